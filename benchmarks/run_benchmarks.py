@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Benchmark response directory loading, lookups, playback, and state iteration
+against synthetic response directories of increasing size
+
+Results are written as JSON so runs can be compared across commits:
+
+    ./benchmarks/run_benchmarks.py --output before.json
+    git checkout <other commit>
+    ./benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+# isort: split
+parent_path = os.path.dirname(
+    os.path.dirname(
+        os.path.abspath(__file__)
+    )
+)
+
+if parent_path not in sys.path:
+    sys.path.insert(0, parent_path)
+
+from mock_cli import (  # noqa: E402
+    CommandInvocation,
+    MockCMDStateConfig,
+    MockCommand,
+    ResponseDirectory
+)
+from mock_cli.__about__ import __version__  # noqa: E402
+
+MIB = 1024 * 1024
+
+DEFAULT_COMMAND_COUNTS = [10, 1000, 10000]
+DEFAULT_OUTPUT_SIZES = [MIB, 64 * MIB]
+DEFAULT_LOOKUPS = 2000
+DEFAULT_STARTUP_RUNS = 10
+DEFAULT_STATE_ITERATIONS = 200
+
+# results are compared on these keys, the rest are measurements
+RESULT_KEYS = ["benchmark", "commands", "output_bytes", "use_index"]
+
+
+def parse_sizes(sizes_str):
+    multipliers = {"k": 1024, "m": MIB, "g": 1024 * MIB}
+    sizes = []
+    for size in sizes_str.split(","):
+        size = size.strip().lower()
+        multiplier = 1
+        if size and size[-1] in multipliers:
+            multiplier = multipliers[size[-1]]
+            size = size[:-1]
+        sizes.append(int(float(size) * multiplier))
+    return sizes
+
+
+def parse_counts(counts_str):
+    return [int(count) for count in counts_str.split(",")]
+
+
+def summarize(samples, unit="us", scale=1e6):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    summary = {
+        f"median_{unit}": statistics.median(samples) * scale,
+        f"mean_{unit}": statistics.fmean(samples) * scale,
+        f"p99_{unit}": p99 * scale,
+        f"min_{unit}": samples[0] * scale,
+        "samples": len(samples)
+    }
+    return summary
+
+
+def generate_output(size, chunk_size=MIB):
+    # compressible, but not trivially so
+    chunk = bytes(random.Random(size).getrandbits(8)
+                  for _ in range(256)) * (chunk_size // 256)
+    remaining = size
+    while remaining > 0:
+        piece = chunk[:remaining]
+        remaining -= len(piece)
+        yield piece
+
+
+def command_args(num):
+    return ["synthetic", "--item", f"item-{num}", f"--flag={num % 7}"]
+
+
+def generate_directory(work_dir: Path, commands: int, output_bytes: int = 64) -> Path:
+    """
+    Create a response directory with the given number of commands,
+    each with output_bytes of output
+    """
+    directory_path = Path(
+        work_dir, f"directory-{commands}-{output_bytes}", "responses.json")
+    if directory_path.exists():
+        return directory_path
+    directory = ResponseDirectory(directory_path, create=True,
+                                  response_dir=Path(directory_path.parent, "responses"))
+    for num in range(commands):
+        if output_bytes <= 1024:
+            output = f"output for item {num}\n".encode().ljust(output_bytes, b".")
+        else:
+            output = generate_output(output_bytes)
+        invocation = CommandInvocation(command_args(num), output, b"", 0,
+                                       f"synthetic-{num}", False)
+        directory.add_command_invocation(invocation)
+    directory.save()
+    return directory_path
+
+
+def bench_load(directory_path: Path, commands: int, use_index: bool):
+    if use_index:
+        # build the index up front so only opening it is measured
+        ResponseDirectory(directory_path, use_index=True)
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        ResponseDirectory(directory_path, use_index=use_index)
+        samples.append(time.perf_counter() - start)
+    result = {"benchmark": "load", "commands": commands,
+              "use_index": use_index}
+    result.update(summarize(samples, unit="ms", scale=1e3))
+    return result
+
+
+def bench_lookup(directory_path: Path, commands: int, use_index: bool, lookups: int):
+    directory = ResponseDirectory(directory_path, use_index=use_index)
+    rand = random.Random(commands)
+    arg_lists = [command_args(rand.randrange(commands))
+                 for _ in range(lookups)]
+    samples = []
+    for args in arg_lists:
+        start = time.perf_counter()
+        directory.response_lookup(args)
+        samples.append(time.perf_counter() - start)
+    result = {"benchmark": "lookup", "commands": commands,
+              "use_index": use_index}
+    result.update(summarize(samples))
+    return result
+
+
+def bench_startup(directory_path: Path, commands: int, use_index: bool, runs: int):
+    # the cost of starting a mock command process, playing back one response, and exiting
+    env = dict(os.environ)
+    env["MOCK_CLI_RESPONSE_DIRECTORY"] = str(directory_path)
+    env.pop("MOCK_CMD_STATE_DIR", None)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [parent_path, env.get("PYTHONPATH", "")])
+    code = ("import os, sys; from mock_cli.playback import RESPONSE_DIR_ENV_NAME, respond; "
+            "sys.exit(respond(response_directory=os.environ[RESPONSE_DIR_ENV_NAME], "
+            f"args=sys.argv[1:], use_index={use_index}))")
+    argv = [sys.executable, "-c", code] + command_args(commands // 2)
+    # warm the index and the OS's file cache
+    subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, check=True)
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - start)
+    result = {"benchmark": "startup", "commands": commands,
+              "use_index": use_index}
+    result.update(summarize(samples, unit="ms", scale=1e3))
+    return result
+
+
+def bench_interpreter_startup(runs: int):
+    # baseline for bench_startup()
+    argv = [sys.executable, "-c", "pass"]
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, check=True)
+        samples.append(time.perf_counter() - start)
+    result = {"benchmark": "interpreter_startup"}
+    result.update(summarize(samples, unit="ms", scale=1e3))
+    return result
+
+
+def _drain(read_fd, counter):
+    while True:
+        data = os.read(read_fd, MIB)
+        if not data:
+            break
+        counter[0] += len(data)
+
+
+def bench_playback(directory_path: Path, output_bytes: int):
+    # play back a response into a pipe, the way a mock command's stdout usually is
+    cmd = MockCommand(response_directory=directory_path)
+    samples = []
+    for _ in range(3):
+        read_fd, write_fd = os.pipe()
+        counter = [0]
+        reader = threading.Thread(target=_drain, args=(read_fd, counter))
+        reader.start()
+        with open(write_fd, "wb", closefd=True) as stdout, open(os.devnull, "wb") as stderr:
+            start = time.perf_counter()
+            cmd.respond(command_args(0), stdout=stdout, stderr=stderr)
+        reader.join()
+        elapsed = time.perf_counter() - start
+        os.close(read_fd)
+        if counter[0] != output_bytes:
+            raise RuntimeError(
+                f"Played back {counter[0]} bytes, expected {output_bytes}")
+        samples.append(elapsed)
+    best = min(samples)
+    result = {
+        "benchmark": "playback",
+        "output_bytes": output_bytes,
+        "median_s": statistics.median(samples),
+        "best_mb_per_s": output_bytes / MIB / best,
+        "samples": len(samples)
+    }
+    return result
+
+
+def bench_state_iteration(work_dir: Path, iterations: int):
+    directory_path = generate_directory(work_dir, 10)
+    state_dir = Path(work_dir, "state")
+    state_dir.mkdir(exist_ok=True)
+    config_path = Path(state_dir, "config.json")
+    config = {
+        "iteration": 0,
+        "max-iterations": iterations,
+        "state-list": [
+            {"response-directory": str(directory_path),
+             "env-vars": {"set": {"MOCK_CLI_BENCH_ITERATION": str(num)}, "pop": []}}
+            for num in range(iterations + 1)
+        ]
+    }
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+    state_config = MockCMDStateConfig(config_path)
+    samples = []
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            state_config.iterate()
+            samples.append(time.perf_counter() - start)
+    finally:
+        state_config.restore_env()
+    result = {"benchmark": "state_iteration"}
+    result.update(summarize(samples))
+    return result
+
+
+def git_commit():
+    try:
+        proc = subprocess.run(["git", "rev-parse", "HEAD"], cwd=parent_path,
+                              capture_output=True, text=True)
+    except OSError:
+        return None
+    commit = proc.stdout.strip() if proc.returncode == 0 else None
+    return commit
+
+
+def run_benchmarks(work_dir: Path, command_counts, output_sizes, lookups, startup_runs,
+                   state_iterations, progress=None):
+    if progress is None:
+        def progress(msg):
+            pass
+    results = []
+    progress("interpreter startup")
+    results.append(bench_interpreter_startup(startup_runs))
+    for commands in command_counts:
+        progress(f"generating directory with {commands} commands")
+        directory_path = generate_directory(work_dir, commands)
+        for use_index in (False, True):
+            progress(f"{commands} commands, use_index={use_index}")
+            results.append(bench_load(directory_path, commands, use_index))
+            results.append(bench_lookup(
+                directory_path, commands, use_index, lookups))
+            results.append(bench_startup(
+                directory_path, commands, use_index, startup_runs))
+    for output_bytes in output_sizes:
+        progress(f"generating {output_bytes} byte response")
+        directory_path = generate_directory(work_dir, 1, output_bytes)
+        progress(f"playback of {output_bytes} bytes")
+        results.append(bench_playback(directory_path, output_bytes))
+    progress("state iteration")
+    results.append(bench_state_iteration(work_dir, state_iterations))
+    return results
+
+
+def result_key(result):
+    return tuple(result.get(key) for key in RESULT_KEYS)
+
+
+def compare(results, baseline_results):
+    """
+    Print each measurement's change relative to a baseline run
+    """
+    baseline = {result_key(result): result for result in baseline_results}
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        label = " ".join(f"{key}={result[key]}" for key in RESULT_KEYS
+                         if result.get(key) is not None)
+        for measurement, value in result.items():
+            if measurement in RESULT_KEYS or measurement == "samples":
+                continue
+            base_value = base.get(measurement)
+            if not base_value:
+                continue
+            change = (value - base_value) / base_value * 100
+            print(f"{label}: {measurement} {base_value:.3f} -> {value:.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark mock-cli-framework")
+    parser.add_argument("--commands", type=parse_counts, default=DEFAULT_COMMAND_COUNTS,
+                        help="Comma-separated numbers of commands per synthetic directory, e.g., 10,1000,100000")
+    parser.add_argument("--output-sizes", type=parse_sizes, default=DEFAULT_OUTPUT_SIZES,
+                        help="Comma-separated response sizes to measure playback of, e.g., 1m,64m,2g")
+    parser.add_argument("--lookups", type=int, default=DEFAULT_LOOKUPS,
+                        help="Number of lookups to time per directory")
+    parser.add_argument("--startup-runs", type=int, default=DEFAULT_STARTUP_RUNS,
+                        help="Number of mock command processes to time per directory")
+    parser.add_argument("--state-iterations", type=int, default=DEFAULT_STATE_ITERATIONS,
+                        help="Number of state iterations to time")
+    parser.add_argument("--work-dir",
+                        help="Directory to generate synthetic response directories in. "
+                        "Reused across runs if provided, otherwise a temporary directory is used")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare results to a previous run's JSON file")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Don't print progress to stderr")
+    args = parser.parse_args()
+
+    def progress(msg):
+        if not args.quiet:
+            print(f"[benchmark] {msg}", file=sys.stderr)
+
+    run_args = (args.commands, args.output_sizes, args.lookups,
+                args.startup_runs, args.state_iterations)
+    if args.work_dir:
+        work_dir = Path(args.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        results = run_benchmarks(work_dir, *run_args, progress=progress)
+    else:
+        with tempfile.TemporaryDirectory(prefix="mock-cli-bench-") as tmp:
+            results = run_benchmarks(Path(tmp), *run_args, progress=progress)
+
+    report = {
+        "meta": {
+            "mock_cli_version": __version__,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time()
+        },
+        "results": results
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json + "\n")
+    else:
+        print(report_json)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        compare(results, baseline["results"])
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,17 +1,60 @@
 from .__about__ import __summary__, __title__, __version__  # noqa: F401
-from .about import MockCLIAbout  # noqa: F401
-from .mock_cmd import MockCommand  # noqa: F401
-from .mock_cmd_state import (  # noqa: F401
-    MockCMDNewStateConfig,
-    MockCMDStateConfig
-)
-from .responses import (  # noqa: F401
-    CommandInvocation,
-    CommandResponse,
-    ResponseAddException,
-    ResponseDirectory,
-    ResponseDirectoryException,
-    ResponseLookupException,
-    ResponseReadException,
-    ResponseRecordException
-)
+
+# Public names are imported on first access rather than up front,
+# so programs that only need a small part of mock_cli (e.g., a mock command
+# that only plays back responses) don't pay to import all of it
+_LAZY_ATTRS = {
+    "ArgPatternException": ".arg_patterns",
+    "ArgPatternMatcher": ".arg_patterns",
+    "ArgKeyException": ".argv_conversion",
+    "upgrade_arg_keys": ".argv_conversion",
+    "AsyncRecorder": ".async_record",
+    "BatchRecordException": ".batch_record",
+    "BatchRecorder": ".batch_record",
+    "BatchRecordSpec": ".batch_record",
+    "BlobStore": ".blob_store",
+    "migrate_to_blob_store": ".blob_store",
+    "maintain": ".maintenance",
+    "MappedOutput": ".mapped_output",
+    "MockCLIAbout": ".about",
+    "MockCommand": ".mock_cmd",
+    "MockCMDNewStateConfig": ".mock_cmd_state",
+    "MockCMDStateConfig": ".mock_cmd_state",
+    "OutputTiming": ".timing",
+    "ResponseArchive": ".archive",
+    "pack_directory": ".archive",
+    "unpack_archive": ".archive",
+    "ResponseCache": ".response_cache",
+    "ResponseIndex": ".response_index",
+    "build_index": ".response_index",
+    "CommandInvocation": ".responses",
+    "CommandResponse": ".responses",
+    "ResponseAddException": ".responses",
+    "ResponseDirectory": ".responses",
+    "ResponseDirectoryException": ".responses",
+    "ResponseLookupException": ".responses",
+    "ResponseReadException": ".responses",
+    "ResponseRecordException": ".responses",
+    "StateBundle": ".state_bundle",
+    "build_state_bundle": ".state_bundle",
+    "SubprocessInterceptor": ".intercept",
+}
+
+__all__ = ["__summary__", "__title__", "__version__"] + list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+
+    module = import_module(module_name, __name__)
+    attr = getattr(module, name)
+    # cache it so __getattr__ isn't called again for this name
+    globals()[name] = attr
+    return attr
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
@@ -0,0 +1,476 @@
+import io
+import json
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+
+from .blob_store import BLOB_HASH_ALGORITHM
+from .slot_table import encode_key
+from .stream_io import CHUNK_SIZE, OutputSource, iter_chunks
+
+# A response archive packs a response directory, its output and its input
+# into a single SQLite database, rather than a JSON file and a few files per response:
+#   directory: "meta" and "command_patterns", JSON-encoded
+#   commands:  (input hash, or "" for none; argument string; JSON-encoded response dictionary)
+#   blobs:     (SHA-256 digest; stored bytes), referenced by responses' "stdout_blob",
+#              "stderr_blob", and "timing_blob", the same as in a blob store
+#   inputs:    (input hash; blob digest) for recorded input
+# Archives are recognized by their content, so they can have any name, and are opened read-only.
+# To change one, unpack it, record into the directory, and pack it again
+
+_SQLITE_MAGIC = b"SQLite format 3\x00"
+# "MCLI"
+_APPLICATION_ID = 0x4D434C49
+_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE directory (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE commands (
+    input_hash TEXT NOT NULL,
+    args BLOB NOT NULL,
+    response TEXT NOT NULL,
+    PRIMARY KEY (input_hash, args)
+) WITHOUT ROWID;
+CREATE TABLE blobs (digest TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE inputs (input_hash TEXT PRIMARY KEY, digest TEXT NOT NULL);
+"""
+
+_BLOB_KEYS = ["stdout_blob", "stderr_blob", "timing_blob"]
+
+
+class ResponseArchiveException(Exception):
+    pass
+
+
+def is_archive(path) -> bool:
+    """
+    Whether path is a response archive rather than a response directory JSON file
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(len(_SQLITE_MAGIC))
+    except OSError:
+        return False
+    return header == _SQLITE_MAGIC
+
+
+def _args_key(arg_string: str) -> bytes:
+    return encode_key(arg_string)
+
+
+class ResponseArchive:
+    """
+    A read-only response directory packed into a single file
+
+    Looking up a response queries the archive's commands table rather than loading
+    the whole directory, and output is streamed from the archive as it's played back
+    """
+
+    def __init__(self, archive_path):
+        # only needed for archives
+        import sqlite3
+
+        self._archive_path = Path(archive_path)
+        uri = self._archive_path.resolve().as_uri() + "?mode=ro"
+        try:
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._load_header()
+        except sqlite3.Error as e:
+            raise ResponseArchiveException(
+                f"Unable to open response archive {archive_path}: {e}") from e
+
+    def _load_header(self):
+        (application_id,) = self._conn.execute(
+            "PRAGMA application_id").fetchone()
+        (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        if application_id != _APPLICATION_ID or version != _VERSION:
+            raise ResponseArchiveException(
+                f"Unrecognized response archive format: {self._archive_path}")
+        directory = dict(self._conn.execute(
+            "SELECT key, value FROM directory"))
+        self._meta = json.loads(directory["meta"])
+        # decoded the first time they're needed, since most lookups match exactly
+        self._command_patterns_json = directory["command_patterns"]
+        self._command_patterns = None
+
+    @property
+    def archive_path(self) -> Path:
+        return self._archive_path
+
+    @property
+    def meta(self) -> Dict:
+        return self._meta
+
+    @property
+    def command_patterns(self) -> List[Dict]:
+        if self._command_patterns is None:
+            self._command_patterns = json.loads(self._command_patterns_json)
+        return self._command_patterns
+
+    def lookup(self, input_hash: Optional[str], arg_string: str) -> Optional[Dict]:
+        row = self._conn.execute(
+            "SELECT response FROM commands WHERE input_hash = ? AND args = ?",
+            (input_hash or "", _args_key(arg_string))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def load_directory(self) -> Dict:
+        """
+        The archive's response directory dictionary, as it would be loaded from a JSON file
+        """
+        directory = {
+            "meta": dict(self._meta),
+            "commands": {},
+            "commands_with_input": {},
+            "command_patterns": json.loads(self._command_patterns_json)
+        }
+        rows = self._conn.execute(
+            "SELECT input_hash, args, response FROM commands")
+        for input_hash, args, response in rows:
+            if input_hash:
+                commands = directory["commands_with_input"].setdefault(
+                    input_hash, {})
+            else:
+                commands = directory["commands"]
+            commands[args.decode("utf-8", "surrogatepass")] = json.loads(response)
+        return directory
+
+    def __contains__(self, digest: str) -> bool:
+        return self._blob_rowid(digest) is not None
+
+    def open_blob(self, digest: str) -> BinaryIO:
+        """
+        Open a blob for reading as a stream
+        """
+        rowid = self._blob_rowid(digest)
+        if rowid is None:
+            raise ResponseArchiveException(f"Blob not found in archive: {digest}")
+        if hasattr(self._conn, "blobopen"):
+            # python >= 3.11
+            blob = self._conn.blobopen("blobs", "data", rowid, readonly=True)
+            return io.BufferedReader(_BlobReader(blob), buffer_size=CHUNK_SIZE)
+        (data,) = self._conn.execute(
+            "SELECT data FROM blobs WHERE rowid = ?", (rowid,)).fetchone()
+        return io.BytesIO(data)
+
+    def read_blob(self, digest: str) -> bytes:
+        with self.open_blob(digest) as f:
+            data = f.read()
+        return data
+
+    def input_digest(self, input_hash: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT digest FROM inputs WHERE input_hash = ?", (input_hash,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def iter_input_hashes(self):
+        for (input_hash,) in self._conn.execute("SELECT input_hash FROM inputs"):
+            yield input_hash
+
+    def _blob_rowid(self, digest: str) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT rowid FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class _BlobReader(io.RawIOBase):
+    def __init__(self, blob):
+        super().__init__()
+        self._blob = blob
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._blob.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._blob.close()
+        super().close()
+
+
+class _ArchiveWriter:
+    def __init__(self, conn):
+        self._conn = conn
+        self.blobs = 0
+
+    def add(self, source: OutputSource, digest: Optional[str] = None, size: Optional[int] = None) -> str:
+        """
+        Add a blob, unless one with the same content is already in the archive
+
+        If a file object's digest and size are known, it's streamed straight into the archive.
+        Otherwise it's read into memory to hash it
+        """
+        if digest is None or size is None:
+            import hashlib
+
+            data = b"".join(iter_chunks(source))
+            digest = hashlib.new(BLOB_HASH_ALGORITHM, data).hexdigest()
+            source = data
+            size = len(data)
+        exists = self._conn.execute(
+            "SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if exists:
+            return digest
+        if not hasattr(self._conn, "blobopen"):
+            data = b"".join(iter_chunks(source))
+            self._conn.execute(
+                "INSERT INTO blobs (digest, data) VALUES (?, ?)", (digest, data))
+        else:
+            cursor = self._conn.execute(
+                "INSERT INTO blobs (digest, data) VALUES (?, zeroblob(?))", (digest, size))
+            with self._conn.blobopen("blobs", "data", cursor.lastrowid) as blob:
+                for chunk in iter_chunks(source):
+                    blob.write(chunk)
+        self.blobs += 1
+        return digest
+
+    def add_file(self, path) -> str:
+        import hashlib
+
+        hasher = hashlib.new(BLOB_HASH_ALGORITHM)
+        with open(path, "rb") as f:
+            for chunk in iter_chunks(f):
+                hasher.update(chunk)
+            size = f.tell()
+            f.seek(0)
+            digest = self.add(f, digest=hasher.hexdigest(), size=size)
+        return digest
+
+
+def pack_directory(responsedir_json_file, archive_path, input_dir=None) -> Dict[str, int]:
+    """
+    Pack a response directory, along with its output and input, into a single-file response archive
+
+    Output is stored as it was recorded (compressed or not), and identical output
+    is stored once. The response directory itself isn't modified
+
+    Parameters
+    ----------
+    responsedir_json_file : Union[str, Path]
+        The response directory JSON file to pack
+    archive_path : Union[str, Path]
+        The archive to write. It is replaced if it already exists
+    input_dir : Union[str, Path], optional
+        Where the directory's recorded input is, if anywhere.
+        Defaults to the "input_dir" saved in the directory, relative to responsedir_json_file.
+        Input that wasn't recorded is skipped
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of responses, distinct blobs, and inputs packed
+    """
+    import sqlite3
+
+    from .file_util import atomic_path
+    from .responses import CommandResponse, ResponseDirectory
+
+    directory = ResponseDirectory(responsedir_json_file)
+    if directory.archive is not None:
+        raise ResponseArchiveException(
+            f"Already a response archive: {responsedir_json_file}")
+    if input_dir is None and directory.meta.get("input_dir"):
+        # relative to the directory JSON file, like "response_dir"
+        input_dir = directory.resolve_meta_path(directory.meta["input_dir"])
+
+    with atomic_path(archive_path) as tmp_name:
+        conn = sqlite3.connect(tmp_name)
+        try:
+            stats = _pack(conn, directory, input_dir, CommandResponse)
+            conn.commit()
+        finally:
+            conn.close()
+    return stats
+
+
+def _pack(conn, directory, input_dir, response_class) -> Dict[str, int]:
+    conn.executescript(_SCHEMA)
+    conn.execute(f"PRAGMA application_id = {_APPLICATION_ID}")
+    conn.execute(f"PRAGMA user_version = {_VERSION}")
+    writer = _ArchiveWriter(conn)
+    blob_dir = directory.blob_dir
+
+    def _pack_response(response_dict: Dict) -> Dict:
+        response = response_class(
+            response_dict, directory.response_dir, blob_dir=blob_dir)
+        packed = dict(response_dict)
+        packed["stdout_blob"] = writer.add_file(response._stdout_path())
+        packed["stderr_blob"] = writer.add_file(response._stderr_path())
+        if "timing" in response:
+            packed["timing_blob"] = writer.add_file(response._timing_path())
+        return packed
+
+    responses = 0
+    input_hashes = set()
+    rows = []
+    commands_with_input = [(None, directory.commands)]
+    commands_with_input.extend(directory.commands_with_input.items())
+    for input_hash, commands in commands_with_input:
+        for arg_string, response_dict in commands.items():
+            rows.append((input_hash or "", _args_key(arg_string),
+                         json.dumps(_pack_response(response_dict))))
+            responses += 1
+        input_hashes.add(input_hash)
+    conn.executemany(
+        "INSERT INTO commands (input_hash, args, response) VALUES (?, ?, ?)", rows)
+
+    command_patterns = []
+    for entry in directory.command_patterns:
+        entry = dict(entry)
+        entry["response"] = _pack_response(entry["response"])
+        command_patterns.append(entry)
+        input_hashes.add(entry.get("input_hash"))
+        responses += 1
+
+    meta = dict(directory.meta)
+    # the archive is its own blob store
+    meta.pop("blob_dir", None)
+    conn.executemany("INSERT INTO directory (key, value) VALUES (?, ?)", [
+        ("meta", json.dumps(meta)),
+        ("command_patterns", json.dumps(command_patterns))
+    ])
+
+    inputs = 0
+    if input_dir:
+        for input_hash in sorted(filter(None, input_hashes)):
+            input_path = Path(input_dir, input_hash, "input.bin")
+            if not input_path.exists():
+                continue
+            conn.execute("INSERT INTO inputs (input_hash, digest) VALUES (?, ?)",
+                         (input_hash, writer.add_file(input_path)))
+            inputs += 1
+
+    stats = {"responses": responses, "blobs": writer.blobs, "inputs": inputs}
+    return stats
+
+
+def unpack_archive(archive_path, responsedir_json_file, response_dir="responses",
+                   blob_dir=None, input_dir="input") -> Dict[str, int]:
+    """
+    Unpack a response archive into a response directory JSON file and its output files
+
+    Parameters
+    ----------
+    archive_path : Union[str, Path]
+        The archive to unpack
+    responsedir_json_file : Union[str, Path]
+        The response directory JSON file to write. It is replaced if it already exists
+    response_dir : Union[str, Path], optional
+        Where to write each response's output files, by default "responses".
+        A relative path is relative to the working directory, and is saved
+        relative to responsedir_json_file, like "response_dir" in any response directory
+    blob_dir : Union[str, Path], optional
+        Write output to a content-addressed blob store here instead of per-invocation directories
+    input_dir : Union[str, Path], optional
+        Where to write recorded input, by default "input"
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of responses and inputs unpacked
+    """
+    from .blob_store import BlobStore
+    from .file_util import atomic_write_json
+    from .path import path_to_save
+    from .stream_io import write_to_path
+
+    archive = ResponseArchive(archive_path)
+    try:
+        directory = archive.load_directory()
+        store = BlobStore(blob_dir) if blob_dir else None
+
+        def _unpack_response(response_dict: Dict):
+            if store is not None:
+                for key in _BLOB_KEYS:
+                    if key in response_dict:
+                        with archive.open_blob(response_dict[key]) as f:
+                            store.add(f)
+                return
+            resp_path = Path(response_dir, response_dict["name"])
+            resp_path.mkdir(parents=True, exist_ok=True)
+            outputs = [("stdout_blob", "stdout"), ("stderr_blob", "stderr"),
+                       ("timing_blob", "timing")]
+            for blob_key, name_key in outputs:
+                if blob_key in response_dict:
+                    with archive.open_blob(response_dict.pop(blob_key)) as f:
+                        write_to_path(Path(resp_path, response_dict[name_key]), f)
+
+        responses = 0
+        for commands in [directory["commands"]] + list(directory["commands_with_input"].values()):
+            for response_dict in commands.values():
+                _unpack_response(response_dict)
+                responses += 1
+        for entry in directory["command_patterns"]:
+            _unpack_response(entry["response"])
+            responses += 1
+
+        inputs = 0
+        for input_hash in archive.iter_input_hashes():
+            input_path = Path(input_dir, input_hash)
+            input_path.mkdir(parents=True, exist_ok=True)
+            with archive.open_blob(archive.input_digest(input_hash)) as f:
+                write_to_path(Path(input_path, "input.bin"), f)
+            inputs += 1
+    finally:
+        archive.close()
+
+    meta = directory["meta"]
+    meta["response_dir"] = path_to_save(response_dir, responsedir_json_file)
+    meta["input_dir"] = path_to_save(input_dir, responsedir_json_file)
+    if blob_dir:
+        meta["blob_dir"] = path_to_save(blob_dir, responsedir_json_file)
+    atomic_write_json(responsedir_json_file, directory, indent=2)
+    stats = {"responses": responses, "inputs": inputs}
+    return stats
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Convert between response directories and single-file response archives")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser(
+        "pack", help="Pack a response directory into an archive")
+    pack_parser.add_argument("response_directory",
+                             help="Response directory JSON file to pack")
+    pack_parser.add_argument("archive", help="Archive file to write")
+    pack_parser.add_argument("--input-dir",
+                             help="Recorded input directory, default: the directory's input_dir")
+    unpack_parser = subparsers.add_parser(
+        "unpack", help="Unpack an archive into a response directory")
+    unpack_parser.add_argument("archive", help="Archive file to unpack")
+    unpack_parser.add_argument("response_directory",
+                               help="Response directory JSON file to write")
+    unpack_parser.add_argument("--response-dir", default="responses",
+                               help="Response output directory, default: responses")
+    unpack_parser.add_argument("--blob-dir",
+                               help="Unpack output into a content-addressed blob store")
+    unpack_parser.add_argument("--input-dir", default="input",
+                               help="Recorded input directory, default: input")
+    parsed = parser.parse_args()
+    if parsed.command == "pack":
+        stats = pack_directory(parsed.response_directory, parsed.archive,
+                               input_dir=parsed.input_dir)
+    else:
+        stats = unpack_archive(parsed.archive, parsed.response_directory,
+                               response_dir=parsed.response_dir,
+                               blob_dir=parsed.blob_dir,
+                               input_dir=parsed.input_dir)
+    print(json.dumps(stats))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
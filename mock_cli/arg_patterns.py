@@ -0,0 +1,164 @@
+import re
+from typing import Dict, List, Optional, Union
+
+# An argument pattern is a list with one element per command-line argument:
+#   "<literal>"                   matches that argument exactly
+#   {"placeholder": "<name>"}     matches any single argument, e.g., a temp path or timestamp
+#   {"regex": "<expression>"}     matches an argument the expression fully matches
+# Patterns are saved in a response directory's "command_patterns" list as:
+#   {"args": <argument pattern>, "input_hash": <input hash or null>, "response": <response dict>}
+
+PLACEHOLDER = "placeholder"
+REGEX = "regex"
+
+ArgPattern = List[Union[str, Dict[str, str]]]
+
+
+class ArgPatternException(Exception):
+    pass
+
+
+def placeholder(name: str) -> Dict[str, str]:
+    return {PLACEHOLDER: name}
+
+
+def regex(expression: str) -> Dict[str, str]:
+    return {REGEX: expression}
+
+
+def validate_pattern(arg_pattern: ArgPattern) -> ArgPattern:
+    """
+    Check that every element of an argument pattern is a literal string,
+    a placeholder, or a valid regular expression
+
+    Returns
+    -------
+    ArgPattern
+        The pattern, as a list
+    """
+    arg_pattern = list(arg_pattern)
+    for arg in arg_pattern:
+        if isinstance(arg, str):
+            continue
+        if isinstance(arg, dict) and len(arg) == 1:
+            if PLACEHOLDER in arg:
+                continue
+            if REGEX in arg:
+                try:
+                    re.compile(arg[REGEX])
+                except re.error as e:
+                    raise ArgPatternException(
+                        f"Invalid regular expression in argument pattern: {arg[REGEX]}") from e
+                continue
+        raise ArgPatternException(f"Invalid argument pattern element: {arg}")
+    return arg_pattern
+
+
+def pattern_entry(input_hash: Optional[str], arg_pattern: ArgPattern, response_dict: Dict) -> Dict:
+    entry = {
+        "args": validate_pattern(arg_pattern),
+        "input_hash": input_hash,
+        "response": response_dict
+    }
+    return entry
+
+
+def add_pattern_entry(pattern_entries: List[Dict], entry: Dict) -> bool:
+    """
+    Add an entry to a directory's list of command patterns,
+    replacing any entry with the same pattern and input hash
+
+    Returns
+    -------
+    bool
+        True if an existing entry was replaced
+    """
+    for i, existing in enumerate(pattern_entries):
+        if existing["args"] == entry["args"] and existing.get("input_hash") == entry["input_hash"]:
+            pattern_entries[i] = entry
+            return True
+    pattern_entries.append(entry)
+    return False
+
+
+class _Node:
+    __slots__ = ("literals", "regexes", "wildcard", "entry")
+
+    def __init__(self):
+        self.literals: Dict[str, "_Node"] = {}
+        # expression -> (compiled expression, node)
+        self.regexes: Dict[str, tuple] = {}
+        self.wildcard: Optional["_Node"] = None
+        self.entry: Optional[Dict] = None
+
+
+class ArgPatternMatcher:
+    """
+    Match command-line arguments against a response directory's argument patterns
+
+    Patterns are compiled into a trie with one level per argument, and literal arguments
+    are found at each level with a dictionary lookup, so matching cost depends on
+    the number of arguments rather than the number of patterns.
+
+    If more than one pattern matches, working from the first argument to the last,
+    literal arguments take priority over regular expressions, which take priority over placeholders
+    """
+
+    def __init__(self, pattern_entries: List[Dict]):
+        # one trie per input hash
+        self._roots: Dict[Optional[str], _Node] = {}
+        for entry in pattern_entries:
+            self._insert(entry)
+
+    def _insert(self, entry: Dict):
+        input_hash = entry.get("input_hash") or None
+        node = self._roots.setdefault(input_hash, _Node())
+        for arg in entry["args"]:
+            if isinstance(arg, str):
+                node = node.literals.setdefault(arg, _Node())
+            elif REGEX in arg:
+                expression = arg[REGEX]
+                if expression not in node.regexes:
+                    node.regexes[expression] = (re.compile(expression), _Node())
+                node = node.regexes[expression][1]
+            else:
+                if node.wildcard is None:
+                    node.wildcard = _Node()
+                node = node.wildcard
+        node.entry = entry
+
+    def match(self, input_hash: Optional[str], args: List[str]) -> Optional[Dict]:
+        """
+        Find the response dictionary of the pattern that best matches args
+
+        Returns
+        -------
+        Optional[Dict]
+            The matching response dictionary, or None if no pattern matches
+        """
+        root = self._roots.get(input_hash or None)
+        if root is None:
+            return None
+        entry = self._match(root, args, 0)
+        response_dict = None
+        if entry is not None:
+            response_dict = entry["response"]
+        return response_dict
+
+    def _match(self, node: _Node, args: List[str], pos: int) -> Optional[Dict]:
+        if pos == len(args):
+            return node.entry
+        arg = args[pos]
+        child = node.literals.get(arg)
+        if child is not None:
+            entry = self._match(child, args, pos + 1)
+            if entry is not None:
+                return entry
+        for compiled, child in node.regexes.values():
+            if compiled.fullmatch(arg):
+                entry = self._match(child, args, pos + 1)
+                if entry is not None:
+                    return entry
+        if node.wildcard is not None:
+            return self._match(node.wildcard, args, pos + 1)
+        return None
@@ -1,12 +1,30 @@
-import shlex
-from typing import AnyStr, List
+import json
+from typing import AnyStr, Dict, List, Optional, Sequence
 
 DEFAULT_SEP = "|"
 
+# Response directories key their commands by an encoded argument string
+#   version 1: arguments joined with "|", so "a|b" and ["a", "b"] collide
+#   version 2: "\" and "|" within arguments are escaped, an empty argument
+#              is "\e", and arguments longer than the directory's digest
+#              threshold are replaced by "\#" and their SHA-256 hex digest
+# Ordinary arguments encode the same way under both versions
+# Directories that don't specify a version use version 1
+ARG_KEY_VERSION_LEGACY = 1
+ARG_KEY_VERSION = 2
+DEFAULT_ARG_DIGEST_THRESHOLD = 1024
+
+_EMPTY_ARG = "\\e"
+_DIGEST_PREFIX = "\\#"
+
+
+class ArgKeyException(Exception):
+    pass
+
 
 def argv_to_string(argv: List, args_to_pop=0, sep=DEFAULT_SEP):
-    for i in range(0, args_to_pop):
-        argv.pop(0)
+    # slice rather than pop, so the caller's list isn't modified
+    argv = argv[args_to_pop:]
 
     # avoid using format strings
     # in some cases pyonepassword uses RedactableString objects
@@ -25,5 +43,154 @@ def argv_from_string(arg_str: AnyStr, popped_args=[], sep=DEFAULT_SEP):
 
 def arg_shlex_from_string(arg_str: AnyStr, popped_args=[], sep=DEFAULT_SEP):
     argv = argv_from_string(arg_str, popped_args=popped_args, sep=sep)
+    arg_str = argv_to_shlex(argv)
+    return arg_str
+
+
+def argv_to_shlex(argv: Sequence[str]) -> str:
+    # shlex is only needed for error messages, so don't import it unless we have to
+    import shlex
+
     arg_str = shlex.join(argv)
     return arg_str
+
+
+def argv_to_key(argv: Sequence[str], version: int = ARG_KEY_VERSION,
+                digest_threshold: int = DEFAULT_ARG_DIGEST_THRESHOLD) -> str:
+    """
+    Encode an argument list as a response directory command key
+
+    Parameters
+    ----------
+    argv : Sequence[str]
+        The command's arguments
+    version : int, optional
+        The directory's argument key version, by default ARG_KEY_VERSION
+    digest_threshold : int, optional
+        Under version 2, arguments longer than this many characters are
+        keyed by their digest, by default DEFAULT_ARG_DIGEST_THRESHOLD
+
+    Returns
+    -------
+    str
+        The command key
+
+    Raises
+    ------
+    ArgKeyException
+        If version isn't a supported argument key version
+    """
+    if version == ARG_KEY_VERSION_LEGACY:
+        return argv_to_string(argv)
+    if version != ARG_KEY_VERSION:
+        raise ArgKeyException(f"Unsupported argument key version: {version}")
+    parts = []
+    for arg in argv:
+        if len(arg) > digest_threshold:
+            arg = _DIGEST_PREFIX + _arg_digest(arg)
+        elif not arg:
+            arg = _EMPTY_ARG
+        elif "\\" in arg or DEFAULT_SEP in arg:
+            arg = arg.replace("\\", "\\\\").replace(DEFAULT_SEP, "\\" + DEFAULT_SEP)
+        parts.append(arg)
+    return DEFAULT_SEP.join(parts)
+
+
+def _arg_digest(arg: str) -> str:
+    # only long arguments are digested, so don't import hashlib unless we have to
+    import hashlib
+
+    # arguments decoded from the OS may contain lone surrogates
+    digest = hashlib.sha256(arg.encode("utf-8", "surrogatepass")).hexdigest()
+    return digest
+
+
+def _legacy_key_to_argv(arg_str: str) -> List[str]:
+    # an empty key is ambiguous, but commands without arguments are the likelier of the two
+    if not arg_str:
+        return []
+    return arg_str.split(DEFAULT_SEP)
+
+
+def upgrade_arg_keys(responsedir_json_file,
+                     digest_threshold: Optional[int] = None) -> Dict[str, int]:
+    """
+    Re-key a response directory's commands with the current argument key version
+
+    Commands are re-keyed in place and the response directory JSON file is rewritten,
+    folding in any journal. Directories already using the current version are left as-is
+
+    Parameters
+    ----------
+    responsedir_json_file : Union[str, Path]
+        The response directory JSON file to upgrade
+    digest_threshold : Optional[int], optional
+        Arguments longer than this many characters are keyed by their digest,
+        by default DEFAULT_ARG_DIGEST_THRESHOLD
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of commands re-keyed, and how many of them have digested arguments
+
+    Raises
+    ------
+    ArgKeyException
+        If the directory already uses the current version with a different digest threshold
+    """
+    from .responses import ResponseDirectory
+
+    directory = ResponseDirectory(responsedir_json_file)
+    meta = directory.meta
+    stats = {"commands": 0, "digested": 0}
+    if directory.arg_key_version == ARG_KEY_VERSION:
+        if digest_threshold is not None and digest_threshold != directory.arg_digest_threshold:
+            # digested arguments can't be recovered to re-key them
+            raise ArgKeyException(
+                f"Response directory already uses argument key version {ARG_KEY_VERSION} "
+                f"with digest threshold {directory.arg_digest_threshold}")
+        return stats
+    if digest_threshold is None:
+        digest_threshold = DEFAULT_ARG_DIGEST_THRESHOLD
+
+    def rekey(commands: Dict) -> Dict:
+        rekeyed = {}
+        for arg_string, response_dict in commands.items():
+            argv = _legacy_key_to_argv(arg_string)
+            rekeyed[argv_to_key(argv, digest_threshold=digest_threshold)] = response_dict
+            stats["commands"] += 1
+            if any(len(arg) > digest_threshold for arg in argv):
+                stats["digested"] += 1
+        return rekeyed
+
+    raw_directory = directory._response_directory
+    raw_directory["commands"] = rekey(raw_directory["commands"])
+    # older directories may not have a "commands_with_input" section
+    commands_with_input = raw_directory.get("commands_with_input", {})
+    for input_hash, commands in commands_with_input.items():
+        commands_with_input[input_hash] = rekey(commands)
+    meta["arg_key_version"] = ARG_KEY_VERSION
+    meta["arg_digest_threshold"] = digest_threshold
+    directory.compact()
+    return stats
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Upgrade a response directory to the current argument key version")
+    parser.add_argument("response_directory",
+                        help="Response directory JSON file to upgrade")
+    parser.add_argument("--digest-threshold", type=int,
+                        help=("Key arguments longer than this many characters by their digest, "
+                              f"default: {DEFAULT_ARG_DIGEST_THRESHOLD}"))
+    parsed = parser.parse_args()
+    stats = upgrade_arg_keys(parsed.response_directory,
+                             digest_threshold=parsed.digest_threshold)
+    print(json.dumps(stats))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
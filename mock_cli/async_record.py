@@ -0,0 +1,258 @@
+import asyncio
+import subprocess
+import tempfile
+import time
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+from .batch_record import BatchRecordException, BatchRecordSpec, _check_specs
+from .hashing import digest_input
+from .responses import (
+    CommandInvocation,
+    ResponseAddException,
+    ResponseDirectory
+)
+from .stream_io import CHUNK_SIZE
+from .timing import STDERR_STREAM, STDOUT_STREAM, OutputTiming
+
+
+class AsyncRecorder:
+    """
+    Run real commands from an asyncio event loop and record their responses
+
+    Each command's stdout and stderr are drained concurrently and spooled to disk
+    as they arrive, so a single event loop can record many slow commands at once
+    """
+
+    def __init__(self,
+                 directory: ResponseDirectory,
+                 max_concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 env: Optional[Dict[str, str]] = None,
+                 cwd=None):
+        """
+        Parameters
+        ----------
+        directory : ResponseDirectory
+            The response directory to add recorded responses to
+        max_concurrency : Optional[int], optional
+            Maximum number of commands to run at once, by default no limit
+        timeout : Optional[float], optional
+            Seconds to let each command run before it's killed and recorded as a failure
+        env : Optional[Dict[str, str]], optional
+            Environment to run the commands in, defaults to this process's environment
+        cwd : Union[str, Path], optional
+            Working directory to run the commands in, defaults to this process's working directory
+        """
+        self._directory = directory
+        self._max_concurrency = max_concurrency
+        self._timeout = timeout
+        self._env = env
+        self._cwd = cwd
+        # created on first use, so it belongs to the event loop that's running
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # (input hash, command key) and invocation names of commands still being recorded,
+        # which aren't in the directory yet, so its own checks can't see them
+        self._pending_keys: Set[Tuple[Optional[str], str]] = set()
+        self._pending_names: Set[str] = set()
+
+    async def record(self, specs: List[BatchRecordSpec], overwrite=False,
+                     save=True) -> List[CommandInvocation]:
+        """
+        Run and record a batch of commands concurrently
+
+        Every spec is checked against the directory (and the rest of the batch)
+        before anything is run, so a conflicting entry fails the batch up front
+
+        Returns
+        -------
+        List[CommandInvocation]
+            The recorded invocations, in the same order as specs
+
+        Raises
+        ------
+        ResponseAddException
+            If a spec's arguments are already registered (and overwrite is False),
+            appear more than once in the batch, or are still being recorded by another call
+        BatchRecordException
+            If any command couldn't be run or recorded. The rest are still added
+        """
+        reserved = self._reserve(specs, overwrite)
+        try:
+            results = await asyncio.gather(*[self._run_and_record(spec) for spec in specs],
+                                           return_exceptions=True)
+        finally:
+            self._release(reserved)
+
+        invocations = []
+        failures = {}
+        for spec, result in zip(specs, results):
+            if isinstance(result, BaseException):
+                failures[spec.invocation_name] = result
+                continue
+            invocations.append(result)
+
+        # the directory dictionary is only touched from the event loop's thread
+        for invocation in invocations:
+            self._directory._register_invocation(invocation)
+        if save:
+            self._directory.save()
+
+        if failures:
+            raise BatchRecordException(
+                f"Failed to record {len(failures)} of {len(specs)} commands: {list(failures)}",
+                failures)
+        return invocations
+
+    async def record_one(self, spec: BatchRecordSpec, overwrite=False,
+                         save=True) -> CommandInvocation:
+        """
+        Run and record a single command
+
+        Calls may run concurrently, e.g., with asyncio.gather(), and share max_concurrency.
+        A command whose arguments (or invocation name) are still being recorded
+        by another call is rejected, even if overwrite is True
+
+        Raises
+        ------
+        ResponseAddException
+            If spec's arguments are already registered (and overwrite is False),
+            or are still being recorded by another call
+        subprocess.TimeoutExpired
+            If the command didn't finish within timeout
+        """
+        reserved = self._reserve([spec], overwrite)
+        try:
+            invocation = await self._run_and_record(spec)
+            self._directory._register_invocation(invocation)
+        finally:
+            self._release(reserved)
+        if save:
+            self._directory.save()
+        return invocation
+
+    def _reserve(self, specs: List[BatchRecordSpec], overwrite):
+        # called from the event loop's thread before awaiting anything,
+        # so concurrent calls can't both pass the checks for the same command
+        _check_specs(self._directory, specs, overwrite)
+        keys = []
+        names = []
+        for spec in specs:
+            input_hash = digest_input(
+                spec.input, self._directory.input_hash_algorithm)
+            key = (input_hash, self._directory.arg_key(spec.cmd_args))
+            if key in self._pending_keys:
+                raise ResponseAddException(
+                    f"Command is already being recorded: '{spec.cmd_args}'")
+            if spec.invocation_name in self._pending_names:
+                raise ResponseAddException(
+                    f"Invocation name is already being recorded: '{spec.invocation_name}'")
+            keys.append(key)
+            names.append(spec.invocation_name)
+        self._pending_keys.update(keys)
+        self._pending_names.update(names)
+        return keys, names
+
+    def _release(self, reserved):
+        keys, names = reserved
+        self._pending_keys.difference_update(keys)
+        self._pending_names.difference_update(names)
+
+    async def _run_and_record(self, spec: BatchRecordSpec) -> CommandInvocation:
+        if self._semaphore is None and self._max_concurrency is not None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        if self._semaphore is None:
+            return await self._run_and_record_now(spec)
+        async with self._semaphore:
+            return await self._run_and_record_now(spec)
+
+    async def _run_and_record_now(self, spec: BatchRecordSpec) -> CommandInvocation:
+        # spool output to temporary files rather than memory,
+        # then stream it into the response directory
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            timing = None
+            start_ns = time.monotonic_ns()
+            if spec.record_timing or spec.record_interleaving:
+                timing = OutputTiming(start_ns=start_ns)
+            stdin = subprocess.DEVNULL
+            if spec.input is not None:
+                stdin = subprocess.PIPE
+            proc = await asyncio.create_subprocess_exec(*spec.argv,
+                                                        stdin=stdin,
+                                                        stdout=subprocess.PIPE,
+                                                        stderr=subprocess.PIPE,
+                                                        env=self._env,
+                                                        cwd=self._cwd)
+            try:
+                returncode = await asyncio.wait_for(
+                    self._communicate(proc, spec.input, stdout, stderr, timing), self._timeout)
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(spec.argv, self._timeout) from None
+            finally:
+                # timed out, or we were cancelled
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+            if timing is not None:
+                timing.finish()
+                if not spec.record_timing:
+                    # only the order matters, so keep the event log small
+                    timing.coalesce()
+            stdout.seek(0)
+            stderr.seek(0)
+            # hashing, compressing, and copying output into the directory
+            # would block the event loop, so do it in a worker thread
+            loop = asyncio.get_running_loop()
+            invocation = await loop.run_in_executor(
+                None, self._record, spec, stdout, stderr, returncode, timing)
+        return invocation
+
+    async def _communicate(self, proc: asyncio.subprocess.Process, input: Optional[bytes],
+                           stdout: BinaryIO, stderr: BinaryIO,
+                           timing: Optional[OutputTiming]) -> int:
+        # drain both pipes (and feed input) at once, so the command can't block
+        # writing to one full pipe while we wait on the other
+        tasks = [self._drain(proc.stdout, stdout, STDOUT_STREAM, timing),
+                 self._drain(proc.stderr, stderr, STDERR_STREAM, timing)]
+        if input is not None:
+            tasks.append(self._feed_input(proc.stdin, input))
+        await asyncio.gather(*tasks)
+        returncode = await proc.wait()
+        return returncode
+
+    @staticmethod
+    async def _drain(reader: asyncio.StreamReader, spool: BinaryIO, stream: int,
+                     timing: Optional[OutputTiming]):
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if timing is not None:
+                timing.note_chunk(stream, len(chunk))
+            spool.write(chunk)
+
+    @staticmethod
+    async def _feed_input(stdin: asyncio.StreamWriter, input: bytes):
+        try:
+            stdin.write(input)
+            await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # the command exited without reading all of its input
+            pass
+        finally:
+            stdin.close()
+
+    def _record(self, spec: BatchRecordSpec, stdout: BinaryIO, stderr: BinaryIO,
+                returncode: int, timing: Optional[OutputTiming]) -> CommandInvocation:
+        invocation = CommandInvocation(spec.cmd_args,
+                                       stdout,
+                                       stderr,
+                                       returncode,
+                                       spec.invocation_name,
+                                       spec.changes_state,
+                                       input=spec.input,
+                                       input_hash_algorithm=self._directory.input_hash_algorithm,
+                                       record_timing=spec.record_timing,
+                                       record_interleaving=spec.record_interleaving,
+                                       timing=timing)
+        self._directory._record_invocation(invocation)
+        return invocation
@@ -0,0 +1,341 @@
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from .hashing import digest_input
+from .responses import (
+    CommandInvocation,
+    ResponseAddException,
+    ResponseDirectory
+)
+from .timing import STDERR_STREAM, STDOUT_STREAM, OutputTiming
+
+
+class BatchRecordException(Exception):
+    """
+    Exception for when one or more commands in a batch couldn't be recorded.
+    The ones that could be recorded are still added to the response directory
+    """
+
+    def __init__(self, msg, failures: Dict[str, BaseException]):
+        super().__init__(msg)
+        self.failures = failures
+
+
+class BatchRecordSpec(dict):
+    def __init__(self,
+                 argv: List[str],
+                 invocation_name: str,
+                 input: Optional[Union[str, bytes]] = None,
+                 changes_state: bool = False,
+                 cmd_args: Optional[List[str]] = None,
+                 record_timing: bool = False,
+                 record_interleaving: bool = False):
+        """
+        Describe a command to run and record as part of a batch
+
+        Parameters
+        ----------
+        argv : List[str]
+            The full command to run, including the program name
+        invocation_name : str
+            A unique, filesystem-safe name for this invocation
+        input : Optional[Union[str, bytes]], optional
+            Input to provide on the command's standard input, if any
+        changes_state : bool, optional
+            Whether this invocation should trigger a state iteration, by default False
+        cmd_args : Optional[List[str]], optional
+            The arguments to record the response under. Defaults to argv minus the program name
+        record_timing : bool, optional
+            Record when each chunk of output was produced, so it can be replayed
+            with its original timing, by default False
+        record_interleaving : bool, optional
+            Record only the order in which the command wrote to stdout and stderr,
+            so it can be played back interleaved the same way, by default False
+        """
+        if cmd_args is None:
+            cmd_args = argv[1:]
+        if isinstance(input, str):
+            input = input.encode()
+        _dict = {
+            "argv": list(argv),
+            "cmd_args": list(cmd_args),
+            "invocation_name": invocation_name,
+            "input": input,
+            "changes_state": changes_state,
+            "record_timing": record_timing,
+            "record_interleaving": record_interleaving
+        }
+        super().__init__(_dict)
+
+    @property
+    def argv(self) -> List[str]:
+        return self["argv"]
+
+    @property
+    def cmd_args(self) -> List[str]:
+        return self["cmd_args"]
+
+    @property
+    def invocation_name(self) -> str:
+        return self["invocation_name"]
+
+    @property
+    def input(self) -> Optional[bytes]:
+        return self["input"]
+
+    @property
+    def changes_state(self) -> bool:
+        return self["changes_state"]
+
+    @property
+    def record_timing(self) -> bool:
+        return self.get("record_timing", False)
+
+    @property
+    def record_interleaving(self) -> bool:
+        return self.get("record_interleaving", False)
+
+
+def _registered_names(directory: ResponseDirectory) -> Dict[str, Optional[Tuple[Optional[str], str]]]:
+    # invocation name -> (input hash, command key) it's registered under,
+    # or None if it's registered under an argument pattern
+    names = {}
+    for arg_string, response_dict in directory.commands.items():
+        names[response_dict.get("name")] = (None, arg_string)
+    # older directories may not have a "commands_with_input" section
+    commands_with_input = directory._response_directory.get(
+        "commands_with_input", {})
+    for input_hash, commands in commands_with_input.items():
+        for arg_string, response_dict in commands.items():
+            names[response_dict.get("name")] = (input_hash, arg_string)
+    for entry in directory.command_patterns:
+        names[entry["response"].get("name")] = None
+    return names
+
+
+def _check_specs(directory: ResponseDirectory, specs: List[BatchRecordSpec], overwrite):
+    registered_names = _registered_names(directory)
+    seen = set()
+    seen_names = set()
+    for spec in specs:
+        input_hash = digest_input(
+            spec.input, directory.input_hash_algorithm)
+        directory._check_can_add(
+            spec.cmd_args, input_hash, overwrite)
+        key = (input_hash, directory.arg_key(spec.cmd_args))
+        if key in seen:
+            raise ResponseAddException(
+                f"Command appears more than once in batch: '{spec.cmd_args}'")
+        seen.add(key)
+        # responses are recorded under their invocation name, so two responses
+        # sharing a name would overwrite each other's output
+        name = spec.invocation_name
+        if name in seen_names:
+            raise ResponseAddException(
+                f"Invocation name appears more than once in batch: '{name}'")
+        seen_names.add(name)
+        # overwriting a response may reuse its name
+        if name in registered_names and not (overwrite and registered_names[name] == key):
+            raise ResponseAddException(
+                f"Invocation name already used in response directory: '{name}'")
+
+
+class BatchRecorder:
+    """
+    Run many real commands concurrently and record their responses,
+    adding them all to a response directory with a single save
+    """
+
+    def __init__(self,
+                 directory: ResponseDirectory,
+                 max_workers: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 env: Optional[Dict[str, str]] = None,
+                 cwd=None):
+        """
+        Parameters
+        ----------
+        directory : ResponseDirectory
+            The response directory to add recorded responses to
+        max_workers : Optional[int], optional
+            Maximum number of commands to run at once. Defaults to ThreadPoolExecutor's default
+        timeout : Optional[float], optional
+            Seconds to let each command run before it's killed and recorded as a failure
+        env : Optional[Dict[str, str]], optional
+            Environment to run the commands in, defaults to this process's environment
+        cwd : Union[str, Path], optional
+            Working directory to run the commands in, defaults to this process's working directory
+        """
+        self._directory = directory
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._env = env
+        self._cwd = cwd
+
+    def record(self, specs: List[BatchRecordSpec], overwrite=False, save=True) -> List[CommandInvocation]:
+        """
+        Run and record a batch of commands
+
+        Every spec is checked against the directory (and the rest of the batch)
+        before anything is run, so a conflicting entry fails the batch up front
+
+        Returns
+        -------
+        List[CommandInvocation]
+            The recorded invocations, in the same order as specs
+
+        Raises
+        ------
+        ResponseAddException
+            If a spec's arguments are already registered (and overwrite is False)
+            or appear more than once in the batch
+        BatchRecordException
+            If any command couldn't be run or recorded. The rest are still added
+        """
+        _check_specs(self._directory, specs, overwrite)
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [executor.submit(self._run_and_record, spec)
+                       for spec in specs]
+
+        invocations = []
+        failures = {}
+        for spec, future in zip(specs, futures):
+            try:
+                invocation = future.result()
+            except Exception as e:
+                failures[spec.invocation_name] = e
+                continue
+            invocations.append(invocation)
+
+        # the directory dictionary is only touched from this thread
+        for invocation in invocations:
+            self._directory._register_invocation(invocation)
+        if save:
+            self._directory.save()
+
+        if failures:
+            raise BatchRecordException(
+                f"Failed to record {len(failures)} of {len(specs)} commands: {list(failures)}",
+                failures)
+        return invocations
+
+    def _run_and_record(self, spec: BatchRecordSpec) -> CommandInvocation:
+        if spec.record_timing or spec.record_interleaving:
+            return self._run_and_record_timed(spec)
+        # spool output to temporary files rather than memory,
+        # then stream it into the response directory
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            stdin = None
+            if spec.input is None:
+                stdin = subprocess.DEVNULL
+            proc = subprocess.run(spec.argv,
+                                  input=spec.input,
+                                  stdin=stdin,
+                                  stdout=stdout,
+                                  stderr=stderr,
+                                  timeout=self._timeout,
+                                  env=self._env,
+                                  cwd=self._cwd)
+            stdout.seek(0)
+            stderr.seek(0)
+            invocation = CommandInvocation(spec.cmd_args,
+                                           stdout,
+                                           stderr,
+                                           proc.returncode,
+                                           spec.invocation_name,
+                                           spec.changes_state,
+                                           input=spec.input,
+                                           input_hash_algorithm=self._directory.input_hash_algorithm)
+            self._directory._record_invocation(invocation)
+        return invocation
+
+    def _run_and_record_timed(self, spec: BatchRecordSpec) -> CommandInvocation:
+        # read output from the command's pipes as it's produced, so the time
+        # each chunk arrives can be recorded, and spool it to temporary files
+        # so nothing is written to the response directory unless the command finishes in time
+        stdin = subprocess.DEVNULL
+        if spec.input is not None:
+            stdin = subprocess.PIPE
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            start_ns = time.monotonic_ns()
+            timing = OutputTiming(start_ns=start_ns)
+            proc = subprocess.Popen(spec.argv,
+                                    stdin=stdin,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    env=self._env,
+                                    cwd=self._cwd)
+            timed_out = []
+            timer = None
+            if self._timeout is not None:
+                def _kill():
+                    timed_out.append(True)
+                    proc.kill()
+                timer = threading.Timer(self._timeout, _kill)
+                timer.start()
+            threads = [threading.Thread(target=self._drain,
+                                        args=(proc.stderr, stderr, STDERR_STREAM, timing))]
+            if spec.input is not None:
+                threads.append(threading.Thread(
+                    target=self._feed_input, args=(proc.stdin, spec.input)))
+            try:
+                for thread in threads:
+                    thread.start()
+                # drain both pipes at once, so the command can't block
+                # writing to one full pipe while we wait on the other
+                self._drain(proc.stdout, stdout, STDOUT_STREAM, timing)
+                for thread in threads:
+                    thread.join()
+                returncode = proc.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+                proc.stderr.close()
+            if timed_out:
+                raise subprocess.TimeoutExpired(spec.argv, self._timeout)
+            timing.finish()
+            if not spec.record_timing:
+                # only the order matters, so keep the event log small
+                timing.coalesce()
+            stdout.seek(0)
+            stderr.seek(0)
+            invocation = CommandInvocation(spec.cmd_args,
+                                           stdout,
+                                           stderr,
+                                           returncode,
+                                           spec.invocation_name,
+                                           spec.changes_state,
+                                           input=spec.input,
+                                           input_hash_algorithm=self._directory.input_hash_algorithm,
+                                           record_timing=spec.record_timing,
+                                           record_interleaving=spec.record_interleaving,
+                                           timing=timing)
+            self._directory._record_invocation(invocation)
+        return invocation
+
+    @staticmethod
+    def _drain(pipe: BinaryIO, spool: BinaryIO, stream: int, timing: OutputTiming):
+        for chunk in timing.timed_chunks(pipe, stream):
+            spool.write(chunk)
+
+    @staticmethod
+    def _feed_input(stdin, input: bytes):
+        try:
+            stdin.write(input)
+        except BrokenPipeError:
+            # the command exited without reading all of its input
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
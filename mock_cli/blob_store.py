@@ -0,0 +1,171 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict
+
+from .stream_io import CHUNK_SIZE, OutputSource, iter_chunks
+
+BLOB_HASH_ALGORITHM = "sha256"
+
+
+class BlobStoreException(Exception):
+    pass
+
+
+class BlobStore:
+    """
+    A content-addressed store of response output, where each distinct
+    payload is stored once, under the hex digest of its contents
+
+    Blobs are stored at <blob_dir>/<first two digest characters>/<remaining digest characters>
+    """
+
+    def __init__(self, blob_dir):
+        self._blob_dir = Path(blob_dir)
+
+    @property
+    def blob_dir(self) -> Path:
+        return self._blob_dir
+
+    def blob_path(self, digest: str) -> Path:
+        return blob_path(self._blob_dir, digest)
+
+    def __contains__(self, digest: str) -> bool:
+        return self.blob_path(digest).exists()
+
+    def add(self, source: OutputSource, chunk_size: int = CHUNK_SIZE) -> str:
+        """
+        Add output to the store, hashing it as it's written to disk
+
+        Parameters
+        ----------
+        source : OutputSource
+            Bytes, a readable binary file object, or an iterable of bytes chunks
+
+        Returns
+        -------
+        str
+            The hex digest identifying the blob
+        """
+        # only needed when recording
+        import hashlib
+
+        from .file_util import make_temp_file
+
+        self._blob_dir.mkdir(parents=True, exist_ok=True)
+        hasher = hashlib.new(BLOB_HASH_ALGORITHM)
+        fd, tmp_name = make_temp_file(self._blob_dir, ".blob-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter_chunks(source, chunk_size=chunk_size):
+                    hasher.update(chunk)
+                    f.write(chunk)
+            digest = hasher.hexdigest()
+            dest = self.blob_path(digest)
+            if dest.exists():
+                # we already have this one
+                os.unlink(tmp_name)
+            else:
+                dest.parent.mkdir(exist_ok=True)
+                os.replace(tmp_name, dest)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        return digest
+
+    def add_file(self, path) -> str:
+        with open(path, "rb") as f:
+            digest = self.add(f)
+        return digest
+
+
+def blob_path(blob_dir, digest: str) -> Path:
+    path = Path(blob_dir, digest[:2], digest[2:])
+    return path
+
+
+def migrate_to_blob_store(responsedir_json_file, blob_dir="blobs", remove_originals=False) -> Dict[str, int]:
+    """
+    Convert a response directory from per-invocation output files to a content-addressed blob store
+
+    Each response's output files are added to the blob store and the response
+    is updated to reference them. The response directory JSON file is then rewritten
+
+    Parameters
+    ----------
+    responsedir_json_file : Union[str, Path]
+        The response directory JSON file to migrate
+    blob_dir : Union[str, Path], optional
+        The blob store directory to record in the response directory, by default "blobs".
+        A relative path is relative to the working directory,
+        and is saved relative to the response directory JSON file, like "response_dir"
+    remove_originals : bool, optional
+        Delete the original per-invocation output files after migrating, by default False
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of responses migrated and distinct blobs stored
+    """
+    from .responses import CommandResponse, ResponseDirectory
+
+    directory = ResponseDirectory(responsedir_json_file)
+    existing_blob_dir = directory.blob_dir
+    if existing_blob_dir is not None and os.path.realpath(existing_blob_dir) != os.path.realpath(blob_dir):
+        raise BlobStoreException(
+            f"Response directory already uses blob store: {existing_blob_dir}")
+    store = BlobStore(blob_dir)
+    migrated = 0
+    digests = set()
+    originals = set()
+    for response_dict in directory.iter_response_dicts():
+        if "stdout_blob" in response_dict:
+            continue
+        response = CommandResponse(response_dict, directory.response_dir)
+        stdout_path = response._stdout_path()
+        stderr_path = response._stderr_path()
+        response_dict["stdout_blob"] = store.add_file(stdout_path)
+        response_dict["stderr_blob"] = store.add_file(stderr_path)
+        digests.update([response_dict["stdout_blob"],
+                       response_dict["stderr_blob"]])
+        originals.update([stdout_path, stderr_path])
+        migrated += 1
+
+    directory.set_blob_dir(blob_dir)
+    directory.save()
+
+    if remove_originals:
+        for path in originals:
+            path.unlink()
+            # remove the invocation's directory once it's empty
+            try:
+                path.parent.rmdir()
+            except OSError:
+                pass
+
+    stats = {"responses": migrated, "blobs": len(digests)}
+    return stats
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Migrate a response directory to a content-addressed blob store")
+    parser.add_argument("response_directory",
+                        help="Response directory JSON file to migrate")
+    parser.add_argument("--blob-dir", default="blobs",
+                        help="Blob store directory, default: blobs")
+    parser.add_argument("--remove-originals", action="store_true",
+                        help="Delete per-invocation output files after migrating")
+    parsed = parser.parse_args()
+    stats = migrate_to_blob_store(parsed.response_directory,
+                                  blob_dir=parsed.blob_dir,
+                                  remove_originals=parsed.remove_originals)
+    print(json.dumps(stats))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
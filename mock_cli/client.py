@@ -0,0 +1,83 @@
+import os
+import socket
+import sys
+from typing import Dict, List, Optional
+
+from .server_protocol import SOCKET_ENV_NAME, recv_message, send_request
+
+# set to "1" to have the client shim send its standard input to the server
+# same as playback.READ_STDIN_ENV_NAME, but not imported from there
+# to keep the client's import footprint small
+READ_STDIN_ENV_NAME = "MOCK_CLI_READ_STDIN"
+
+
+class MockCLIClientException(Exception):
+    pass
+
+
+def run_client(args: List[str],
+               input: Optional[bytes] = None,
+               socket_path: Optional[str] = None,
+               env: Optional[Dict[str, str]] = None) -> int:
+    """
+    Ask a running mock command server to respond to the provided arguments.
+    The server writes responses directly to this process's stdout & stderr
+
+    Parameters
+    ----------
+    args : List[str]
+        Command-line arguments, not including the program name
+    input : Optional[bytes], optional
+        Standard input to look up the response by, if any
+    socket_path : Optional[str], optional
+        Path to the server's Unix socket. Defaults to $MOCK_CLI_SERVER_SOCKET
+    env : Optional[Dict[str, str]], optional
+        Environment to run the mock command in. Defaults to os.environ
+
+    Returns
+    -------
+    int
+        The mock command's exit status
+    """
+    if socket_path is None:
+        socket_path = os.environ.get(SOCKET_ENV_NAME)
+    if not socket_path:
+        raise MockCLIClientException("No server socket path provided")
+    if env is None:
+        env = dict(os.environ)
+
+    input_len = -1
+    if input is not None:
+        input_len = len(input)
+    request = {
+        "args": list(args),
+        "env": env,
+        "cwd": os.getcwd(),
+        "input_len": input_len
+    }
+
+    # make sure anything we've written lands before the server's output
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        send_request(sock, request, [sys.stdout.fileno(), sys.stderr.fileno()])
+        if input is not None:
+            sock.sendall(input)
+        reply = recv_message(sock)
+
+    if "error" in reply:
+        sys.stderr.write(reply["error"])
+        return 1
+    return reply["exit_status"]
+
+
+def main():
+    input = None
+    if os.environ.get(READ_STDIN_ENV_NAME) == "1":
+        input = sys.stdin.buffer.read()
+    return run_client(sys.argv[1:], input=input)
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,179 @@
+import io
+from itertools import chain
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+
+from .stream_io import CHUNK_SIZE, OutputSource, iter_chunks
+
+CODEC_GZIP = "gzip"
+CODEC_LZMA = "lzma"
+CODEC_ZSTD = "zstd"
+# pick the best codec available at record time
+CODEC_AUTO = "auto"
+
+# outputs smaller than this aren't worth compressing
+DEFAULT_COMPRESSION_THRESHOLD = 64 * 1024
+
+
+class CompressionCodecException(Exception):
+    pass
+
+
+# codec modules are imported only when needed
+# so playing back uncompressed responses doesn't pay for them
+
+def _zstd_module():
+    try:
+        # python >= 3.14
+        from compression import zstd
+    except ImportError:
+        try:
+            import zstandard as zstd
+        except ImportError:
+            zstd = None
+    return zstd
+
+
+def available_codecs():
+    codecs = [CODEC_GZIP, CODEC_LZMA]
+    if _zstd_module() is not None:
+        codecs.insert(0, CODEC_ZSTD)
+    return codecs
+
+
+def resolve_codec(codec: str) -> str:
+    """
+    Resolve "auto" to the best available codec, and ensure the codec is available
+    """
+    available = available_codecs()
+    if codec == CODEC_AUTO:
+        codec = available[0]
+    if codec not in available:
+        raise CompressionCodecException(
+            f"Compression codec not available: {codec}")
+    return codec
+
+
+def _compressor(codec: str):
+    if codec == CODEC_GZIP:
+        import zlib
+
+        # wbits=31 produces gzip framing, with no timestamp in the header,
+        # so identical output always compresses to identical bytes
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    elif codec == CODEC_LZMA:
+        import lzma
+
+        compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    elif codec == CODEC_ZSTD:
+        zstd = _zstd_module()
+        if hasattr(zstd, "ZstdCompressor") and hasattr(zstd.ZstdCompressor(), "compressobj"):
+            # the zstandard package
+            compressor = zstd.ZstdCompressor().compressobj()
+        else:
+            compressor = zstd.ZstdCompressor()
+    else:
+        raise CompressionCodecException(f"Unknown compression codec: {codec}")
+    return compressor
+
+
+def compress_chunks(chunks: Iterable[bytes], codec: str) -> Iterator[bytes]:
+    compressor = _compressor(codec)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def maybe_compress(source: OutputSource,
+                   codec: str,
+                   threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+                   chunk_size: int = CHUNK_SIZE) -> Tuple[Optional[str], Iterable[bytes]]:
+    """
+    Compress an output source if it's at least threshold bytes long
+
+    At most threshold bytes (plus one chunk) are buffered to make the decision,
+    so this works on streams of any size
+
+    Returns
+    -------
+    Tuple[Optional[str], Iterable[bytes]]
+        The codec used, or None if the output wasn't compressed,
+        and the possibly compressed output as an iterable of chunks
+    """
+    codec = resolve_codec(codec)
+    chunks = iter_chunks(source, chunk_size=chunk_size)
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        head_size += len(chunk)
+        if head_size >= threshold:
+            break
+    else:
+        # we ran out of output before reaching the threshold
+        return None, head
+    compressed = compress_chunks(chain(head, chunks), codec)
+    return codec, compressed
+
+
+def open_decompressed(path, codec: Optional[str]) -> BinaryIO:
+    """
+    Open a possibly compressed file for reading, decompressing it as a stream
+
+    path may also be a readable binary file object, which is closed along with the returned stream
+    """
+    if hasattr(path, "read"):
+        if not codec:
+            return path
+        return io.BufferedReader(_OwningReader(_open_decompressed(path, codec), path))
+    if not codec:
+        return open(path, "rb")
+    return _open_decompressed(path, codec)
+
+
+def _open_decompressed(path, codec: str) -> BinaryIO:
+    if codec == CODEC_GZIP:
+        import gzip
+
+        return gzip.open(path, "rb")
+    if codec == CODEC_LZMA:
+        import lzma
+
+        return lzma.open(path, "rb")
+    if codec == CODEC_ZSTD:
+        zstd = _zstd_module()
+        if zstd is None:
+            raise CompressionCodecException(
+                "Response is zstd-compressed, but no zstd module is available")
+        if hasattr(zstd, "ZstdDecompressor") and hasattr(zstd.ZstdDecompressor(), "stream_reader"):
+            # the zstandard package
+            if hasattr(path, "read"):
+                return zstd.ZstdDecompressor().stream_reader(path, closefd=True)
+            return zstd.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return zstd.open(path, "rb")
+    raise CompressionCodecException(f"Unknown compression codec: {codec}")
+
+
+class _OwningReader(io.RawIOBase):
+    # decompressors don't close file objects they were handed, so close it for them
+    def __init__(self, stream: BinaryIO, owned: BinaryIO):
+        super().__init__()
+        self._stream = stream
+        self._owned = owned
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._stream.close()
+            finally:
+                self._owned.close()
+        super().close()
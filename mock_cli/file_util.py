@@ -0,0 +1,132 @@
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def make_temp_file(dir, prefix, like=None):
+    """
+    Create a temporary file like tempfile.mkstemp(), but with the permissions
+    a file created with open() would get, rather than mkstemp()'s 0600,
+    since it's going to be renamed into place
+
+    If like is given and exists, its permissions are copied instead
+
+    Returns
+    -------
+    Tuple[int, str]
+        The open file descriptor and the file's name
+    """
+    # only needed when writing
+    import tempfile
+
+    fd, tmp_name = tempfile.mkstemp(dir=dir, prefix=prefix)
+    try:
+        mode = None
+        if like is not None:
+            try:
+                mode = os.stat(like).st_mode & 0o7777
+            except FileNotFoundError:
+                pass
+        if mode is None:
+            # the umask can only be read by setting it
+            umask = os.umask(0o022)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, mode)
+        else:
+            os.chmod(tmp_name, mode)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_name)
+        raise
+    return fd, tmp_name
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Create an empty temporary file next to path, and rename it over path
+    once the with block exits, for writers that need a file name rather than a file object
+
+    If an exception is raised, the temporary file is removed and path is left untouched
+    """
+    path = Path(path)
+    fd, tmp_name = make_temp_file(path.parent, f".{path.name}.", like=path)
+    os.close(fd)
+    try:
+        yield tmp_name
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+@contextmanager
+def atomic_open(path, mode="w"):
+    """
+    Open a temporary file next to path for writing, and rename it over path
+    once it has been written and synced to disk
+
+    Readers see either the old file or the new one, never a partially written file.
+    If an exception is raised while writing, path is left untouched
+    """
+    with atomic_path(path) as tmp_name:
+        with open(tmp_name, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def atomic_write_json(path, obj, indent=2):
+    with atomic_open(path, "w") as f:
+        json.dump(obj, f, indent=indent)
+
+
+def lock_path_for(path) -> str:
+    """
+    The lock file to lock path with, e.g., a state config that's replaced atomically
+    and so can't be locked itself
+
+    Lock files are kept in a per-user directory under the temporary directory rather than
+    next to path, so they don't clutter fixture trees that are checked in. Since that's
+    local to this machine, processes on different machines sharing path don't lock each other out
+    """
+    # only needed when taking a lock
+    import tempfile
+    import zlib
+
+    real_path = os.path.realpath(path)
+    lock_dir = "mock-cli-locks"
+    if hasattr(os, "getuid"):
+        lock_dir = f"{lock_dir}-{os.getuid()}"
+    lock_dir = os.path.join(tempfile.gettempdir(), lock_dir)
+    os.makedirs(lock_dir, mode=0o700, exist_ok=True)
+    # a collision only means two paths share a lock
+    path_hash = zlib.crc32(os.fsencode(real_path))
+    lock_path = os.path.join(
+        lock_dir, f"{os.path.basename(real_path)}-{path_hash:08x}.lock")
+    return lock_path
+
+
+@contextmanager
+def locked(lock_path):
+    """
+    Hold an exclusive lock on lock_path (created if necessary) across processes
+
+    On platforms without fcntl, no lock is taken
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    with open(lock_path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -1,13 +1,70 @@
-import hashlib
-from typing import Optional, Union
+from typing import Optional
 
+from .stream_io import OutputSource, iter_chunks
 
-def digest_input(input: Optional[Union[str, bytes]]) -> Optional[str]:
+HASH_MD5 = "md5"
+HASH_BLAKE2B = "blake2b"
+# xxh3_128, if the xxhash package is installed
+HASH_XXHASH = "xxhash"
+
+DEFAULT_INPUT_HASH_ALGORITHM = HASH_MD5
+
+
+class InputHashException(Exception):
+    pass
+
+
+def new_input_hasher(algorithm: str = DEFAULT_INPUT_HASH_ALGORITHM):
+    if algorithm == HASH_XXHASH:
+        try:
+            import xxhash
+        except ImportError as e:
+            raise InputHashException(
+                "xxhash input hashing requires the xxhash package") from e
+        hasher = xxhash.xxh3_128()
+    elif algorithm in (HASH_MD5, HASH_BLAKE2B):
+        # hashlib is comparatively slow to import, and most invocations have no input
+        import hashlib
+
+        if algorithm == HASH_BLAKE2B:
+            # 128 bits, the same length as md5, to keep input directory names short
+            hasher = hashlib.blake2b(digest_size=16)
+        else:
+            hasher = hashlib.md5()
+    else:
+        raise InputHashException(
+            f"Unknown input hash algorithm: {algorithm}")
+    return hasher
+
+
+def digest_input(input: Optional[OutputSource],
+                 algorithm: str = DEFAULT_INPUT_HASH_ALGORITHM) -> Optional[str]:
+    """
+    Hash input as a series of chunks, so it never has to be held in memory all at once
+
+    Parameters
+    ----------
+    input : Optional[OutputSource]
+        Bytes, a string, a readable binary file object (e.g., sys.stdin.buffer),
+        or an iterable of bytes chunks. File objects are read to the end
+    algorithm : str, optional
+        Hash algorithm, by default DEFAULT_INPUT_HASH_ALGORITHM
+
+    Returns
+    -------
+    Optional[str]
+        The input's hex digest, or None if input is None or empty
+    """
     digest = None
     # ignore input if None or if empty string
-    if input:
-        if isinstance(input, str):
-            input = input.encode()
-        hash = hashlib.md5(input)
-        digest = hash.hexdigest()
+    if input is None:
+        return digest
+
+    hasher = None
+    for chunk in iter_chunks(input):
+        if hasher is None:
+            hasher = new_input_hasher(algorithm)
+        hasher.update(chunk)
+    if hasher is not None:
+        digest = hasher.hexdigest()
     return digest
@@ -0,0 +1,99 @@
+import argparse
+import subprocess
+import sys
+from typing import Dict, List
+
+# Modules the playback path must not import. Each of these is only needed
+# for recording, error reporting, or other less common operations,
+# and should be imported lazily where it's used
+FORBIDDEN_MODULES = [
+    "argparse",
+    "hashlib",
+    "importlib.resources",
+    "shlex",
+    "socket",
+    "subprocess",
+    "tempfile",
+]
+
+# Maximum number of modules importing the playback path may add
+# beyond what a bare interpreter imports at startup, as measured on CPython 3.11.
+# If this needs to go up, make sure it's for a good reason,
+# and if it can come down, lower it so the next regression is caught
+MAX_NEW_MODULES = 49
+
+PLAYBACK_MODULE = "mock_cli.playback"
+
+
+def measure_imports(statement: str) -> Dict[str, int]:
+    """
+    Run a statement in a fresh interpreter with -X importtime
+
+    Returns
+    -------
+    Dict[str, int]
+        Each imported module's name mapped to its cumulative import time in microseconds
+    """
+    argv = [sys.executable, "-X", "importtime", "-c", statement]
+    proc = subprocess.run(argv, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, check=True, text=True)
+    imports = {}
+    for line in proc.stderr.splitlines():
+        # import time: <self us> | <cumulative us> | <module name>
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = [field.strip() for field in line.split("|")]
+        # skip the header line
+        if not cumulative.isdigit():
+            continue
+        imports[name] = int(cumulative)
+    return imports
+
+
+def check_import_budget(module_name: str = PLAYBACK_MODULE) -> List[str]:
+    """
+    Check that importing a module stays within the import budget
+
+    Returns
+    -------
+    List[str]
+        A list of budget violations, empty if there were none
+    """
+    baseline = measure_imports("pass")
+    imports = measure_imports(f"import {module_name}")
+    new_modules = [name for name in imports if name not in baseline]
+    problems = []
+    for forbidden in FORBIDDEN_MODULES:
+        if forbidden in new_modules:
+            problems.append(f"{module_name} imports {forbidden}")
+    if len(new_modules) > MAX_NEW_MODULES:
+        problems.append(
+            f"{module_name} imports {len(new_modules)} modules, budget is {MAX_NEW_MODULES}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that mock_cli's playback path stays within its import budget")
+    parser.add_argument("--module", default=PLAYBACK_MODULE,
+                        help=f"Module to check, default: {PLAYBACK_MODULE}")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="Print the cumulative import time of each module imported")
+    parsed = parser.parse_args()
+
+    if parsed.verbose:
+        imports = measure_imports(f"import {parsed.module}")
+        for name, cumulative in sorted(imports.items(), key=lambda item: item[1]):
+            print(f"{cumulative:>10} us  {name}")
+
+    problems = check_import_budget(parsed.module)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        return 1
+    print(f"{parsed.module} is within its import budget")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,377 @@
+import io
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+
+from .mock_cmd import MockCommand
+from .mock_cmd_state import STATE_DIR_ENV_NAME
+from .playback import RESPONSE_DIR_ENV_NAME
+from .response_cache import ResponseCache
+from .responses import ResponseLookupException
+from .stream_io import copy_to_fd
+
+
+class _MockExecutable(dict):
+    def __init__(self, executable: str, response_directory=None, state_dir=None):
+        _dict = {
+            "executable": executable,
+            "response_directory": response_directory,
+            "state_dir": state_dir
+        }
+        super().__init__(_dict)
+
+    @property
+    def executable(self) -> str:
+        return self["executable"]
+
+    @property
+    def response_directory(self):
+        return self["response_directory"]
+
+    @property
+    def state_dir(self):
+        return self["state_dir"]
+
+
+class _StdinPipe(io.BytesIO):
+    # keep what was written after the pipe is closed, the way a child process would
+    def close(self):
+        if not self.closed:
+            self.data = self.getvalue()
+        super().close()
+
+
+class MockPopen:
+    """
+    A stand-in for subprocess.Popen that plays back a recorded response in-process
+
+    The response is looked up the first time the "process" is waited on, communicated with,
+    or its output is read, so anything written to its standard input beforehand is used
+    to look up commands_with_input. Output sent to pipes is read from the recorded
+    response on disk. Other destinations (inherited file descriptors, files) are written to directly
+    """
+
+    def __init__(self, interceptor: "SubprocessInterceptor", mock_executable: _MockExecutable,
+                 argv: List[str], popen_args: Dict):
+        self._interceptor = interceptor
+        self._mock_executable = mock_executable
+        self.args = popen_args["args"]
+        self._argv = argv
+        # there's no real process to signal
+        self.pid = None
+        self.returncode = None
+        self._env = popen_args.get("env")
+        self._stdin_arg = popen_args.get("stdin")
+        self._stdout_arg = popen_args.get("stdout")
+        self._stderr_arg = popen_args.get("stderr")
+        self.text_mode = bool(popen_args.get("text") or popen_args.get("universal_newlines")
+                              or popen_args.get("encoding") or popen_args.get("errors"))
+        self._encoding = popen_args.get("encoding")
+        self._errors = popen_args.get("errors")
+        self._stdout = None
+        self._stderr = None
+        self._resolved = False
+
+        self.stdin = None
+        self._stdin_pipe = None
+        if self._stdin_arg == subprocess.PIPE:
+            self._stdin_pipe = _StdinPipe()
+            self.stdin = self._stdin_pipe
+            if self.text_mode:
+                self.stdin = self._text_wrapper(self._stdin_pipe)
+
+    @property
+    def stdout(self):
+        if self._stdout_arg == subprocess.PIPE:
+            self._resolve()
+        return self._stdout
+
+    @property
+    def stderr(self):
+        if self._stderr_arg == subprocess.PIPE:
+            self._resolve()
+        return self._stderr
+
+    def poll(self) -> int:
+        self._resolve()
+        return self.returncode
+
+    def wait(self, timeout=None) -> int:
+        self._resolve()
+        return self.returncode
+
+    def communicate(self, input=None, timeout=None):
+        if input is not None and self.stdin is not None:
+            self.stdin.write(input)
+        self._resolve()
+        stdout = None
+        stderr = None
+        if self._stdout is not None:
+            with self._stdout:
+                stdout = self._stdout.read()
+        if self._stderr is not None:
+            with self._stderr:
+                stderr = self._stderr.read()
+        return stdout, stderr
+
+    def send_signal(self, sig):
+        # the response has already been (or will be) played back in full
+        pass
+
+    def terminate(self):
+        pass
+
+    def kill(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for stream in (self._stdout, self._stderr, self.stdin):
+            if stream is not None:
+                stream.close()
+        self.wait()
+
+    def _text_wrapper(self, stream: BinaryIO):
+        if self._encoding is None:
+            import locale
+
+            encoding = locale.getpreferredencoding(False)
+        else:
+            encoding = self._encoding
+        wrapper = io.TextIOWrapper(
+            stream, encoding=encoding, errors=self._errors)
+        return wrapper
+
+    def _input(self):
+        stdin = self._stdin_arg
+        if self._stdin_pipe is not None:
+            if self.stdin is not self._stdin_pipe and not self.stdin.closed:
+                self.stdin.flush()
+            if self._stdin_pipe.closed:
+                input = self._stdin_pipe.data
+            else:
+                input = self._stdin_pipe.getvalue()
+        elif stdin is None or stdin == subprocess.DEVNULL:
+            # an inherited stdin isn't read, same as the playback entry point's default
+            input = None
+        elif isinstance(stdin, int):
+            input = os.fdopen(stdin, "rb", closefd=False)
+        else:
+            input = stdin
+        return input
+
+    def _resolve(self):
+        if self._resolved:
+            return
+        self._resolved = True
+        try:
+            response = self._interceptor._lookup(
+                self._mock_executable, self._argv[1:], self._input(), self._env)
+        except ResponseLookupException as e:
+            # fail the way a mock command process would
+            self._fail(f"{type(e).__name__}: {e}\n".encode())
+            return
+        self.returncode = response.return_code
+
+        if self._stderr_arg == subprocess.STDOUT:
+            # merged the way they were recorded, or stdout first if the order wasn't recorded
+            merged = response.open_interleaved_output()
+            self._stdout = self._route(merged, self._stdout_arg, 1)
+            return
+
+        stdout = response.open_output()
+        stderr = response.open_error_output()
+        pipes = (self._stdout_arg, self._stderr_arg)
+        if subprocess.PIPE not in pipes and "timing" in response:
+            self._replay(response, stdout, stderr)
+            return
+        self._stdout = self._route(stdout, self._stdout_arg, 1)
+        self._stderr = self._route(stderr, self._stderr_arg, 2)
+
+    def _fail(self, message: bytes):
+        self.returncode = 1
+        if self._stderr_arg == subprocess.STDOUT:
+            self._stdout = self._route(io.BytesIO(message), self._stdout_arg, 1)
+            return
+        self._stdout = self._route(io.BytesIO(), self._stdout_arg, 1)
+        self._stderr = self._route(io.BytesIO(message), self._stderr_arg, 2)
+
+    def _replay(self, response, stdout: BinaryIO, stderr: BinaryIO):
+        # both go straight to file descriptors, so write them in their recorded order
+        from .timing import STDERR_STREAM, STDOUT_STREAM
+
+        timing = response.read_timing()
+        with stdout, stderr:
+            stdout_fd, close_stdout = self._dest_fd(self._stdout_arg, 1)
+            try:
+                stderr_fd, close_stderr = self._dest_fd(self._stderr_arg, 2)
+                try:
+                    streams = {
+                        STDOUT_STREAM: (stdout, stdout_fd),
+                        STDERR_STREAM: (stderr, stderr_fd)
+                    }
+                    timing.replay(streams, scale=0)
+                finally:
+                    if close_stderr:
+                        os.close(stderr_fd)
+            finally:
+                if close_stdout:
+                    os.close(stdout_fd)
+
+    def _dest_fd(self, dest, default_fd: int):
+        # the file descriptor to write to, and whether we opened it
+        if dest == subprocess.DEVNULL:
+            return os.open(os.devnull, os.O_WRONLY), True
+        if dest is None:
+            # inherited, like a child process writing to our file descriptor
+            handle = sys.stdout if default_fd == 1 else sys.stderr
+            try:
+                handle.flush()
+            except (AttributeError, ValueError):
+                pass
+            return default_fd, False
+        if isinstance(dest, int):
+            return dest, False
+        dest.flush()
+        return dest.fileno(), False
+
+    def _route(self, stream: BinaryIO, dest, default_fd: int):
+        if dest == subprocess.PIPE:
+            if self.text_mode:
+                stream = self._text_wrapper(stream)
+            return stream
+        with stream:
+            if dest != subprocess.DEVNULL:
+                out_fd, _ = self._dest_fd(dest, default_fd)
+                copy_to_fd(stream, out_fd)
+        return None
+
+
+class SubprocessInterceptor:
+    """
+    Serve responses for selected executables in-process, without forking a mock command
+
+    While installed, subprocess.Popen (and so subprocess.run(), check_output(), etc.)
+    is replaced with a wrapper that plays back responses for registered executables
+    and runs everything else normally. Code that imported Popen directly
+    (from subprocess import Popen) before installation isn't affected.
+
+    Each call is handled by a fresh MockCommand, exactly as a mock command process would:
+    state iterations are honored, input is used to look up commands_with_input,
+    settings are read from the call's environment (env= or os.environ),
+    and a command with no recorded response exits with status 1 and the error on stderr.
+    The environment changes a state iteration makes are made to a copy of the
+    call's environment, so os.environ isn't touched and calls can be made from any thread.
+    Parsed response directories are kept in a ResponseCache between calls
+    """
+
+    def __init__(self, cache: Optional[ResponseCache] = None, use_index: bool = False):
+        if cache is None:
+            cache = ResponseCache()
+        self._cache = cache
+        self._use_index = use_index
+        self._mocks: Dict[str, _MockExecutable] = {}
+        self._original_popen = None
+
+    @property
+    def cache(self) -> ResponseCache:
+        return self._cache
+
+    def add_mock(self, executable: str, response_directory=None, state_dir=None):
+        """
+        Register an executable to be mocked
+
+        Parameters
+        ----------
+        executable : str
+            The executable's name (matched against the basename of argv[0]) or full path
+        response_directory : Union[str, Path], optional
+            Response directory JSON file to play back from
+        state_dir : Union[str, Path], optional
+            Mock command state directory to play back from.
+            If neither is provided, they are taken from the $MOCK_CLI_RESPONSE_DIRECTORY and
+            $MOCK_CMD_STATE_DIR variables in the environment the command is run with
+        """
+        self._mocks[str(executable)] = _MockExecutable(
+            str(executable), response_directory=response_directory, state_dir=state_dir)
+
+    def install(self):
+        if self._original_popen is not None:
+            return
+        import inspect
+
+        original_popen = subprocess.Popen
+        signature = inspect.signature(original_popen.__init__)
+        interceptor = self
+
+        class _InterceptingPopen(original_popen):
+            def __new__(cls, *args, **kwargs):
+                popen_args = signature.bind(None, *args, **kwargs).arguments
+                mock_popen = interceptor._mock_popen(popen_args)
+                if mock_popen is not None:
+                    # not an instance of cls, so __init__() isn't called
+                    return mock_popen
+                return super().__new__(cls)
+
+        self._original_popen = original_popen
+        subprocess.Popen = _InterceptingPopen
+
+    def uninstall(self):
+        if self._original_popen is None:
+            return
+        subprocess.Popen = self._original_popen
+        self._original_popen = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+
+    def _mock_popen(self, popen_args: Dict) -> Optional[MockPopen]:
+        args = popen_args["args"]
+        if isinstance(args, (str, bytes, Path)):
+            if popen_args.get("shell"):
+                import shlex
+
+                argv = shlex.split(os.fsdecode(args))
+            else:
+                argv = [args]
+        else:
+            argv = list(args)
+        argv = [os.fsdecode(arg) for arg in argv]
+        if not argv:
+            return None
+        executable = popen_args.get("executable") or argv[0]
+        executable = os.fsdecode(executable)
+        mock_executable = self._mocks.get(executable)
+        if mock_executable is None:
+            mock_executable = self._mocks.get(os.path.basename(executable))
+        if mock_executable is None:
+            return None
+        return MockPopen(self, mock_executable, argv, popen_args)
+
+    def _lookup(self, mock_executable: _MockExecutable, args: List[str], input, env: Optional[Dict]):
+        if env is None:
+            env = os.environ
+        # the "child" environment, which the state iteration's changes are made to
+        env = {os.fsdecode(var): os.fsdecode(val) for var, val in env.items()}
+        response_directory = mock_executable.response_directory
+        state_dir = mock_executable.state_dir
+        if response_directory is None and state_dir is None:
+            response_directory = env.get(RESPONSE_DIR_ENV_NAME)
+            state_dir = env.get(STATE_DIR_ENV_NAME)
+        with MockCommand(response_directory=response_directory,
+                         state_dir=state_dir,
+                         use_index=self._use_index,
+                         cache=self._cache,
+                         environ=env) as cmd:
+            response = cmd.get_response(args, input=input)
+            if response.changes_state:
+                cmd._iterate_state()
+        return response
@@ -0,0 +1,120 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .arg_patterns import ArgPattern, add_pattern_entry, pattern_entry
+
+# Responses added to a response directory can be appended to a journal
+# rather than rewriting the whole directory JSON file on every save
+# Each line of the journal is a JSON object:
+#   {"input_hash": <input hash or null>, "args": <argument string>, "response": <response dict>}
+# or, for responses registered under an argument pattern:
+#   {"input_hash": <input hash or null>, "arg_pattern": <argument pattern>, "response": <response dict>}
+# Later entries take precedence over earlier ones and over the directory JSON file
+
+JOURNAL_SUFFIX = ".journal"
+
+
+def journal_path_for(responsedir_json_file) -> Path:
+    responsedir_json_file = Path(responsedir_json_file)
+    journal_path = responsedir_json_file.with_name(
+        responsedir_json_file.name + JOURNAL_SUFFIX)
+    return journal_path
+
+
+def directory_file_state(responsedir_json_file) -> Tuple[int, int, int, int]:
+    """
+    Modification time & size of a response directory JSON file and its journal.
+    If these haven't changed, neither has the directory's content
+    """
+    source_stat = os.stat(responsedir_json_file)
+    try:
+        # the same as journal_path_for(), without the overhead of pathlib
+        journal_stat = os.stat(os.fspath(responsedir_json_file) + JOURNAL_SUFFIX)
+        journal_state = (journal_stat.st_mtime_ns, journal_stat.st_size)
+    except FileNotFoundError:
+        journal_state = (0, -1)
+    state = (source_stat.st_mtime_ns, source_stat.st_size) + journal_state
+    return state
+
+
+def journal_entry(input_hash: Optional[str], arg_string: str, response_dict: Dict) -> Dict:
+    entry = {
+        "input_hash": input_hash,
+        "args": arg_string,
+        "response": response_dict
+    }
+    return entry
+
+
+def pattern_journal_entry(input_hash: Optional[str], arg_pattern: ArgPattern, response_dict: Dict) -> Dict:
+    entry = {
+        "input_hash": input_hash,
+        "arg_pattern": arg_pattern,
+        "response": response_dict
+    }
+    return entry
+
+
+def append_entries(journal_path, entries: List[Dict]):
+    """
+    Append entries to a journal, and sync them to disk before returning
+    """
+    if not entries:
+        return
+    data = "".join(json.dumps(entry) + "\n" for entry in entries).encode()
+    with open(journal_path, "ab+") as f:
+        # if a previous append was interrupted mid-line, start on a fresh line
+        # so the partial entry doesn't corrupt this one
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_entries(journal_path) -> Iterator[Dict]:
+    try:
+        f = open(journal_path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a partial line left by an interrupted append
+                # it was never completely written, so it was never successfully saved
+                continue
+            yield entry
+
+
+def apply_entries(directory: Dict, entries) -> int:
+    """
+    Merge journal entries into a loaded response directory dictionary
+
+    Returns
+    -------
+    int
+        The number of entries applied
+    """
+    applied = 0
+    for entry in entries:
+        input_hash = entry["input_hash"]
+        if "arg_pattern" in entry:
+            patterns = directory.setdefault("command_patterns", [])
+            add_pattern_entry(patterns, pattern_entry(
+                input_hash, entry["arg_pattern"], entry["response"]))
+            applied += 1
+            continue
+        if input_hash:
+            commands = directory.setdefault("commands_with_input", {})
+            commands = commands.setdefault(input_hash, {})
+        else:
+            commands = directory.setdefault("commands", {})
+        commands[entry["args"]] = entry["response"]
+        applied += 1
+    return applied
@@ -0,0 +1,438 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from .blob_store import BLOB_HASH_ALGORITHM
+from .hashing import digest_input
+from .responses import CommandResponse, ResponseDirectory
+
+INPUT_FILE_NAME = "input.bin"
+# refuse to delete anything if more than this fraction of referenced output files is missing,
+# which is more likely to be a misplaced response directory than data loss
+MISSING_LIMIT = 0.5
+
+
+class MaintenanceException(Exception):
+    pass
+
+
+class MaintenanceReport(dict):
+    """
+    What response directory maintenance found, and what it reclaimed
+    """
+
+    def __init__(self):
+        _dict = {
+            "responses": 0,
+            "missing": [],
+            "corrupt": [],
+            "dropped": 0,
+            "unreferenced": [],
+            "reclaimed_bytes": 0,
+            "reclaimed_inodes": 0
+        }
+        super().__init__(_dict)
+
+    @property
+    def missing(self) -> List[str]:
+        """
+        Referenced files that don't exist
+        """
+        return self["missing"]
+
+    @property
+    def corrupt(self) -> List[str]:
+        """
+        Blobs and inputs whose content doesn't match the digest they're stored under
+        """
+        return self["corrupt"]
+
+    @property
+    def unreferenced(self) -> List[str]:
+        """
+        Files and directories no response refers to
+        """
+        return self["unreferenced"]
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return self["reclaimed_bytes"]
+
+    @property
+    def reclaimed_inodes(self) -> int:
+        return self["reclaimed_inodes"]
+
+
+def _real(path) -> str:
+    return os.path.realpath(os.fspath(path))
+
+
+class _Reference:
+    # a file responses need, and how to check its content
+    __slots__ = ("path", "digest", "algorithm", "owners")
+
+    def __init__(self, path: str, digest: Optional[str] = None, algorithm: Optional[str] = None):
+        self.path = path
+        self.digest = digest
+        self.algorithm = algorithm
+        # (directory, location) of each response relying on this file
+        self.owners = []
+
+
+def _check_reference(reference: _Reference) -> Optional[str]:
+    """
+    Returns "missing", "corrupt", or None if the file is fine
+    """
+    if reference.digest is None:
+        return None if os.path.isfile(reference.path) else "missing"
+    try:
+        f = open(reference.path, "rb")
+    except FileNotFoundError:
+        return "missing"
+    with f:
+        if reference.algorithm == BLOB_HASH_ALGORITHM:
+            import hashlib
+
+            hasher = hashlib.new(BLOB_HASH_ALGORITHM)
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+            digest = hasher.hexdigest()
+        else:
+            digest = digest_input(f, reference.algorithm)
+    return None if digest == reference.digest else "corrupt"
+
+
+def _iter_locations(directory: ResponseDirectory):
+    # every response, along with where it's registered, so it can be dropped
+    for arg_string, response_dict in directory.commands.items():
+        yield ("commands", None, arg_string), None, response_dict
+    commands_with_input = directory._response_directory.get(
+        "commands_with_input", {})
+    for input_hash, commands in commands_with_input.items():
+        for arg_string, response_dict in commands.items():
+            yield ("commands_with_input", input_hash, arg_string), input_hash, response_dict
+    for num, entry in enumerate(directory._response_directory.get("command_patterns", [])):
+        yield ("command_patterns", None, num), entry.get("input_hash"), entry["response"]
+
+
+def _response_files(directory: ResponseDirectory, response_dict: Dict) -> List[Tuple[str, Optional[str]]]:
+    # each file the response reads, and the digest its content should have, if it's a blob
+    response = CommandResponse(
+        response_dict, directory.response_dir, blob_dir=directory.blob_dir)
+    files = []
+    for blob_key, get_path in [("stdout_blob", response._stdout_path),
+                               ("stderr_blob", response._stderr_path)]:
+        files.append((_real(get_path()), response_dict.get(blob_key)))
+    if "timing" in response_dict:
+        files.append((_real(response._timing_path()),
+                     response_dict.get("timing_blob")))
+    return files
+
+
+def _tree_size(path: str) -> Tuple[int, int]:
+    # bytes and inodes in a file or directory tree, without following symlinks
+    st = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return st.st_size, 1
+    size = 0
+    inodes = 1
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            size += st.st_size
+            inodes += 1
+    return size, inodes
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        import shutil
+
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _scan_response_dir(root: str, referenced: Set[str], keep: Set[str]) -> List[str]:
+    unreferenced = []
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return unreferenced
+    for entry in entries:
+        # only per-invocation directories are ours; leave anything else alone
+        if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+            continue
+        path = _real(entry.path)
+        if path in keep:
+            continue
+        entries = list(os.scandir(path))
+        if any(f.is_dir(follow_symlinks=False) for f in entries):
+            # per-invocation directories are flat, so this is something else
+            continue
+        files = [_real(f.path) for f in entries]
+        if not any(f in referenced for f in files):
+            unreferenced.append(path)
+            continue
+        unreferenced.extend(f for f in files if f not in referenced)
+    return unreferenced
+
+
+def _scan_blob_dir(root: str, referenced: Set[str], keep: Set[str]) -> List[str]:
+    unreferenced = []
+    try:
+        prefixes = list(os.scandir(root))
+    except FileNotFoundError:
+        return unreferenced
+    for prefix in prefixes:
+        # hidden files are blobs being written right now
+        if prefix.name.startswith(".") or not prefix.is_dir(follow_symlinks=False):
+            continue
+        if _real(prefix.path) in keep:
+            continue
+        blobs = [_real(blob.path) for blob in os.scandir(prefix.path)
+                 if not blob.name.startswith(".")]
+        if not any(blob in referenced for blob in blobs):
+            unreferenced.append(_real(prefix.path))
+            continue
+        unreferenced.extend(blob for blob in blobs if blob not in referenced)
+    return unreferenced
+
+
+def _scan_input_dir(root: str, referenced_input_dirs: Set[str], keep: Set[str]) -> List[str]:
+    unreferenced = []
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return unreferenced
+    for entry in entries:
+        path = _real(entry.path)
+        if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+            continue
+        if path not in referenced_input_dirs and path not in keep:
+            unreferenced.append(path)
+    return unreferenced
+
+
+def maintain(responsedir_json_files, input_dir=None, jobs: Optional[int] = None,
+             dry_run: bool = False, drop_broken: bool = False, force: bool = False) -> MaintenanceReport:
+    """
+    Verify response directories, delete data none of their responses refer to,
+    and rewrite them compactly
+
+    Every referenced output file must exist. Blobs and recorded input are also hashed,
+    and must match the digest they're stored under. Per-invocation output directories,
+    blobs, and input directories that no response refers to are deleted.
+    Each directory's journal is then folded into its JSON file.
+    A relative "response_dir" or "blob_dir" is relative to its directory's JSON file, as in playback.
+
+    If most referenced output files are missing, nothing is changed and MaintenanceException is raised,
+    since deleting everything unreferenced would likely delete the real output, unless force is given
+
+    Recorded input is only checked, and its directory only scanned for unreferenced input,
+    if input_dir is given. A directory's "input_dir" is a default from its template,
+    and input is only recorded there if ResponseDirectory was given input_dir,
+    so it can't be trusted to hold nothing but recorded input
+
+    Response directories that share output, blob, or input directories must be maintained
+    together, or each one's data would look unreferenced to the others
+
+    Parameters
+    ----------
+    responsedir_json_files : Union[str, Path, List[Union[str, Path]]]
+        The response directory JSON file(s) to maintain
+    input_dir : Union[str, Path], optional
+        Where the directories' recorded input is, if any
+    jobs : Optional[int], optional
+        Number of worker threads to verify, scan, and delete with. Defaults to os.cpu_count()
+    dry_run : bool, optional
+        Report what would be deleted and rewritten without changing anything, by default False
+    drop_broken : bool, optional
+        Remove responses whose files are missing or corrupt from their directories, by default False
+    force : bool, optional
+        Delete and drop even if most referenced output files are missing, by default False
+
+    Returns
+    -------
+    MaintenanceReport
+        Problems found, and how many bytes and inodes were (or would be) reclaimed
+    """
+    if isinstance(responsedir_json_files, (str, os.PathLike)):
+        responsedir_json_files = [responsedir_json_files]
+    directories = []
+    for path in responsedir_json_files:
+        directory = ResponseDirectory(path)
+        if directory.archive is not None:
+            raise MaintenanceException(
+                f"Response archives are read-only, unpack it first: {path}")
+        directories.append(directory)
+
+    report = MaintenanceReport()
+    # output files, and recorded input files, mapped to what's expected of them
+    outputs: Dict[str, _Reference] = {}
+    inputs: Dict[str, _Reference] = {}
+    response_roots = set()
+    blob_roots = set()
+    input_roots = set()
+    if input_dir is not None:
+        input_roots.add(_real(input_dir))
+
+    def _reference(references: Dict[str, _Reference], path: str, digest: Optional[str],
+                   algorithm: Optional[str]) -> _Reference:
+        reference = references.get(path)
+        if reference is None:
+            reference = _Reference(path, digest, algorithm)
+            references[path] = reference
+        return reference
+
+    for directory in directories:
+        response_roots.add(_real(directory.response_dir))
+        if directory.blob_dir:
+            blob_roots.add(_real(directory.blob_dir))
+        for location, input_hash, response_dict in _iter_locations(directory):
+            report["responses"] += 1
+            owner = (directory, location)
+            for path, digest in _response_files(directory, response_dict):
+                algorithm = BLOB_HASH_ALGORITHM if digest else None
+                _reference(outputs, path, digest, algorithm).owners.append(owner)
+            if input_hash and input_dir is not None:
+                # input is only recorded if the directory was given an input_dir,
+                # so it's fine for it to be missing, but not to be wrong
+                path = _real(os.path.join(
+                    input_dir, input_hash, INPUT_FILE_NAME))
+                if os.path.exists(path):
+                    _reference(inputs, path, input_hash,
+                               directory.input_hash_algorithm).owners.append(owner)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        references = list(outputs.values()) + list(inputs.values())
+        broken = {}
+        bad_inputs = []
+        for reference, problem in zip(references, pool.map(_check_reference, references)):
+            if problem is None:
+                continue
+            report[problem].append(reference.path)
+            if reference.path in inputs:
+                # playback only needs the input's hash, so the response is fine without it
+                bad_inputs.append(os.path.dirname(reference.path))
+                continue
+            for owner in reference.owners:
+                broken[id(owner[0]), owner[1]] = owner
+        report.missing.sort()
+        report.corrupt.sort()
+        missing_outputs = sum(1 for path in report.missing if path in outputs)
+        if not (dry_run or force) and missing_outputs > len(outputs) * MISSING_LIMIT:
+            raise MaintenanceException(
+                f"{missing_outputs} of {len(outputs)} referenced output files are missing, "
+                "refusing to delete anything. Check the response_dir and blob_dir, or force it")
+
+        if drop_broken:
+            report["dropped"] = len(broken)
+            # data only the dropped responses referred to is now unreferenced
+            for reference in references:
+                reference.owners = [owner for owner in reference.owners
+                                    if (id(owner[0]), owner[1]) not in broken]
+        referenced = {path for path, reference in outputs.items()
+                      if reference.owners}
+        referenced_input_dirs = {os.path.dirname(path) for path, reference in inputs.items()
+                                 if reference.owners}
+        if drop_broken:
+            referenced_input_dirs.difference_update(bad_inputs)
+
+        # so one root nested in another (e.g., blobs/ inside responses/) isn't mistaken for garbage
+        keep = response_roots | blob_roots | input_roots
+        scans = [pool.submit(_scan_response_dir, root, referenced, keep)
+                 for root in response_roots]
+        scans.extend(pool.submit(_scan_blob_dir, root, referenced, keep)
+                     for root in blob_roots)
+        scans.extend(pool.submit(_scan_input_dir, root, referenced_input_dirs, keep)
+                     for root in input_roots)
+        unreferenced = set()
+        for scan in scans:
+            unreferenced.update(scan.result())
+
+        unreferenced = sorted(unreferenced)
+        report["unreferenced"] = unreferenced
+        for size, inodes in pool.map(_tree_size, unreferenced):
+            report["reclaimed_bytes"] += size
+            report["reclaimed_inodes"] += inodes
+        if dry_run:
+            return report
+
+        list(pool.map(_remove, unreferenced))
+
+    # blob store prefix directories emptied by removing their last blob
+    for prefix in set(os.path.dirname(path) for path in unreferenced):
+        if os.path.dirname(prefix) in blob_roots:
+            try:
+                os.rmdir(prefix)
+                report["reclaimed_inodes"] += 1
+            except OSError:
+                pass
+
+    if drop_broken:
+        _drop(broken.values())
+    for directory in directories:
+        directory.compact()
+    return report
+
+
+def _drop(owners):
+    patterns = []
+    for directory, (section, input_hash, key) in owners:
+        contents = directory._response_directory
+        if section == "commands":
+            del contents["commands"][key]
+        elif section == "commands_with_input":
+            commands = contents["commands_with_input"][input_hash]
+            del commands[key]
+            if not commands:
+                del contents["commands_with_input"][input_hash]
+        else:
+            patterns.append((directory, key))
+    # highest index first, so removing one pattern doesn't shift the others
+    for directory, key in sorted(patterns, key=lambda pattern: pattern[1], reverse=True):
+        del directory._response_directory["command_patterns"][key]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Verify response directories, delete unreferenced data, and compact them")
+    parser.add_argument("response_directories", nargs="+",
+                        help="Response directory JSON files. Directories that share storage must be listed together")
+    parser.add_argument("--input-dir",
+                        help="Recorded input directory to verify and clean up, default: leave input alone")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Number of worker threads, default: the number of CPUs")
+    parser.add_argument("--dry-run", "-n", action="store_true",
+                        help="Report what would be deleted, without changing anything")
+    parser.add_argument("--drop-broken", action="store_true",
+                        help="Remove responses whose files are missing or corrupt")
+    parser.add_argument("--force", action="store_true",
+                        help="Delete unreferenced data even if most referenced output files are missing")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="List each unreferenced path")
+    parsed = parser.parse_args()
+    report = maintain(parsed.response_directories,
+                      input_dir=parsed.input_dir,
+                      jobs=parsed.jobs,
+                      dry_run=parsed.dry_run,
+                      drop_broken=parsed.drop_broken,
+                      force=parsed.force)
+    if not parsed.verbose:
+        report["unreferenced"] = len(report.unreferenced)
+    print(json.dumps(report, indent=2))
+    broken = report.missing or report.corrupt
+    if broken and not parsed.drop_broken:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,67 @@
+import mmap
+import os
+from typing import Optional
+
+
+class MappedOutput:
+    """
+    A read-only memoryview over a response's recorded output, memory-mapped
+    from its file where possible, so it can be scanned or sliced without copying it
+
+    The view is valid until close() is called, or the with block it's used in exits.
+    Slices of the view share its mapping, so they must be released first
+    (e.g., with their own with blocks), or close() raises BufferError
+    """
+
+    def __init__(self, view: memoryview, mapping: Optional[mmap.mmap] = None):
+        self._view = view
+        self._mapping = mapping
+
+    @property
+    def view(self) -> memoryview:
+        if self._view is None:
+            raise ValueError("Mapped output is closed")
+        return self._view
+
+    @property
+    def mapped(self) -> bool:
+        """
+        Whether the output is memory-mapped from its file, rather than read into memory
+        """
+        return self._mapping is not None
+
+    @property
+    def closed(self) -> bool:
+        return self._view is None
+
+    def __len__(self):
+        return self.view.nbytes
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mapping is not None:
+            # raises BufferError if slices of the view are still in use
+            # close() can be called again once they're released
+            self._mapping.close()
+            self._mapping = None
+
+    def __enter__(self) -> memoryview:
+        return self.view
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def map_file(path) -> MappedOutput:
+    """
+    Memory-map a file read-only
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return MappedOutput(memoryview(b""))
+        # the mapping stays valid after the file is closed
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedOutput(memoryview(mapping), mapping)
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+from typing import Any, Dict
+
+# set to a file path to have each mock command invocation append a JSON-lines record
+# of how long each phase took, e.g.:
+#   {"time": ..., "pid": ..., "args": "--binary|big-file.bin", "hit": true, "exit_status": 0,
+#    "stdout_bytes": 1048576, "stderr_bytes": 0, "total_ms": 3.1,
+#    "phases_ms": {"load_state": 0.2, "load_directory": 1.1, "hash_input": 0.0, "lookup": 0.1, ...}}
+METRICS_FILE_ENV_NAME = "MOCK_CLI_METRICS_FILE"
+
+
+class _Phase:
+    __slots__ = ("_phases", "_name", "_start")
+
+    def __init__(self, phases: Dict[str, float], name: str):
+        self._phases = phases
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self._start
+        self._phases[self._name] = self._phases.get(self._name, 0.0) + elapsed
+
+
+class InvocationMetrics:
+    """
+    Times the phases of a single mock command invocation,
+    and appends them to a metrics file as one JSON-lines record
+    """
+    enabled = True
+
+    def __init__(self, metrics_path):
+        self._metrics_path = metrics_path
+        self._start = time.perf_counter()
+        self._phases: Dict[str, float] = {}
+        self._record: Dict[str, Any] = {}
+
+    def phase(self, name: str) -> _Phase:
+        """
+        Time a phase of the invocation. Phases with the same name are added together
+        """
+        return _Phase(self._phases, name)
+
+    def set(self, key: str, value: Any):
+        self._record[key] = value
+
+    def write(self):
+        total = time.perf_counter() - self._start
+        record = {
+            "time": time.time(),
+            "pid": os.getpid()
+        }
+        record.update(self._record)
+        record["total_ms"] = total * 1000
+        record["phases_ms"] = {name: elapsed * 1000
+                               for name, elapsed in self._phases.items()}
+        line = (json.dumps(record) + "\n").encode()
+        # a single write to a file opened for appending, so records from
+        # concurrent invocations don't interleave
+        fd = os.open(self._metrics_path,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
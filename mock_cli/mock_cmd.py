@@ -1,34 +1,123 @@
 import os
 import sys
 from pathlib import Path
-from typing import IO
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Mapping,
+    MutableMapping,
+    Optional
+)
 
+from .argv_conversion import argv_to_string
 from .mock_cmd_state import MockCMDState, MockCMDStateNoDirectoryException
 from .responses import (
     CommandResponse,
     ResponseDirectory,
+    ResponseLookupException,
     ResponseReadException
 )
+from .stream_io import copy_to_fd
+
+if TYPE_CHECKING:
+    from .response_cache import ResponseCache
+
+# the same as mock_cli.timing.TIMING_SCALE_ENV_NAME
+# which is only imported if recorded timing is being replayed
+_TIMING_SCALE_ENV_NAME = "MOCK_CLI_TIMING_SCALE"
+# the same as mock_cli.metrics.METRICS_FILE_ENV_NAME
+# which is only imported if metrics are enabled
+_METRICS_FILE_ENV_NAME = "MOCK_CLI_METRICS_FILE"
 
 
 class MockCommandResponseDirException(Exception):
     pass
 
 
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _NullMetrics:
+    """
+    Stands in for mock_cli.metrics.InvocationMetrics when metrics are disabled, doing nothing
+    """
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name: str):
+        return self._phase
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def write(self):
+        pass
+
+
+_NULL_METRICS = _NullMetrics()
+
+
+def _metrics_for_invocation(environ: Mapping[str, str]):
+    """
+    Metrics for a new invocation, or _NULL_METRICS if $MOCK_CLI_METRICS_FILE isn't set
+    """
+    metrics_path = environ.get(_METRICS_FILE_ENV_NAME)
+    if not metrics_path:
+        return _NULL_METRICS
+    from .metrics import InvocationMetrics
+
+    return InvocationMetrics(metrics_path)
+
+
 class MockCommand:
-    def __init__(self, response_directory=None, state_dir=None):
-        self._mock_cmd_state = self._get_mock_cmd_state(state_dir)
+    def __init__(self, response_directory=None, state_dir=None, use_index=False,
+                 cache: Optional["ResponseCache"] = None, timing_scale: Optional[float] = None,
+                 environ: Optional[MutableMapping[str, str]] = None):
+        # the environment settings are read from and state changes are made in,
+        # e.g., a copy of os.environ for a command that isn't its own process
+        if environ is None:
+            environ = os.environ
+        self._environ = environ
+        # a no-op unless $MOCK_CLI_METRICS_FILE is set
+        self._metrics = _metrics_for_invocation(environ)
+        with self._metrics.phase("load_state"):
+            self._mock_cmd_state = self._get_mock_cmd_state(state_dir)
+        self._use_index = use_index
+        # a mock_cli.response_cache.ResponseCache, which may be shared between mock commands
+        self._cache = cache
+        # if set, replay recorded output timing scaled by this factor
+        # defaults to $MOCK_CLI_TIMING_SCALE
+        if timing_scale is None and environ.get(_TIMING_SCALE_ENV_NAME):
+            from .timing import timing_scale_from_env
+
+            timing_scale = timing_scale_from_env(environ)
+        self._timing_scale = timing_scale
 
-        self.response_directory = self._get_response_directory(
-            response_directory)
+        with self._metrics.phase("load_directory"):
+            self.response_directory = self._get_response_directory(
+                response_directory)
 
     def _get_response_directory(self, response_directory):
         if response_directory is None:
             if self._mock_cmd_state:
                 response_directory = self._mock_cmd_state.response_directory_path()
+                index = self._mock_cmd_state.response_index()
+                if index is not None:
+                    # already indexed in the state bundle, so there's nothing to load
+                    return ResponseDirectory(response_directory, index=index, cache=self._cache)
 
         if isinstance(response_directory, (str, Path)):
-            response_directory = ResponseDirectory(response_directory)
+            response_directory = self._load_response_directory(
+                response_directory)
         elif isinstance(response_directory, ResponseDirectory):
             pass
 
@@ -37,6 +126,18 @@ class MockCommand:
                 "No response directory provided")
         return response_directory
 
+    def _load_response_directory(self, response_directory_path) -> ResponseDirectory:
+        def _load():
+            return ResponseDirectory(
+                response_directory_path, use_index=self._use_index, cache=self._cache)
+
+        if self._cache is not None:
+            response_directory = self._cache.get_directory(
+                response_directory_path, _load)
+        else:
+            response_directory = _load()
+        return response_directory
+
     @classmethod
     def write_binary_output(cls, output_handle: IO, data: bytes):
         return cls._write_binary(output_handle, data)
@@ -47,40 +148,125 @@ class MockCommand:
             fd.write(data)
             fd.flush()
 
+    @classmethod
+    def _write_stream(cls, output_handle: IO, stream: BinaryIO):
+        # flush anything already buffered in the handle
+        # since we're about to write around it to its file descriptor
+        output_handle.flush()
+        return copy_to_fd(stream, output_handle.fileno())
+
     def get_response(self, args, input=None) -> CommandResponse:
-        response = self.response_directory.response_lookup(args, input=input)
+        metrics = self._metrics
+        with metrics.phase("hash_input"):
+            input_hash = self.response_directory.hash_input(input)
+        with metrics.phase("lookup"):
+            response = self.response_directory.response_lookup(
+                args, input_hash=input_hash)
         return response
 
-    def respond(self, args, input=None) -> int:
-        response = self.get_response(args, input=input)
+    def respond(self, args, input=None, stdout: IO = None, stderr: IO = None) -> int:
+        if stdout is None:
+            stdout = sys.stdout
+        if stderr is None:
+            stderr = sys.stderr
+        metrics = self._metrics
+        if metrics.enabled:
+            try:
+                return self._respond(args, input, stdout, stderr, metrics)
+            finally:
+                metrics.write()
+                # in case we're asked to respond again
+                self._metrics = _metrics_for_invocation(self._environ)
+        return self._respond(args, input, stdout, stderr, metrics)
+
+    def _respond(self, args, input, stdout: IO, stderr: IO, metrics) -> int:
+        if metrics.enabled:
+            metrics.set("args", argv_to_string(args))
+        try:
+            response = self.get_response(args, input=input)
+        except ResponseLookupException:
+            metrics.set("hit", False)
+            raise
+        metrics.set("hit", True)
 
         exit_status = response.return_code
+        metrics.set("exit_status", exit_status)
 
+        # open both outputs before writing either, so if one can't be read
+        # we fail without having written a partial response
+        output = None
         try:
-            output = response.output
-            error_output = response.error_output
+            with metrics.phase("open_outputs"):
+                output = response.open_output()
+                error_output = response.open_error_output()
         except (FileNotFoundError, PermissionError, OSError) as err:
+            if output is not None:
+                output.close()
             err_msg = f"Response couldn't be read {err}"
             raise ResponseReadException(err_msg)
 
-        if response.output:
-            self._write_binary(sys.stdout, output)
+        timing = None
+        # responses recorded with their interleaving are always played back in order,
+        # but only with delays if we've been asked to
+        if self._timing_scale is not None or "timing" in response:
+            with metrics.phase("read_timing"):
+                timing = response.read_timing()
 
-        if response.error_output:
-            self._write_binary(sys.stderr, error_output)
+        # stream outputs directly from disk rather than reading them into memory
+        with output, error_output:
+            if timing is not None:
+                with metrics.phase("replay"):
+                    stdout_bytes, stderr_bytes = self._replay(
+                        timing, stdout, output, stderr, error_output)
+            else:
+                with metrics.phase("write_stdout"):
+                    stdout_bytes = self._write_stream(stdout, output)
+                with metrics.phase("write_stderr"):
+                    stderr_bytes = self._write_stream(stderr, error_output)
+        metrics.set("stdout_bytes", stdout_bytes)
+        metrics.set("stderr_bytes", stderr_bytes)
 
         if response.changes_state:
-            self._iterate_state()
+            with metrics.phase("iterate_state"):
+                self._iterate_state()
 
         return exit_status
 
+    def _replay(self, timing, stdout: IO, output: BinaryIO, stderr: IO, error_output: BinaryIO):
+        from .timing import STDERR_STREAM, STDOUT_STREAM
+
+        stdout.flush()
+        stderr.flush()
+        streams = {
+            STDOUT_STREAM: (output, stdout.fileno()),
+            STDERR_STREAM: (error_output, stderr.fileno())
+        }
+        scale = self._timing_scale
+        if scale is None:
+            scale = 0
+        written = timing.replay(streams, scale=scale)
+        return written[STDOUT_STREAM], written[STDERR_STREAM]
+
+    def close(self):
+        """
+        Undo any environment changes made by the mock command's state, if it has one
+        """
+        if self._mock_cmd_state:
+            self._mock_cmd_state.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def _iterate_state(self):
         if self._mock_cmd_state:
             self._mock_cmd_state.iterate_config()
 
     def _get_mock_cmd_state(self, state_dir):
         try:
-            cmd_state = MockCMDState(state_dir=state_dir)
+            cmd_state = MockCMDState(state_dir=state_dir, environ=self._environ)
         except MockCMDStateNoDirectoryException:
             cmd_state = None
         return cmd_state
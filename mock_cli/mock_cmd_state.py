@@ -1,12 +1,42 @@
 import json
 import os
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, MutableMapping, Optional, Union
 
 from . import data
-from .pkg_resources import pkgfiles
+from .file_util import atomic_write_json, lock_path_for, locked
 
 STATE_DIR_ENV_NAME = "MOCK_CMD_STATE_DIR"
+# If set, state iterations are tracked separately for each namespace,
+# e.g., one per pytest-xdist worker: MOCK_CMD_STATE_NAMESPACE=$PYTEST_XDIST_WORKER
+STATE_NAMESPACE_ENV_NAME = "MOCK_CMD_STATE_NAMESPACE"
+
+# the same as mock_cli.state_bundle.BUNDLE_SUFFIX
+# which is only imported if the state directory has a bundle
+_BUNDLE_SUFFIX = ".bundle"
+
+
+def _config_file_state(config_path) -> List[int]:
+    config_stat = os.stat(config_path)
+    return [config_stat.st_mtime_ns, config_stat.st_size]
+
+
+def _read_iteration_counter(counter_path, config_state: List[int]) -> Optional[int]:
+    # a counter saved while the config was different is left over from an earlier
+    # run of the scenario (e.g., a reused pytest-xdist worker name), so it's ignored
+    try:
+        with open(counter_path, "r") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    if saved.get("config_state") != list(config_state):
+        return None
+    return saved["iteration"]
+
+
+def _write_iteration_counter(counter_path, iteration: int, config_state: List[int]):
+    atomic_write_json(counter_path, {"iteration": iteration,
+                                     "config_state": list(config_state)})
 
 
 class MockCMDStateDirException(Exception):
@@ -22,10 +52,21 @@ class MockCMDStateMaxIterationException(Exception):
 
 
 class MockCMDEnvironmentConfig(dict):
+    """
+    An overlay of environment variables to set and unset for a state iteration
+
+    Only the variables named in "set" and "pop" are saved when the overlay is applied,
+    and only those are put back when it's restored, so unrelated changes
+    to the environment are left alone. Can be used as a context manager
+    """
 
     def __init__(self, env_config_dict):
         super().__init__(env_config_dict)
-        self._saved_env = dict(os.environ)
+        # original values of variables we've changed, None for ones that weren't set
+        # None until the overlay has been applied
+        self._saved_env: Optional[Dict[str, Optional[str]]] = None
+        # the environment the overlay is applied to
+        self._environ = os.environ
 
     @property
     def set_vars(self) -> Dict[str, str]:
@@ -43,30 +84,58 @@ class MockCMDEnvironmentConfig(dict):
     def pop_vars(self, pop_vars: List[str]):
         self["pop"] = pop_vars
 
-    def initialize_env(self):
+    def initialize_env(self, environ: Optional[MutableMapping[str, str]] = None):
+        """
+        Apply the overlay to environ, by default os.environ,
+        e.g., a copy of it for a command that isn't its own process
+        """
+        if self._saved_env is not None:
+            # already applied
+            return
+        if environ is None:
+            environ = os.environ
+        self._environ = environ
+        saved_env = {}
+        self._saved_env = saved_env
         for var in self.pop_vars:
-            os.environ.pop(var, None)
+            saved_env.setdefault(var, environ.get(var))
+            environ.pop(var, None)
 
         for var, val in self.set_vars.items():
-            os.environ[var] = val
+            saved_env.setdefault(var, environ.get(var))
+            environ[var] = val
 
     def restore_env(self):
         # in case we blow up during initialization,
         # check that _saved_env has been set
         # so we don't blow up again on the way down
-        if hasattr(self, "_saved_env"):
-            if self._saved_env:
-                os.environ.clear()
-                os.environ.update(self._saved_env)
+        saved_env = getattr(self, "_saved_env", None)
+        if saved_env:
+            environ = self._environ
+            for var, val in saved_env.items():
+                if val is None:
+                    environ.pop(var, None)
+                else:
+                    environ[var] = val
         self._saved_env = None
 
+    def __enter__(self):
+        self.initialize_env()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.restore_env()
+
     def __del__(self):
-        # call restore on obj delete in case owner doesn't get a chance to explicitly call it
-        # not sure if relying on this is racey
+        # last resort in case the owner never restores the environment
+        # callers should call restore_env() or use this as a context manager
+        # rather than relying on this
         self.restore_env()
 
     @classmethod
     def from_template(cls):
+        from .pkg_resources import pkgfiles
+
         template_dict = {}
         with pkgfiles(data).joinpath(data.ENV_TEMPLATE_JSON).open("r") as _file:
             template_dict = json.load(_file)
@@ -77,7 +146,8 @@ class MockCMDEnvironmentConfig(dict):
 
 class MockCMDStateConfig(dict):
 
-    def __init__(self, config_path, config=None):
+    def __init__(self, config_path, config=None, namespace: Optional[str] = None,
+                 environ: Optional[MutableMapping[str, str]] = None):
         if isinstance(config_path, str):
             config_path = Path(config_path)
         if config:
@@ -86,6 +156,13 @@ class MockCMDStateConfig(dict):
             config_dict = json.load(open(config_path, "r"))
         super().__init__(config_dict)
         self._config_path = config_path
+        self._namespace = namespace
+        # where the current iteration's environment changes are made, by default os.environ
+        self._environ = environ
+        # the iteration recorded in the config file itself, which namespaces start from
+        self._shared_iteration = self.get("iteration")
+        if namespace:
+            self.iteration = self._read_saved_iteration()
         self._env_config: MockCMDEnvironmentConfig = None
         self._initialize_env()
 
@@ -116,6 +193,10 @@ class MockCMDStateConfig(dict):
     def state_list(self):
         return self["state-list"]
 
+    def response_index(self):
+        # only a state bundle has the response directory indexed ahead of time
+        return None
+
     def increase_max_iterations(self):
         self["max-iterations"] += 1
 
@@ -161,25 +242,83 @@ class MockCMDStateConfig(dict):
             self.save_config()
 
     def iterate(self):
-        if self.iteration >= self.max_iterations:
-            raise MockCMDStateMaxIterationException(
-                f"Already reached max iterations: {self.max_iterations}")
-        self.iteration += 1
-        self.save_config()
+        # Lock so concurrent invocations each advance the state exactly once
+        # and re-read the saved iteration, since another process
+        # may have iterated since we loaded it
+        with locked(self._lock_path()):
+            self.iteration = self._read_saved_iteration()
+            if self.iteration >= self.max_iterations:
+                raise MockCMDStateMaxIterationException(
+                    f"Already reached max iterations: {self.max_iterations}")
+            self.iteration += 1
+            self._save_iteration()
 
         # restore saved env
-        self._env_config.restore_env()
-
-        # explicitly set env_config to None
-        self._env_config = None
+        # explicitly sets env_config to None
+        self.restore_env()
 
         # initialize the next env
         self._initialize_env()
 
+    def restore_env(self):
+        """
+        Undo the current state iteration's environment changes
+        """
+        if self._env_config is not None:
+            self._env_config.restore_env()
+            self._env_config = None
+
     def save_config(self):
         self._config_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(self._config_path, "w") as f:
-            json.dump(self, f, indent=2)
+        config = self
+        if self._namespace:
+            # a namespace's iteration is saved separately
+            # don't let it leak into the shared config
+            config = dict(self)
+            config["iteration"] = self._shared_iteration
+        # replace the file atomically so concurrent readers never see a partial config
+        atomic_write_json(self._config_path, config, indent=2)
+
+    def _iteration_path(self) -> Path:
+        iteration_path = Path(self._config_path.parent,
+                              f"iteration-{self._namespace}.json")
+        return iteration_path
+
+    def _lock_path(self) -> str:
+        if self._namespace:
+            # namespaces don't contend with each other
+            state_path = self._iteration_path()
+        else:
+            state_path = self._config_path
+        lock_path = lock_path_for(state_path)
+        return lock_path
+
+    def _read_saved_iteration(self) -> int:
+        if self._namespace:
+            try:
+                iteration = _read_iteration_counter(
+                    self._iteration_path(), _config_file_state(self._config_path))
+            except FileNotFoundError:
+                # the config hasn't been saved yet
+                iteration = None
+            if iteration is None:
+                # this namespace hasn't iterated since the config was written
+                iteration = self._shared_iteration
+            return iteration
+        else:
+            try:
+                saved = json.load(open(self._config_path, "r"))
+            except FileNotFoundError:
+                # not saved yet, so there's nothing newer than what we have
+                return self.iteration
+        return saved["iteration"]
+
+    def _save_iteration(self):
+        if self._namespace:
+            _write_iteration_counter(self._iteration_path(), self.iteration,
+                                     _config_file_state(self._config_path))
+        else:
+            self.save_config()
 
     def _initialize_env(self):
         # don't initialize a config if we have done so already
@@ -190,7 +329,7 @@ class MockCMDStateConfig(dict):
             current_state = state_list[self.iteration]
             env_config = current_state["env-vars"]
             env_config = MockCMDEnvironmentConfig(env_config)
-            env_config.initialize_env()
+            env_config.initialize_env(self._environ)
             self._env_config = env_config
 
 
@@ -212,6 +351,8 @@ class MockCMDNewStateConfig(MockCMDStateConfig):
 
     @classmethod
     def from_template(cls, config_path):
+        from .pkg_resources import pkgfiles
+
         template_dict = {}
         with pkgfiles(data).joinpath(data.CONFIG_TEMPLATE_JSON).open("r") as _file:
             template_dict = json.load(_file)
@@ -230,9 +371,25 @@ class MockCMDNewStateConfig(MockCMDStateConfig):
 class MockCMDState:
     CONFIG_FILE_NAME = "config.json"
 
-    def __init__(self, state_dir: Union[str, Path] = None):
+    def __init__(self, state_dir: Union[str, Path] = None, namespace: Optional[str] = None,
+                 environ: Optional[MutableMapping[str, str]] = None):
+        """
+        Parameters
+        ----------
+        state_dir : Union[str, Path], optional
+            The state directory, or its config file. Defaults to $MOCK_CMD_STATE_DIR
+        namespace : Optional[str], optional
+            Track iterations separately for this namespace. Defaults to $MOCK_CMD_STATE_NAMESPACE
+        environ : Optional[MutableMapping[str, str]], optional
+            The environment to read the defaults from and make the current iteration's
+            environment changes in, by default os.environ
+        """
+        if environ is None:
+            environ = os.environ
         if state_dir is None:
-            state_dir = os.environ.get(STATE_DIR_ENV_NAME)
+            state_dir = environ.get(STATE_DIR_ENV_NAME)
+        if namespace is None:
+            namespace = environ.get(STATE_NAMESPACE_ENV_NAME) or None
 
         if state_dir is None:
             raise MockCMDStateNoDirectoryException(
@@ -248,10 +405,35 @@ class MockCMDState:
         else:
             state_path = state_dir
         self._state_path = state_path
-        self._config = MockCMDStateConfig(Path(self._state_path))
+        if os.path.exists(os.fspath(state_path) + _BUNDLE_SUFFIX):
+            from .state_bundle import StateBundle
+
+            self._config = StateBundle(state_path, namespace=namespace, environ=environ)
+        else:
+            self._config = MockCMDStateConfig(
+                Path(self._state_path), namespace=namespace, environ=environ)
 
     def response_directory_path(self) -> str:
         return self._config.response_directory
 
+    def response_index(self):
+        """
+        The current response directory's index, if the state directory has been compiled
+        into a state bundle, otherwise None
+        """
+        return self._config.response_index()
+
     def iterate_config(self):
         self._config.iterate()
+
+    def close(self):
+        """
+        Undo the environment changes made for the current state iteration
+        """
+        self._config.restore_env()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
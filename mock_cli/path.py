@@ -81,3 +81,54 @@ class ActualPath(AbstractPath):
             if fname is not None:
                 args.append(fname)
             super().__init__(*args)
+
+
+def resolve_saved_path(path: Union[str, Path], saved_in: Union[str, Path]) -> str:
+    """
+    Resolve a path saved in a file, e.g., a response directory's "response_dir",
+    where a relative path is relative to the saving file's directory
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        The path as it was saved
+    saved_in : Union[str, Path]
+        The file it was saved in
+
+    Returns
+    -------
+    str
+        The resolved absolute path
+    """
+    path = os.path.expanduser(os.fspath(path))
+    base_dir = os.path.dirname(os.path.realpath(saved_in))
+    return os.path.join(base_dir, path)
+
+
+def path_to_save(path: Union[str, Path], saved_in: Union[str, Path]) -> str:
+    """
+    The inverse of resolve_saved_path(): a path given relative to the working directory,
+    as it should be saved in saved_in. Absolute paths are saved as they are
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        The path to save
+    saved_in : Union[str, Path]
+        The file it will be saved in
+
+    Returns
+    -------
+    str
+        The path to save
+    """
+    path = os.path.expanduser(os.fspath(path))
+    if os.path.isabs(path):
+        return path
+    base_dir = os.path.dirname(os.path.realpath(saved_in))
+    try:
+        path = os.path.relpath(os.path.realpath(path), base_dir)
+    except ValueError:
+        # e.g., on a different drive than saved_in on Windows
+        path = os.path.realpath(path)
+    return path
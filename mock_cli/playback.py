@@ -0,0 +1,59 @@
+# Minimal entry point for mock commands that only play back responses
+# Importing this module pulls in only what's needed to look up and write out a
+# response. Its import footprint is checked by mock_cli.import_budget
+import os
+import sys
+from typing import BinaryIO, List, Optional, Union
+
+from .mock_cmd import MockCommand
+
+RESPONSE_DIR_ENV_NAME = "MOCK_CLI_RESPONSE_DIRECTORY"
+# set to "1" to read standard input and use it to look up the response
+READ_STDIN_ENV_NAME = "MOCK_CLI_READ_STDIN"
+
+
+def respond(response_directory=None,
+            state_dir=None,
+            args: Optional[List[str]] = None,
+            input: Optional[Union[bytes, BinaryIO]] = None,
+            use_index: bool = True) -> int:
+    """
+    Play back the response for a set of command-line arguments
+
+    Parameters
+    ----------
+    response_directory : Union[str, Path], optional
+        Response directory JSON file. If not provided, it is taken from the mock command state
+    state_dir : Union[str, Path], optional
+        Mock command state directory. Defaults to $MOCK_CMD_STATE_DIR
+    args : Optional[List[str]], optional
+        Command-line arguments, not including the program name. Defaults to sys.argv[1:]
+    input : Optional[Union[bytes, BinaryIO]], optional
+        Standard input to look up the response by, if any. A file object is hashed as it's read
+    use_index : bool, optional
+        Look up the response using a compiled response directory index, by default True
+
+    Returns
+    -------
+    int
+        The response's exit status
+    """
+    if args is None:
+        args = sys.argv[1:]
+    cmd = MockCommand(response_directory=response_directory,
+                      state_dir=state_dir, use_index=use_index)
+    exit_status = cmd.respond(args, input=input)
+    return exit_status
+
+
+def main():
+    input = None
+    if os.environ.get(READ_STDIN_ENV_NAME) == "1":
+        # hashed a chunk at a time rather than read into memory all at once
+        input = sys.stdin.buffer
+    response_directory = os.environ.get(RESPONSE_DIR_ENV_NAME)
+    return respond(response_directory=response_directory, input=input)
+
+
+if __name__ == "__main__":
+    exit(main())
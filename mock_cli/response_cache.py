@@ -0,0 +1,155 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Callable, Dict, Optional
+
+from .journal import directory_file_state
+
+if TYPE_CHECKING:
+    from .responses import ResponseDirectory
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    A least-recently-used cache of response output and parsed response directories,
+    bounded by their total size in bytes
+
+    Entries are invalidated when the modification time or size of the file they
+    were loaded from changes. A response directory's size is approximated by the size
+    of its JSON file and journal. Safe to share between threads
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_MAX_BYTES, max_item_bytes: Optional[int] = None):
+        """
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Maximum total size of cached entries, by default DEFAULT_CACHE_MAX_BYTES
+        max_item_bytes : Optional[int], optional
+            Output larger than this is streamed from disk rather than cached.
+            Defaults to 1/8th of max_bytes, so one large response can't flush the whole cache
+        """
+        # only needed if a cache is in use
+        import threading
+
+        if max_item_bytes is None:
+            max_item_bytes = max_bytes // 8
+        self._max_bytes = max_bytes
+        self._max_item_bytes = min(max_item_bytes, max_bytes)
+        # key -> (file state, value, size)
+        self._entries: OrderedDict = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "total_bytes": self._total_bytes,
+            "max_bytes": self._max_bytes
+        }
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def get_output(self, path, open_output: Callable[[], BinaryIO]) -> Optional[bytes]:
+        """
+        Get a response output file's (decompressed) content, loading it on a miss
+
+        Parameters
+        ----------
+        path : Union[str, Path]
+            The output file
+        open_output : Callable[[], BinaryIO]
+            Opens the output for reading, decompressing it if necessary
+
+        Returns
+        -------
+        Optional[bytes]
+            The output, or None if it's too large to cache and should be streamed instead
+        """
+        key = ("output", str(path))
+        st = os.stat(path)
+        file_state = (st.st_mtime_ns, st.st_size)
+        data = self._get(key, file_state)
+        if data is not None:
+            return data
+        if st.st_size > self._max_item_bytes:
+            return None
+        with open_output() as f:
+            data = f.read()
+        if len(data) > self._max_item_bytes:
+            # compressed output can be much larger than its file
+            return data
+        self._put(key, file_state, data, len(data))
+        return data
+
+    def get_directory(self, responsedir_json_file, load: Callable[[], "ResponseDirectory"]) -> "ResponseDirectory":
+        """
+        Get a parsed response directory, loading it on a miss or if it has changed on disk
+        """
+        path = Path(responsedir_json_file).resolve()
+        key = ("directory", str(path))
+        try:
+            file_state = directory_file_state(path)
+        except OSError:
+            # let the loader raise the appropriate exception
+            return load()
+        directory = self._get(key, file_state)
+        if directory is not None:
+            return directory
+        directory = load()
+        size = file_state[1] + max(file_state[3], 0)
+        if size <= self._max_item_bytes:
+            self._put(key, file_state, directory, size)
+        return directory
+
+    def _get(self, key, file_state):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == file_state:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                # changed on disk
+                self._remove(key)
+            self.misses += 1
+        return None
+
+    def _put(self, key, file_state, value, size):
+        with self._lock:
+            if key in self._entries:
+                # loaded concurrently by another thread
+                self._remove(key)
+            self._entries[key] = (file_state, value, size)
+            self._total_bytes += size
+            while self._total_bytes > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._total_bytes -= size
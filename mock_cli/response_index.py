@@ -0,0 +1,207 @@
+import hashlib
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .journal import (
+    apply_entries,
+    directory_file_state,
+    journal_path_for,
+    read_entries
+)
+from .slot_table import (
+    SLOT,
+    build_slots,
+    entry_key,
+    lookup,
+    pack_record,
+    write_table
+)
+
+INDEX_SUFFIX = ".idx"
+
+# Index file layout (all integers little-endian):
+#   header:  magic, version, source mtime (ns), source size,
+#            journal mtime (ns), journal size (-1 if there is no journal),
+#            meta offset, meta length, patterns offset, patterns length,
+#            slot count, slot table offset
+#   meta:    JSON-encoded directory "meta" dictionary
+#   patterns: JSON-encoded directory "command_patterns" list
+#   records: key length (u32), key bytes, JSON-encoded response dictionary
+#            where the key is the input hash, NUL, argument string
+#   slots:   open-addressed hash table of (key hash, record offset, record length)
+# see mock_cli.slot_table for the layout of the records and slots
+_MAGIC = b"MCLIIDX\x00"
+_VERSION = 3
+_HEADER = struct.Struct("<8sIqqqqQQQQQQ")
+
+
+class ResponseIndexException(Exception):
+    pass
+
+
+def index_path_for(responsedir_json_file) -> Path:
+    responsedir_json_file = Path(responsedir_json_file)
+    index_path = responsedir_json_file.with_name(
+        responsedir_json_file.name + INDEX_SUFFIX)
+    return index_path
+
+
+def _key_hash(key: bytes) -> int:
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _iter_entries(directory: Dict):
+    for arg_string, response_dict in directory.get("commands", {}).items():
+        yield None, arg_string, response_dict
+
+    commands_with_input = directory.get("commands_with_input", {})
+    for input_hash, commands in commands_with_input.items():
+        for arg_string, response_dict in commands.items():
+            yield input_hash, arg_string, response_dict
+
+
+def write_index(index_path, directory: Dict, source_state: Tuple[int, int, int, int]):
+    index_path = Path(index_path)
+    meta = json.dumps(directory["meta"]).encode()
+    patterns = json.dumps(directory.get("command_patterns", [])).encode()
+    records = []
+    for input_hash, arg_string, response_dict in _iter_entries(directory):
+        key = entry_key(input_hash, arg_string)
+        records.append((_key_hash(key), pack_record(key, response_dict)))
+
+    meta_offset = _HEADER.size
+    patterns_offset = meta_offset + len(meta)
+    slots, slots_offset = build_slots(
+        records, patterns_offset + len(patterns))
+
+    header = _HEADER.pack(_MAGIC, _VERSION, *source_state,
+                          meta_offset, len(meta),
+                          patterns_offset, len(patterns),
+                          len(slots), slots_offset)
+
+    # only needed when (re)building the index
+    from .file_util import atomic_open
+
+    # a concurrent reader never sees a partially written index
+    with atomic_open(index_path, "wb") as f:
+        f.write(header)
+        f.write(meta)
+        f.write(patterns)
+        write_table(f, records, slots)
+
+
+def build_index(responsedir_json_file, index_path=None) -> Path:
+    """
+    Compile a response directory JSON file into a memory-mappable lookup index
+
+    Parameters
+    ----------
+    responsedir_json_file : Union[str, Path]
+        The response directory JSON file to compile
+    index_path : Union[str, Path], optional
+        Where to write the index. Defaults to a sidecar file next to the JSON file
+
+    Returns
+    -------
+    Path
+        The path to the newly written index
+    """
+    if index_path is None:
+        index_path = index_path_for(responsedir_json_file)
+    # stat before reading, so if the source changes while we're reading it,
+    # the index will look stale and get rebuilt next time
+    source_state = directory_file_state(responsedir_json_file)
+    with open(responsedir_json_file, "r") as f:
+        directory = json.load(f)
+    apply_entries(directory, read_entries(
+        journal_path_for(responsedir_json_file)))
+    write_index(index_path, directory, source_state)
+    return Path(index_path)
+
+
+class ResponseIndex:
+    """
+    A read-only, memory-mapped view of a compiled response directory
+
+    Looking up a response hashes the argument string and probes a hash table,
+    decoding only the matching entry rather than the whole directory
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_header()
+        except BaseException:
+            self._mmap.close()
+            raise
+
+    def _parse_header(self):
+        if len(self._mmap) < _HEADER.size:
+            raise ResponseIndexException("Truncated response index")
+        (magic, version,
+         *source_state,
+         meta_offset, meta_len,
+         self._patterns_offset, self._patterns_len,
+         self._slot_count, self._slots_offset) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ResponseIndexException("Unrecognized response index format")
+        self._source_state = tuple(source_state)
+        expected_len = self._slots_offset + self._slot_count * SLOT.size
+        if len(self._mmap) != expected_len:
+            raise ResponseIndexException("Truncated response index")
+        meta = self._mmap[meta_offset:meta_offset + meta_len]
+        self._meta = json.loads(meta)
+        # decoded the first time they're needed, since most lookups match exactly
+        self._command_patterns = None
+
+    @classmethod
+    def for_directory(cls, responsedir_json_file) -> "ResponseIndex":
+        """
+        Open the sidecar index for a response directory JSON file,
+        (re)building it first if it is missing or out of date
+        """
+        index_path = index_path_for(responsedir_json_file)
+        source_state = directory_file_state(responsedir_json_file)
+        index = None
+        try:
+            index = cls(index_path)
+        except (FileNotFoundError, ResponseIndexException, ValueError):
+            pass
+
+        if index is not None and not index.is_current(source_state):
+            index.close()
+            index = None
+
+        if index is None:
+            build_index(responsedir_json_file, index_path=index_path)
+            index = cls(index_path)
+        return index
+
+    @property
+    def meta(self) -> Dict:
+        return self._meta
+
+    @property
+    def command_patterns(self) -> List[Dict]:
+        if self._command_patterns is None:
+            start = self._patterns_offset
+            patterns = self._mmap[start:start + self._patterns_len]
+            self._command_patterns = json.loads(patterns)
+        return self._command_patterns
+
+    def is_current(self, source_state: Tuple[int, int, int, int]) -> bool:
+        current = self._source_state == tuple(source_state)
+        return current
+
+    def lookup(self, input_hash: Optional[str], arg_string: str) -> Optional[Dict]:
+        key = entry_key(input_hash, arg_string)
+        return lookup(self._mmap, self._slots_offset, self._slot_count,
+                      key, _key_hash(key))
+
+    def close(self):
+        self._mmap.close()
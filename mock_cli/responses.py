@@ -1,10 +1,45 @@
+import io
 import json
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Union
+)
 
-from .argv_conversion import arg_shlex_from_string, argv_to_string
-from .hashing import digest_input
-from .path import ActualPath
+from .argv_conversion import (
+    ARG_KEY_VERSION,
+    ARG_KEY_VERSION_LEGACY,
+    DEFAULT_ARG_DIGEST_THRESHOLD,
+    ArgKeyException,
+    argv_to_key,
+    argv_to_shlex
+)
+from .hashing import (
+    DEFAULT_INPUT_HASH_ALGORITHM,
+    digest_input,
+    new_input_hasher
+)
+from .path import ActualPath, path_to_save, resolve_saved_path
+
+if TYPE_CHECKING:
+    import subprocess
+
+    from .archive import ResponseArchive
+    from .arg_patterns import ArgPattern, ArgPatternMatcher
+    from .mapped_output import MappedOutput
+    from .response_cache import ResponseCache
+    from .response_index import ResponseIndex
+    from .stream_io import OutputSource
+    from .timing import OutputTiming
+
+# the same as mock_cli.compression.DEFAULT_COMPRESSION_THRESHOLD
+# which is only imported if responses are compressed
+_DEFAULT_COMPRESSION_THRESHOLD = 64 * 1024
 
 
 class ResponseRecordException(Exception):
@@ -32,11 +67,27 @@ class ResponseDirectoryException(Exception):
 
 
 class CommandResponse(dict):
-    def __init__(self, response_dict, response_dir, output=None, error_output=None):
+    def __init__(self, response_dict, response_dir, output=None, error_output=None, blob_dir=None,
+                 cache: Optional["ResponseCache"] = None, record_timing: bool = False,
+                 timing_start_ns: Optional[int] = None, record_interleaving: bool = False,
+                 archive: Optional["ResponseArchive"] = None,
+                 timing: Optional["OutputTiming"] = None,
+                 wait: Optional[Callable[[], int]] = None):
         super().__init__(response_dict)
         if response_dir:
             response_dir = ActualPath(response_dir)
         self._response_dir = response_dir
+        self._blob_dir = blob_dir
+        self._cache = cache
+        # output is read from here, if the response was loaded from a response archive
+        self._archive = archive
+        self._record_timing = record_timing
+        self._timing_start_ns = timing_start_ns
+        self._record_interleaving = record_interleaving
+        # already noted while the output was read, e.g., by AsyncRecorder
+        self._timing = timing
+        # returns the exit status, once the output has been drained
+        self._wait = wait
         self._output = output
         self._error_output = error_output
 
@@ -66,22 +117,133 @@ class CommandResponse(dict):
     def changes_state(self) -> bool:
         return self.get("changes_state", False)
 
-    def record_response(self, response_dir):
+    def record_response(self,
+                        response_dir,
+                        blob_dir=None,
+                        compression: Optional[str] = None,
+                        compression_threshold: int = _DEFAULT_COMPRESSION_THRESHOLD):
         if None in [self._output, self._error_output]:
             raise ResponseRecordException(
                 "Missing stdout and/or stderr response")
 
-        resp_path: Path
-        stdout_name = self["stdout"]
-        stderr_name = self["stderr"]
-        resp_path = Path(response_dir, self["name"])
-        resp_path = ActualPath(resp_path, create=True)
+        # only needed when recording
+        from .stream_io import is_stream, write_to_path
+
+        if blob_dir:
+            from .blob_store import BlobStore
+
+            # store output by content rather than under the invocation's name
+            store = BlobStore(blob_dir)
+            record_output = store.add
+            record_error_output = store.add
+        else:
+            resp_path: Path
+            stdout_name = self["stdout"]
+            stderr_name = self["stderr"]
+            resp_path = Path(response_dir, self["name"])
+            resp_path = ActualPath(resp_path, create=True)
+
+            output_path = Path(resp_path, f"{stdout_name}")
+            error_output_path = Path(resp_path, f"{stderr_name}")
+
+            def record_output(source):
+                return write_to_path(output_path, source)
+
+            def record_error_output(source):
+                return write_to_path(error_output_path, source)
+
+        if compression:
+            record_output = self._compressing_recorder(
+                record_output, "stdout_codec", compression, compression_threshold)
+            record_error_output = self._compressing_recorder(
+                record_error_output, "stderr_codec", compression, compression_threshold)
+
+        output = self._output
+        error_output = self._error_output
+        timing = self._timing
+        note_timing = timing is None and (self._record_timing or self._record_interleaving)
+        if note_timing:
+            from .timing import STDERR_STREAM, STDOUT_STREAM, OutputTiming
+
+            timing = OutputTiming(start_ns=self._timing_start_ns)
+            output = timing.timed_chunks(output, STDOUT_STREAM)
+            error_output = timing.timed_chunks(error_output, STDERR_STREAM)
+
+        stdout_result, stderr_result = self._record_outputs(
+            record_output, record_error_output, output, error_output)
+        if self._wait is not None:
+            self["exit_status"] = self._wait()
+            self._wait = None
+        if blob_dir:
+            self["stdout_blob"] = stdout_result
+            self["stderr_blob"] = stderr_result
+
+        if note_timing:
+            timing.finish()
+            if not self._record_timing:
+                # only the order matters, so keep the event log small
+                timing.coalesce()
+        if timing is not None:
+            self["timing"] = "timing"
+            if blob_dir:
+                self["timing_blob"] = store.add(timing.to_bytes())
+            else:
+                write_to_path(Path(resp_path, self["timing"]), timing.to_bytes())
+
+        # streams can only be consumed once, so read them back from disk from now on
+        self._response_dir = ActualPath(response_dir)
+        self._blob_dir = blob_dir
+        if is_stream(self._output):
+            self._output = None
+        if is_stream(self._error_output):
+            self._error_output = None
+
+    def _compressing_recorder(self, record, codec_key, compression, compression_threshold):
+        from .compression import CompressionCodecException, maybe_compress
 
-        output_path = Path(resp_path, f"{stdout_name}")
-        error_output_path = Path(resp_path, f"{stderr_name}")
+        def _record(source):
+            try:
+                codec, source = maybe_compress(
+                    source, compression, threshold=compression_threshold)
+            except CompressionCodecException as e:
+                raise ResponseRecordException(str(e)) from e
+            result = record(source)
+            # note which codec, if any, was used so playback can decompress it
+            if codec:
+                self[codec_key] = codec
+            else:
+                self.pop(codec_key, None)
+            return result
+        return _record
+
+    def _record_outputs(self, record_output, record_error_output, output, error_output):
+        from .stream_io import is_stream
+
+        if not (is_stream(output) and is_stream(error_output)):
+            return record_output(output), record_error_output(error_output)
+
+        # if both are live pipes from the same process, draining one
+        # while the other fills up can deadlock, so drain them concurrently
+        import threading
+
+        stderr_results = []
+        stderr_errors = []
 
-        output_path.write_bytes(self._output)
-        error_output_path.write_bytes(self._error_output)
+        def _record_error_output():
+            try:
+                stderr_results.append(record_error_output(error_output))
+            except BaseException as e:
+                stderr_errors.append(e)
+
+        stderr_thread = threading.Thread(target=_record_error_output)
+        stderr_thread.start()
+        try:
+            stdout_result = record_output(output)
+        finally:
+            stderr_thread.join()
+        if stderr_errors:
+            raise stderr_errors[0]
+        return stdout_result, stderr_results[0]
 
     def _out_path(self, out_name):
         response_name = self["name"]
@@ -89,55 +251,235 @@ class CommandResponse(dict):
         return out_path
 
     def _stdout_path(self):
+        if "stdout_blob" in self:
+            from .blob_store import blob_path
+
+            return blob_path(self._blob_dir, self["stdout_blob"])
         out_name = self["stdout"]
         stdout_path = self._out_path(out_name)
         return stdout_path
 
     def _stderr_path(self):
+        if "stderr_blob" in self:
+            from .blob_store import blob_path
+
+            return blob_path(self._blob_dir, self["stderr_blob"])
         out_name = self["stderr"]
         stderr_path = self._out_path(out_name)
         return stderr_path
 
+    def _timing_path(self):
+        if "timing_blob" in self:
+            from .blob_store import blob_path
+
+            return blob_path(self._blob_dir, self["timing_blob"])
+        timing_path = self._out_path(self["timing"])
+        return timing_path
+
+    def read_timing(self) -> Optional["OutputTiming"]:
+        """
+        The response's recorded output timing, or None if it was recorded without timing
+        """
+        if "timing" not in self:
+            return None
+        from .timing import OutputTiming, OutputTimingException
+
+        try:
+            if self._archive is not None:
+                timing = OutputTiming.from_bytes(
+                    self._archive.read_blob(self["timing_blob"]))
+            else:
+                timing = OutputTiming.from_file(self._timing_path())
+        except OutputTimingException as e:
+            raise ResponseReadException(str(e)) from e
+        return timing
+
+    def open_interleaved_output(self) -> BinaryIO:
+        """
+        Open the response's standard output and standard error as a single stream,
+        interleaved as they were recorded. If the order wasn't recorded,
+        all of standard output comes first
+        """
+        timing = self.read_timing()
+        output = self.open_output()
+        try:
+            error_output = self.open_error_output()
+        except BaseException:
+            output.close()
+            raise
+        if timing is None:
+            from .timing import OutputTiming
+
+            timing = OutputTiming(start_ns=0)
+        from .timing import interleaved_reader
+
+        return interleaved_reader(timing, output, error_output)
+
+    def open_output(self) -> BinaryIO:
+        """
+        Open the response's standard output for reading as a stream,
+        rather than reading it into memory all at once
+        """
+        if self._output is not None:
+            return io.BytesIO(self._output)
+        if self._archive is not None:
+            return self._open_archived(self["stdout_blob"], self.get("stdout_codec"))
+        return self._open_recorded(self._stdout_path(), self.get("stdout_codec"))
+
+    def open_error_output(self) -> BinaryIO:
+        """
+        Open the response's standard error for reading as a stream,
+        rather than reading it into memory all at once
+        """
+        if self._error_output is not None:
+            return io.BytesIO(self._error_output)
+        if self._archive is not None:
+            return self._open_archived(self["stderr_blob"], self.get("stderr_codec"))
+        return self._open_recorded(self._stderr_path(), self.get("stderr_codec"))
+
+    def map_output(self) -> "MappedOutput":
+        """
+        Access the response's standard output as a read-only memoryview, without copying it
+
+        Uncompressed recorded output is memory-mapped from its file. Output that's
+        compressed, or stored in a response archive, is read into memory. Output that
+        hasn't been recorded yet, such as a stream or an iterable of chunks, is read
+        into memory and kept there, so it can still be recorded afterward.
+        Close the returned MappedOutput when done with it, or use it as a context manager:
+
+            with response.map_output() as view:
+                ...
+        """
+        if self._output is not None:
+            self._output = self._unrecorded_bytes(self._output)
+        return self._map_recorded(self._output, self._stdout_path,
+                                  self.get("stdout_codec"), self.open_output)
+
+    def map_error_output(self) -> "MappedOutput":
+        """
+        Access the response's standard error as a read-only memoryview, without copying it.
+        See map_output()
+        """
+        if self._error_output is not None:
+            self._error_output = self._unrecorded_bytes(self._error_output)
+        return self._map_recorded(self._error_output, self._stderr_path,
+                                  self.get("stderr_codec"), self.open_error_output)
+
+    @staticmethod
+    def _unrecorded_bytes(source: "OutputSource") -> bytes:
+        if isinstance(source, bytes):
+            return source
+        from .stream_io import iter_chunks
+
+        # a stream can only be read once, so the caller keeps the bytes in its place
+        return b"".join(iter_chunks(source))
+
+    def _map_recorded(self, data, recorded_path, codec, open_output) -> "MappedOutput":
+        from .mapped_output import MappedOutput, map_file
+
+        if data is None and self._archive is None and not codec:
+            return map_file(recorded_path())
+        if data is None:
+            with open_output() as f:
+                data = f.read()
+        return MappedOutput(memoryview(data).toreadonly())
+
+    def _open_recorded(self, path, codec) -> BinaryIO:
+        if self._cache is not None:
+            data = self._cache.get_output(
+                path, lambda: self._open_decompressed(path, codec))
+            if data is not None:
+                return io.BytesIO(data)
+        return self._open_decompressed(path, codec)
+
+    def _open_archived(self, digest, codec) -> BinaryIO:
+        from .archive import ResponseArchiveException
+
+        try:
+            stream = self._archive.open_blob(digest)
+        except ResponseArchiveException as e:
+            raise ResponseReadException(str(e)) from e
+        return self._open_decompressed(stream, codec)
+
+    def _open_decompressed(self, path, codec):
+        from .compression import CompressionCodecException, open_decompressed
+
+        try:
+            stream = open_decompressed(path, codec)
+        except CompressionCodecException as e:
+            raise ResponseReadException(str(e)) from e
+        return stream
+
     def _read_output(self):
-        stdout_path = self._stdout_path()
-        output = open(stdout_path, "rb").read()
+        with self.open_output() as f:
+            output = f.read()
         return output
 
     def _read_error_output(self):
-        stder_path = self._stderr_path()
-        output = open(stder_path, "rb").read()
+        with self.open_error_output() as f:
+            output = f.read()
         return output
 
 
 class CommandInvocation(dict):
     def __init__(self,
                  cmd_args: List[str],
-                 output: bytes,
-                 error_output: bytes,
-                 returncode: int,
+                 output: "OutputSource",
+                 error_output: "OutputSource",
+                 returncode: Union[int, Callable[[], int], "subprocess.Popen"],
                  invocation_name: str,
                  changes_state: bool,
-                 input: Optional[bytes] = None):
+                 input: Optional["OutputSource"] = None,
+                 input_hash_algorithm: str = DEFAULT_INPUT_HASH_ALGORITHM,
+                 record_timing: bool = False,
+                 timing_start_ns: Optional[int] = None,
+                 record_interleaving: bool = False,
+                 timing: Optional["OutputTiming"] = None):
         _dict = {"args": cmd_args}
+        # output from a running process's pipes must be drained before it can be waited on,
+        # so a Popen, or a callable like its wait method, is called once the output is recorded
+        wait = None
+        if hasattr(returncode, "wait"):
+            returncode = returncode.wait
+        if callable(returncode):
+            wait = returncode
+            returncode = None
+        elif returncode is None:
+            raise ResponseRecordException("Missing exit status")
         response_dict = {}
         response_dict["exit_status"] = returncode
         stdout_name = "output"
         stderr_name = "error_output"
 
-        # returns None if input is None
-        # converts input to bytes if input is a string
-        input_hash = digest_input(input)
         response_dict["stdout"] = stdout_name
         response_dict["stderr"] = stderr_name
         response_dict["name"] = invocation_name
         response_dict["changes_state"] = changes_state
+        # if record_timing is set, note when each chunk of output is read while recording
+        # timing_start_ns is time.monotonic_ns() when the command was started
+        # if only record_interleaving is set, just note the order of stdout & stderr output
+        # timing is output timing that was already noted (and finished) while output was spooled
         cmd_response = CommandResponse(
             response_dict, None, output=output,
-            error_output=error_output)
-        _dict["input_hash"] = input_hash
+            error_output=error_output, record_timing=record_timing,
+            timing_start_ns=timing_start_ns, record_interleaving=record_interleaving,
+            timing=timing, wait=wait)
+        # set below, once the input has been hashed
+        _dict["input_hash"] = None
         _dict["response"] = cmd_response
         super().__init__(_dict)
-        self._input = input
+        self._input_hash_algorithm = input_hash_algorithm
+        # only needed when recording
+        from .stream_io import is_stream
+
+        if input is not None and is_stream(input):
+            # streamed input is hashed as it's spooled, so it's only read once
+            self._input, input_hash = self._spool_input(input, input_hash_algorithm)
+        else:
+            self._input = input
+            # returns None if input is None or empty
+            input_hash = digest_input(input, input_hash_algorithm)
+        self["input_hash"] = input_hash
 
     @property
     def cmd_args(self):
@@ -151,29 +493,83 @@ class CommandInvocation(dict):
     def input_hash(self) -> Optional[str]:
         return self["input_hash"]
 
+    @property
+    def input_hash_algorithm(self) -> str:
+        return self._input_hash_algorithm
+
+    def hash_input(self, algorithm: str):
+        """
+        Re-hash the invocation's input with a different algorithm,
+        e.g., the one used by the response directory it's being added to
+        """
+        if algorithm == self._input_hash_algorithm:
+            return
+        self["input_hash"] = digest_input(self._rewound_input(), algorithm)
+        self._input_hash_algorithm = algorithm
+
     def record_input(self, input_path):
-        if input_path and self._input:
+        if input_path and self.input_hash:
             input_path = Path(input_path, self.input_hash)
             input_path.mkdir(parents=True, exist_ok=True)
             input_path = Path(input_path, "input.bin")
-            input = self._input
-            if isinstance(input, str):
-                input = input.encode()
-            with open(input_path, "wb") as f:
-                f.write(input)
+            from .stream_io import write_to_path
+
+            write_to_path(input_path, self._rewound_input())
+
+    def _rewound_input(self) -> Optional["OutputSource"]:
+        from .stream_io import is_stream
+
+        input = self._input
+        if input is not None and is_stream(input):
+            input.seek(0)
+        return input
+
+    @staticmethod
+    def _spool_input(input: "OutputSource", algorithm: str):
+        # kept in memory unless it's large, and then spilled to a temporary file
+        import tempfile
+
+        from .stream_io import CHUNK_SIZE, iter_chunks
+
+        spooled = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+        hasher = None
+        for chunk in iter_chunks(input):
+            if hasher is None:
+                hasher = new_input_hasher(algorithm)
+            hasher.update(chunk)
+            spooled.write(chunk)
+        input_hash = None
+        if hasher is not None:
+            input_hash = hasher.hexdigest()
+        return spooled, input_hash
 
 
 class ResponseDirectory:
     default_directory = {
         "meta": {
             "response_dir": "responses",
-            "input_dir": "input"
+            "input_dir": "input",
+            "arg_key_version": ARG_KEY_VERSION
         },
         "commands": {},
-        "commands_with_input": {}
+        "commands_with_input": {},
+        "command_patterns": []
     }
 
-    def __init__(self, responsedir_json_file, create=False, response_dir=None, input_dir=None):
+    def __init__(self,
+                 responsedir_json_file,
+                 create=False,
+                 response_dir=None,
+                 input_dir=None,
+                 use_index=False,
+                 blob_dir=None,
+                 compression: Optional[str] = None,
+                 compression_threshold: Optional[int] = None,
+                 journal: bool = False,
+                 input_hash_algorithm: Optional[str] = None,
+                 arg_digest_threshold: Optional[int] = None,
+                 cache: Optional["ResponseCache"] = None,
+                 index=None):
         if isinstance(responsedir_json_file, str):
             responsedir_json_file = Path(responsedir_json_file)
         dpath_base = responsedir_json_file.name
@@ -185,35 +581,208 @@ class ResponseDirectory:
         if input_dir:
             self._input_dir = Path(input_dir)
         self._response_responsedir_json_filename = responsedir_json_file
-        self._response_directory: Dict = self._load_or_create_directory(
-            responsedir_json_file, create, response_dir)
+        self._create = create
+        self._create_response_dir = response_dir
+        self._create_blob_dir = blob_dir
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._journal = journal
+        self._create_input_hash_algorithm = input_hash_algorithm
+        self._create_arg_digest_threshold = arg_digest_threshold
+        # holds recorded output read back during lookups
+        self._cache = cache
+        self._journal_pending = []
+        self._loaded_directory: Optional[Dict] = None
+        self._index: Optional["ResponseIndex"] = None
+        self._archive: Optional["ResponseArchive"] = None
+        # compiled the first time a lookup has no exact match
+        self._pattern_matcher: Optional["ArgPatternMatcher"] = None
+        from .archive import is_archive
+
+        if is_archive(responsedir_json_file):
+            self._archive = self._load_archive(responsedir_json_file)
+            # an archive is already indexed, and answers lookups the same way
+            self._index = self._archive
+        elif index is not None:
+            # e.g., the directory's part of a state bundle
+            self._index = index
+        elif use_index:
+            self._index = self._load_index(responsedir_json_file)
+        if self._index is None:
+            self._loaded_directory = self._load_or_create_directory(
+                responsedir_json_file, create, response_dir)
+
+    @property
+    def _response_directory(self) -> Dict:
+        # When an index is in use, the full directory is only parsed
+        # if something needs more than a single lookup
+        if self._loaded_directory is None:
+            if self._archive is not None:
+                self._loaded_directory = self._archive.load_directory()
+            else:
+                self._loaded_directory = self._load_or_create_directory(
+                    self._response_responsedir_json_filename, self._create, self._create_response_dir)
+        return self._loaded_directory
+
+    def _load_archive(self, archive_path) -> "ResponseArchive":
+        from .archive import ResponseArchive, ResponseArchiveException
+
+        try:
+            archive = ResponseArchive(archive_path)
+        except ResponseArchiveException as e:
+            raise ResponseDirectoryException(str(e)) from e
+        return archive
+
+    def _load_index(self, responsedir_json_file) -> Optional["ResponseIndex"]:
+        from .response_index import ResponseIndex, ResponseIndexException
+
+        try:
+            index = ResponseIndex.for_directory(responsedir_json_file)
+        except (OSError, ValueError, ResponseIndexException):
+            # missing or unparseable directory, or we can't write the index
+            # fall back to loading the JSON directly
+            index = None
+        return index
 
     def _load_or_create_directory(self, responsedir_json_file, create, response_dir):
         try:
             directory = json.load(open(responsedir_json_file, "r"))
             directory_missing = False
+            from .journal import apply_entries, journal_path_for, read_entries
+
+            # responses saved since the directory was last compacted
+            apply_entries(directory, read_entries(
+                journal_path_for(responsedir_json_file)))
         except (FileNotFoundError, json.JSONDecodeError) as e:
             directory_missing = True
             if not create:
                 raise ResponseDirectoryException(
                     f"Directory path not found {responsedir_json_file}") from e
             else:
-                directory = self.default_directory
+                # copy so we don't modify the class's default directory
+                import copy
+
+                directory = copy.deepcopy(self.default_directory)
                 if response_dir:
-                    if isinstance(response_dir, Path):
-                        response_dir = str(response_dir)
-                    directory["meta"]["response_dir"] = response_dir
+                    directory["meta"]["response_dir"] = path_to_save(
+                        response_dir, responsedir_json_file)
+                if self._create_blob_dir:
+                    directory["meta"]["blob_dir"] = path_to_save(
+                        self._create_blob_dir, responsedir_json_file)
+                if self._compression:
+                    directory["meta"]["compression"] = self._compression
+                if self._compression_threshold is not None:
+                    directory["meta"]["compression_threshold"] = self._compression_threshold
+                if self._create_input_hash_algorithm:
+                    directory["meta"]["input_hash_algorithm"] = self._create_input_hash_algorithm
+                if self._create_arg_digest_threshold is not None:
+                    directory["meta"]["arg_digest_threshold"] = self._create_arg_digest_threshold
 
         if directory_missing and create:
             self._save_to_disk(responsedir_json_file, directory)
         return directory
 
     @property
-    def response_dir(self):
-        meta = self._response_directory["meta"]
-        response_dir = meta["response_dir"]
+    def meta(self) -> Dict:
+        if self._loaded_directory is None and self._index is not None:
+            meta = self._index.meta
+        else:
+            meta = self._response_directory["meta"]
+        return meta
+
+    @property
+    def archive(self) -> Optional["ResponseArchive"]:
+        """
+        The response archive this directory was loaded from, or None if it's a JSON file
+        """
+        return self._archive
+
+    @property
+    def response_dir(self) -> str:
+        """
+        The directory per-invocation output is recorded in.
+        A relative "response_dir" is relative to the directory JSON file
+        """
+        response_dir = self.resolve_meta_path(self.meta["response_dir"])
         return response_dir
 
+    @property
+    def blob_dir(self) -> Optional[str]:
+        """
+        The content-addressed blob store responses are recorded in,
+        or None if responses are recorded in per-invocation directories
+        """
+        blob_dir = self.meta.get("blob_dir")
+        if blob_dir:
+            blob_dir = self.resolve_meta_path(blob_dir)
+        return blob_dir
+
+    def resolve_meta_path(self, path) -> str:
+        """
+        Resolve a path saved in this directory's meta, relative to the directory JSON file,
+        so playback finds the same files no matter the working directory
+        """
+        return resolve_saved_path(path, self._response_responsedir_json_filename)
+
+    @property
+    def compression(self) -> Optional[str]:
+        """
+        The codec new responses are compressed with, if they're at least
+        compression_threshold bytes. Defaults to the codec saved in the directory, if any
+        """
+        compression = self._compression
+        if compression is None:
+            compression = self.meta.get("compression")
+        return compression
+
+    @property
+    def compression_threshold(self) -> int:
+        threshold = self._compression_threshold
+        if threshold is None:
+            threshold = self.meta.get(
+                "compression_threshold", _DEFAULT_COMPRESSION_THRESHOLD)
+        return threshold
+
+    @property
+    def input_hash_algorithm(self) -> str:
+        """
+        The algorithm input is hashed with to look up commands_with_input.
+        Directories that don't specify one use md5
+        """
+        algorithm = self.meta.get(
+            "input_hash_algorithm", DEFAULT_INPUT_HASH_ALGORITHM)
+        return algorithm
+
+    @property
+    def arg_key_version(self) -> int:
+        """
+        How commands' arguments are encoded as keys. Directories that don't specify
+        a version join arguments with "|"
+        """
+        version = self.meta.get("arg_key_version", ARG_KEY_VERSION_LEGACY)
+        return version
+
+    @property
+    def arg_digest_threshold(self) -> int:
+        threshold = self.meta.get(
+            "arg_digest_threshold", DEFAULT_ARG_DIGEST_THRESHOLD)
+        return threshold
+
+    def arg_key(self, args) -> str:
+        """
+        Encode args the way this directory's commands are keyed
+        """
+        try:
+            arg_string = argv_to_key(args, version=self.arg_key_version,
+                                     digest_threshold=self.arg_digest_threshold)
+        except ArgKeyException as e:
+            raise ResponseDirectoryException(str(e)) from e
+        return arg_string
+
+    def set_blob_dir(self, blob_dir):
+        self._response_directory["meta"]["blob_dir"] = path_to_save(
+            blob_dir, self._response_responsedir_json_filename)
+
     @property
     def commands(self):
         return self._response_directory["commands"]
@@ -222,47 +791,256 @@ class ResponseDirectory:
     def commands_with_input(self):
         return self._response_directory["commands_with_input"]
 
-    def response_lookup(self, args, input=None) -> CommandResponse:
-        input_hash = digest_input(input)
-        arg_string = argv_to_string(args)
-        try:
-            commands = self.commands
-            if input_hash:
-                commands = self.commands_with_input
-                commands = commands[input_hash]
-
-            response_dict = commands[arg_string]
-        except KeyError:
-            escaped_arg_str = arg_shlex_from_string(arg_string)
+    @property
+    def command_patterns(self) -> List[Dict]:
+        """
+        Responses registered under argument patterns rather than exact arguments
+        """
+        if self._loaded_directory is None and self._index is not None:
+            command_patterns = self._index.command_patterns
+        else:
+            # older directories may not have a "command_patterns" section
+            command_patterns = self._response_directory.get(
+                "command_patterns", [])
+        return command_patterns
+
+    def hash_input(self, input) -> Optional[str]:
+        """
+        Hash input the way this directory's commands_with_input are keyed
+        """
+        input_hash = digest_input(input, self.input_hash_algorithm)
+        return input_hash
+
+    def response_lookup(self, args, input=None, input_hash: Optional[str] = None) -> CommandResponse:
+        # input may be hashed ahead of time with hash_input()
+        if input_hash is None:
+            input_hash = self.hash_input(input)
+        arg_string = self.arg_key(args)
+        response_dict = self._lookup_response_dict(input_hash, arg_string)
+        if response_dict is None:
+            # exact matches take priority over patterns
+            response_dict = self._match_arg_patterns(input_hash, args)
+        if response_dict is None:
+            escaped_arg_str = argv_to_shlex(args)
             raise ResponseLookupException(
                 "No response for command args: {}".format(escaped_arg_str))
 
-        response = CommandResponse(response_dict, self.response_dir)
+        response = CommandResponse(
+            response_dict, self.response_dir, blob_dir=self.blob_dir, cache=self._cache,
+            archive=self._archive)
         return response
 
+    def iter_response_dicts(self):
+        """
+        Iterate over every response dictionary in the directory, with or without input
+        """
+        for response_dict in self.commands.values():
+            yield response_dict
+        # older directories may not have a "commands_with_input" section
+        commands_with_input = self._response_directory.get(
+            "commands_with_input", {})
+        for commands in commands_with_input.values():
+            for response_dict in commands.values():
+                yield response_dict
+        for entry in self._response_directory.get("command_patterns", []):
+            yield entry["response"]
+
+    def _lookup_response_dict(self, input_hash, arg_string) -> Optional[Dict]:
+        if self._loaded_directory is None and self._index is not None:
+            response_dict = self._index.lookup(input_hash, arg_string)
+        else:
+            try:
+                commands = self.commands
+                if input_hash:
+                    commands = self.commands_with_input
+                    commands = commands[input_hash]
+
+                response_dict = commands[arg_string]
+            except KeyError:
+                response_dict = None
+        return response_dict
+
+    def _match_arg_patterns(self, input_hash, args) -> Optional[Dict]:
+        if self._pattern_matcher is None:
+            command_patterns = self.command_patterns
+            if not command_patterns:
+                return None
+            from .arg_patterns import ArgPatternMatcher
+
+            self._pattern_matcher = ArgPatternMatcher(command_patterns)
+        response_dict = self._pattern_matcher.match(input_hash, list(args))
+        return response_dict
+
+    def save(self):
+        """
+        Save the response directory to disk
+
+        If the directory was opened with journal=True, only responses added since
+        the last save are written, appended to a journal file next to the directory JSON file.
+        Otherwise the directory JSON file is rewritten, folding in any journal
+        """
+        self._check_writable()
+        if self._journal:
+            from .journal import append_entries, journal_path_for
+
+            journal_path = journal_path_for(
+                self._response_responsedir_json_filename)
+            append_entries(journal_path, self._journal_pending)
+            self._journal_pending = []
+        else:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the response directory JSON file with all saved and unsaved responses,
+        and remove the journal
+        """
+        self._check_writable()
+        self._save_to_disk(
+            self._response_responsedir_json_filename, self._response_directory)
+        # the JSON file now has everything the journal has, so if we crash here
+        # replaying the journal on the next load is harmless
+        from .journal import journal_path_for
+
+        journal_path = journal_path_for(self._response_responsedir_json_filename)
+        try:
+            journal_path.unlink()
+        except FileNotFoundError:
+            pass
+        self._journal_pending = []
+
+    def _check_writable(self):
+        if self._archive is not None:
+            raise ResponseDirectoryException(
+                f"Response archives are read-only: {self._archive.archive_path}")
+
     def _save_to_disk(self, responsedir_json_filename, directory):
-        with open(responsedir_json_filename, "w") as f:
-            json.dump(directory, f, indent=2)
+        # write to a temporary file and rename it into place
+        # so a crash mid-save can't leave a truncated directory behind
+        from .file_util import atomic_write_json
 
-    def add_command_invocation(self, cmd: CommandInvocation, overwrite=False, save=False):
-        cmd_args = cmd.cmd_args
-        arg_string = argv_to_string(cmd_args)
-        if cmd.input_hash:
+        atomic_write_json(responsedir_json_filename, directory, indent=2)
+
+    def _commands_for_input_hash(self, input_hash: Optional[str]) -> Dict:
+        if input_hash:
             # get the "command with input" dict
             commands: Dict = self._response_directory.setdefault(
                 "commands_with_input", {})
             # then get the command dict for this specific input hash, or set an
             # empty dict if it wasn't already there
-            commands = commands.setdefault(cmd.input_hash, {})
+            commands = commands.setdefault(input_hash, {})
         else:
             commands: Dict = self._response_directory["commands"]
+        return commands
+
+    def _check_can_add(self, cmd_args, input_hash: Optional[str], overwrite: bool,
+                       arg_pattern: Optional["ArgPattern"] = None):
+        if self._archive is not None:
+            raise ResponseAddException(
+                f"Response archives are read-only: {self._archive.archive_path}")
+        if arg_pattern is not None:
+            self._check_can_add_pattern(
+                cmd_args, input_hash, overwrite, arg_pattern)
+            return
+        arg_string = self.arg_key(cmd_args)
+        # look up without setdefault(), so a failed check doesn't leave
+        # an empty commands_with_input entry behind to be saved
+        if input_hash:
+            commands = self._response_directory.get(
+                "commands_with_input", {}).get(input_hash, {})
+        else:
+            commands = self._response_directory["commands"]
         if arg_string in commands and overwrite is False:
             raise ResponseAddException(
                 f"Response already registered for command: '{cmd_args}'")
+
+    def _check_can_add_pattern(self, cmd_args, input_hash: Optional[str], overwrite: bool,
+                               arg_pattern: "ArgPattern"):
+        from .arg_patterns import (
+            ArgPatternException,
+            ArgPatternMatcher,
+            pattern_entry
+        )
+
+        try:
+            entry = pattern_entry(input_hash, arg_pattern, {})
+        except ArgPatternException as e:
+            raise ResponseAddException(str(e)) from e
+        # the recorded command should be an example of the pattern
+        if ArgPatternMatcher([entry]).match(input_hash, list(cmd_args)) is None:
+            raise ResponseAddException(
+                f"Argument pattern {arg_pattern} doesn't match command: '{cmd_args}'")
+        if overwrite is False:
+            for existing in self._response_directory.get("command_patterns", []):
+                if existing["args"] == entry["args"] and existing.get("input_hash") == input_hash:
+                    raise ResponseAddException(
+                        f"Response already registered for argument pattern: {arg_pattern}")
+
+    def _record_invocation(self, cmd: CommandInvocation):
+        # write the invocation's input & output to disk without registering it
+        # this doesn't touch the directory dictionary, so it's safe to do concurrently
         cmd.record_input(self._input_dir)
         response: CommandResponse = cmd.response
-        response.record_response(self.response_dir)
-        commands[arg_string] = dict(response)
+        response.record_response(self.response_dir,
+                                 blob_dir=self.blob_dir,
+                                 compression=self.compression,
+                                 compression_threshold=self.compression_threshold)
+
+    def _register_invocation(self, cmd: CommandInvocation, arg_pattern: Optional["ArgPattern"] = None):
+        if arg_pattern is not None:
+            self._register_pattern(cmd, arg_pattern)
+            return
+        arg_string = self.arg_key(cmd.cmd_args)
+        commands = self._commands_for_input_hash(cmd.input_hash)
+        from .journal import journal_entry
+
+        response_dict = dict(cmd.response)
+        commands[arg_string] = response_dict
+        self._journal_pending.append(
+            journal_entry(cmd.input_hash, arg_string, response_dict))
+
+    def _register_pattern(self, cmd: CommandInvocation, arg_pattern: "ArgPattern"):
+        from .arg_patterns import add_pattern_entry, pattern_entry
+        from .journal import pattern_journal_entry
+
+        response_dict = dict(cmd.response)
+        entry = pattern_entry(cmd.input_hash, arg_pattern, response_dict)
+        command_patterns = self._response_directory.setdefault(
+            "command_patterns", [])
+        add_pattern_entry(command_patterns, entry)
+        # recompile on the next lookup that needs it
+        self._pattern_matcher = None
+        self._journal_pending.append(
+            pattern_journal_entry(cmd.input_hash, entry["args"], response_dict))
+
+    def add_command_invocation(self, cmd: CommandInvocation, overwrite=False, save=False,
+                               arg_pattern: Optional["ArgPattern"] = None):
+        """
+        Record a command invocation's output and register its response
+
+        Parameters
+        ----------
+        cmd : CommandInvocation
+            The invocation to add
+        overwrite : bool, optional
+            Replace a response already registered for the same arguments, by default False
+        save : bool, optional
+            Save the directory after adding the response, by default False
+        arg_pattern : Optional[ArgPattern], optional
+            Register the response under an argument pattern rather than cmd's exact arguments,
+            e.g., ["--log", {"placeholder": "log-path"}, {"regex": "--id=[0-9a-f-]+"}].
+            cmd's arguments must match the pattern
+
+        Raises
+        ------
+        ResponseAddException
+            If a response is already registered (and overwrite is False),
+            or arg_pattern is invalid or doesn't match cmd's arguments
+        """
+        cmd.hash_input(self.input_hash_algorithm)
+        self._check_can_add(cmd.cmd_args, cmd.input_hash,
+                            overwrite, arg_pattern=arg_pattern)
+        self._record_invocation(cmd)
+        self._register_invocation(cmd, arg_pattern=arg_pattern)
         if save:
-            self._save_to_disk(
-                self._response_responsedir_json_filename, self._response_directory)
+            self.save()
@@ -0,0 +1,186 @@
+import argparse
+import os
+import signal
+import socketserver
+import sys
+import traceback
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .journal import directory_file_state
+from .mock_cmd import MockCommand
+from .playback import RESPONSE_DIR_ENV_NAME
+from .responses import ResponseDirectory
+from .server_protocol import (
+    SOCKET_ENV_NAME,
+    recv_exactly,
+    recv_request,
+    send_message
+)
+
+
+class ResponseDirectoryCache:
+    """
+    Keeps loaded response directories around between requests,
+    reloading any whose JSON file has changed on disk
+    """
+
+    def __init__(self, use_index=False):
+        self._use_index = use_index
+        self._directories = {}
+
+    def get(self, response_directory_path) -> ResponseDirectory:
+        path = Path(response_directory_path).resolve()
+        try:
+            file_key = directory_file_state(path)
+        except OSError:
+            # let ResponseDirectory raise the appropriate exception
+            return ResponseDirectory(path, use_index=self._use_index)
+
+        cached = self._directories.get(path)
+        if cached is not None and cached[0] == file_key:
+            directory = cached[1]
+        else:
+            directory = ResponseDirectory(path, use_index=self._use_index)
+            self._directories[path] = (file_key, directory)
+        return directory
+
+
+class _ServerMockCommand(MockCommand):
+    def __init__(self, directory_cache: ResponseDirectoryCache, response_directory=None, state_dir=None):
+        self._directory_cache = directory_cache
+        super().__init__(response_directory=response_directory, state_dir=state_dir)
+
+    def _load_response_directory(self, response_directory_path) -> ResponseDirectory:
+        return self._directory_cache.get(response_directory_path)
+
+
+class _MockCommandRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        request, fds = recv_request(self.request)
+        try:
+            input = None
+            input_len = request["input_len"]
+            if input_len >= 0:
+                input = recv_exactly(self.request, input_len)
+            reply = self.server.run_request(request, input, fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        send_message(self.request, reply)
+
+
+class MockCommandServer(socketserver.UnixStreamServer):
+    """
+    A long-lived server that plays back mock command responses on behalf of
+    the client shim, keeping response directories loaded between invocations
+
+    Requests are handled one at a time, so state iterations happen in the
+    same order they would if each invocation were a separate process.
+    A client that's slow to read its output holds up every other client until
+    its response has been written, see ForkingMockCommandServer
+
+    The mock command state config is re-read for every request, so changes
+    made by other processes are seen. For large state configs, compile a state bundle
+    """
+
+    def __init__(self, socket_path, response_directory=None, use_index=False):
+        self._response_directory = response_directory
+        self._directory_cache = ResponseDirectoryCache(use_index=use_index)
+        super().__init__(str(socket_path), _MockCommandRequestHandler)
+
+    def run_request(self, request: Dict, input: Optional[bytes], fds: List[int]) -> Dict:
+        saved_env = dict(os.environ)
+        saved_cwd = os.getcwd()
+        cmd = None
+        stdout = os.fdopen(fds[0], "wb", closefd=False)
+        stderr = os.fdopen(fds[1], "wb", closefd=False)
+        try:
+            # run with the client's environment & working directory so
+            # state directories and relative paths resolve the way they
+            # would if the mock were its own process
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+
+            response_directory = os.environ.get(
+                RESPONSE_DIR_ENV_NAME, self._response_directory)
+            cmd = _ServerMockCommand(
+                self._directory_cache, response_directory=response_directory)
+            exit_status = cmd.respond(
+                request["args"], input=input, stdout=stdout, stderr=stderr)
+            reply = {"exit_status": exit_status}
+        except Exception:
+            reply = {"error": traceback.format_exc()}
+        finally:
+            if cmd is not None:
+                cmd.close()
+            stdout.close()
+            stderr.close()
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+        return reply
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+class ForkingMockCommandServer(socketserver.ForkingMixIn, MockCommandServer):
+    """
+    A MockCommandServer that handles each request in a forked child process,
+    so a slow client doesn't hold up the others
+
+    Response directories loaded by a child aren't kept for later requests,
+    so the default response directory is loaded up front for children to inherit.
+    Concurrent requests advance the state in whatever order they arrive
+    """
+
+    def __init__(self, socket_path, response_directory=None, use_index=False):
+        super().__init__(socket_path, response_directory=response_directory, use_index=use_index)
+        if response_directory is not None and os.path.exists(response_directory):
+            self._directory_cache.get(response_directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play back mock command responses over a Unix socket")
+    parser.add_argument("socket_path", nargs="?", default=os.environ.get(SOCKET_ENV_NAME),
+                        help=f"Path to the Unix socket to listen on. Defaults to ${SOCKET_ENV_NAME}")
+    parser.add_argument("--response-directory",
+                        help="Default response directory JSON file, if not provided by the client or a state directory")
+    parser.add_argument("--use-index", action="store_true",
+                        help="Load response directories using a compiled index")
+    parser.add_argument("--fork", action="store_true",
+                        help="Handle each request in a forked process, so slow clients don't block the others")
+    parsed = parser.parse_args()
+    if not parsed.socket_path:
+        parser.error("No socket path provided")
+
+    # clean up after a previous server that didn't exit cleanly
+    if os.path.exists(parsed.socket_path):
+        os.unlink(parsed.socket_path)
+
+    server_class = MockCommandServer
+    if parsed.fork:
+        server_class = ForkingMockCommandServer
+    server = server_class(parsed.socket_path,
+                          response_directory=parsed.response_directory,
+                          use_index=parsed.use_index)
+    # exit via SystemExit on SIGTERM so the socket gets cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
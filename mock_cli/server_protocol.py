@@ -0,0 +1,81 @@
+import array
+import json
+import socket
+import struct
+from typing import Dict, List, Tuple
+
+# Wire protocol between the playback server and its client shim:
+#
+# client -> server:
+#   u32 length of the JSON request, sent along with the client's
+#   stdout & stderr file descriptors (SCM_RIGHTS)
+#   the JSON request
+#   "input_len" bytes of standard input, if "input_len" is non-negative
+#
+# server -> client:
+#   u32 length of the JSON reply
+#   the JSON reply, containing either "exit_status" or "error"
+
+SOCKET_ENV_NAME = "MOCK_CLI_SERVER_SOCKET"
+
+_LENGTH = struct.Struct("<I")
+_FD_COUNT = 2
+
+
+class MockCLIProtocolException(Exception):
+    pass
+
+
+def recv_exactly(sock: socket.socket, length: int) -> bytes:
+    chunks = []
+    remaining = length
+    while remaining:
+        chunk = sock.recv(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise MockCLIProtocolException("Connection closed mid-message")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock: socket.socket, message: Dict):
+    data = json.dumps(message).encode()
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def recv_message(sock: socket.socket) -> Dict:
+    (length,) = _LENGTH.unpack(recv_exactly(sock, _LENGTH.size))
+    data = recv_exactly(sock, length)
+    return json.loads(data)
+
+
+def send_request(sock: socket.socket, request: Dict, fds: List[int]):
+    data = json.dumps(request).encode()
+    fd_array = array.array("i", fds)
+    sock.sendmsg([_LENGTH.pack(len(data))],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fd_array)])
+    sock.sendall(data)
+
+
+def recv_request(sock: socket.socket) -> Tuple[Dict, List[int]]:
+    fd_array = array.array("i")
+    msg, ancdata, _, _ = sock.recvmsg(
+        _LENGTH.size, socket.CMSG_SPACE(_FD_COUNT * fd_array.itemsize))
+    for level, msg_type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and msg_type == socket.SCM_RIGHTS:
+            usable_len = len(cmsg_data) - (len(cmsg_data) % fd_array.itemsize)
+            fd_array.frombytes(cmsg_data[:usable_len])
+    fds = list(fd_array)
+    try:
+        if len(fds) != _FD_COUNT:
+            raise MockCLIProtocolException(
+                f"Expected {_FD_COUNT} file descriptors, got {len(fds)}")
+        if len(msg) < _LENGTH.size:
+            msg += recv_exactly(sock, _LENGTH.size - len(msg))
+        (length,) = _LENGTH.unpack(msg)
+        request = json.loads(recv_exactly(sock, length))
+    except BaseException:
+        for fd in fds:
+            socket.close(fd)
+        raise
+    return request, fds
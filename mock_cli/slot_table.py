@@ -0,0 +1,99 @@
+import json
+import struct
+from typing import Dict, List, Optional, Tuple
+
+# An open-addressed hash table of JSON-encoded records, for files that are memory-mapped
+# and looked up in place, e.g., response indexes and state bundles
+#
+# Layout (all integers little-endian):
+#   records: key length (u32), key bytes, JSON-encoded value
+#   slots:   (key hash, record offset, record length) for each slot,
+#            where an offset of 0 marks an empty slot, so records can't start at offset 0
+SLOT = struct.Struct("<QQQ")
+_KEY_LEN = struct.Struct("<I")
+_EMPTY_SLOT = (0, 0, 0)
+
+Slot = Tuple[int, int, int]
+
+
+def encode_key(text: str) -> bytes:
+    # sys.argv may contain surrogate-escaped bytes, which json tolerates
+    # so we need to tolerate them as well
+    return text.encode("utf-8", "surrogatepass")
+
+
+def entry_key(input_hash: Optional[str], arg_string: str) -> bytes:
+    if input_hash is None:
+        input_hash = ""
+    return encode_key("\x00".join([input_hash, arg_string]))
+
+
+def pack_record(key: bytes, value) -> bytes:
+    record = _KEY_LEN.pack(len(key)) + key + json.dumps(value).encode()
+    return record
+
+
+def build_slots(records: List[Tuple[int, bytes]], records_offset: int) -> Tuple[List[Slot], int]:
+    """
+    Lay out a hash table for records, which will be written starting at records_offset
+
+    Parameters
+    ----------
+    records : List[Tuple[int, bytes]]
+        Each record's key hash and packed record, from pack_record()
+    records_offset : int
+        The file offset the first record will be written at
+
+    Returns
+    -------
+    Tuple[List[Slot], int]
+        The slots, and the file offset they'll be written at, right after the records
+    """
+    # keep the load factor at or below 50% so probe sequences stay short
+    slot_count = 1
+    while slot_count < 2 * len(records):
+        slot_count <<= 1
+    slots = [_EMPTY_SLOT] * slot_count
+    offset = records_offset
+    for key_hash, record in records:
+        slot_num = key_hash & (slot_count - 1)
+        while slots[slot_num] is not _EMPTY_SLOT:
+            slot_num = (slot_num + 1) & (slot_count - 1)
+        slots[slot_num] = (key_hash, offset, len(record))
+        offset += len(record)
+    return slots, offset
+
+
+def write_table(f, records: List[Tuple[int, bytes]], slots: List[Slot]):
+    for _, record in records:
+        f.write(record)
+    for slot in slots:
+        f.write(SLOT.pack(*slot))
+
+
+def lookup(buffer, slots_offset: int, slot_count: int, key: bytes, key_hash: int) -> Optional[Dict]:
+    """
+    Find a record by its key in a table laid out by build_slots(),
+    decoding only the matching record
+
+    Returns
+    -------
+    Optional[Dict]
+        The record's decoded value, or None if there's no record for key
+    """
+    if slot_count == 0:
+        return None
+    mask = slot_count - 1
+    slot_num = key_hash & mask
+    while True:
+        slot_offset = slots_offset + slot_num * SLOT.size
+        slot_hash, offset, length = SLOT.unpack_from(buffer, slot_offset)
+        if offset == 0:
+            return None
+        if slot_hash == key_hash:
+            (key_len,) = _KEY_LEN.unpack_from(buffer, offset)
+            key_start = offset + _KEY_LEN.size
+            if buffer[key_start:key_start + key_len] == key:
+                value_json = buffer[key_start + key_len:offset + length]
+                return json.loads(value_json)
+        slot_num = (slot_num + 1) & mask
@@ -0,0 +1,436 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Dict, List, MutableMapping, Optional, Tuple
+
+from .file_util import atomic_open, lock_path_for, locked
+from .journal import directory_file_state
+from .mock_cmd_state import (
+    MockCMDEnvironmentConfig,
+    MockCMDStateMaxIterationException,
+    _read_iteration_counter,
+    _write_iteration_counter
+)
+from .slot_table import (
+    SLOT,
+    build_slots,
+    encode_key,
+    entry_key,
+    lookup,
+    pack_record,
+    write_table
+)
+
+BUNDLE_SUFFIX = ".bundle"
+
+# A state bundle compiles a mock command state config and every response directory
+# in its state list into one memory-mapped file, so an invocation of a stateful mock
+# reads the small current iteration counter and does one lookup in the bundle,
+# rather than parsing the config and the current iteration's whole response directory.
+# While a bundle exists, the current iteration is kept in iteration.json
+# (or iteration-<namespace>.json) rather than in the config, so the config isn't rewritten
+# on every state change. Rewriting the config (or any response directory) makes the bundle stale,
+# and it's rebuilt the next time it's used. Counters record the config they were counted against,
+# so a rewritten config starts over from its iteration, but a changed response directory doesn't
+#
+# Bundle file layout (all integers little-endian):
+#   header:     magic, version, config mtime (ns), config size,
+#               config iteration, max iterations, iteration count, directory count,
+#               slot count, slot table offset
+#   iterations: directory number, env-vars offset, env-vars length
+#   directories: source state (mtime, size, journal mtime, journal size), archive flag,
+#               path offset, path length, meta offset, meta length, patterns offset, patterns length
+#   data:       UTF-8 paths and JSON-encoded env-vars, meta, and command_patterns
+#   records:    key length (u32), key bytes, JSON-encoded response dictionary
+#               where the key is the directory number (u32), input hash, NUL, argument string
+#   slots:      open-addressed hash table of (key hash, record offset, record length)
+# see mock_cli.slot_table for the layout of the records and slots
+_MAGIC = b"MCLISTB\x00"
+_VERSION = 1
+_HEADER = struct.Struct("<8sIqqqqQQQQ")
+_ITERATION = struct.Struct("<IQQ")
+_DIRECTORY = struct.Struct("<qqqqIQQQQQQ")
+_DIRECTORY_NUM = struct.Struct("<I")
+
+
+class StateBundleException(Exception):
+    pass
+
+
+def bundle_path_for(config_path) -> Path:
+    config_path = Path(config_path)
+    bundle_path = config_path.with_name(config_path.name + BUNDLE_SUFFIX)
+    return bundle_path
+
+
+def _entry_key(directory_num: int, input_hash: Optional[str], arg_string: str) -> bytes:
+    key = _DIRECTORY_NUM.pack(directory_num) + entry_key(input_hash, arg_string)
+    return key
+
+
+def _key_hash(key: bytes) -> int:
+    # crc32 rather than hashlib, which is comparatively slow to import
+    # collisions only cost an extra key comparison
+    return zlib.crc32(key)
+
+
+def _counter_path(config_path, namespace: Optional[str]) -> str:
+    # string paths rather than pathlib, which adds up when opening a bundle on every invocation
+    state_dir = os.path.dirname(os.fspath(config_path))
+    if namespace:
+        # the same file a namespace's iteration is kept in without a bundle
+        return os.path.join(state_dir, f"iteration-{namespace}.json")
+    return os.path.join(state_dir, "iteration.json")
+
+
+def build_state_bundle(state_dir, config_name: str = "config.json") -> Path:
+    """
+    Compile a mock command state config and its response directories into a state bundle
+
+    Stateful mocks using this state directory pick up the bundle automatically.
+    The current iteration carries on, unless the config has changed since it was saved
+
+    Parameters
+    ----------
+    state_dir : Union[str, Path]
+        The state directory, or the state config file itself
+    config_name : str, optional
+        The config's file name, if a directory is given, by default "config.json"
+
+    Returns
+    -------
+    Path
+        The path to the newly written bundle
+    """
+    state_dir = Path(state_dir)
+    if state_dir.is_dir():
+        config_path = Path(state_dir, config_name)
+    else:
+        config_path = state_dir
+    with locked(lock_path_for(config_path)):
+        _build_state_bundle(config_path)
+    return bundle_path_for(config_path)
+
+
+def _build_state_bundle(config_path: Path):
+    # only needed when (re)building the bundle
+    from .archive import is_archive
+    from .responses import ResponseDirectory
+
+    # stat before reading, so if anything changes while we're reading it,
+    # the bundle will look stale and get rebuilt next time
+    config_state = directory_file_state(config_path)[:2]
+    with open(config_path, "r") as f:
+        config = json.load(f)
+
+    state_list = config["state-list"]
+    directory_nums: Dict[str, int] = {}
+    directories = []
+    for state in state_list:
+        path = state["response-directory"]
+        if path in directory_nums:
+            continue
+        directory_nums[path] = len(directories)
+        source_state = directory_file_state(path)
+        if is_archive(path):
+            # already indexed, and its output can only be read from the archive
+            directories.append((path, source_state, None))
+        else:
+            directory = ResponseDirectory(path)._response_directory
+            directories.append((path, source_state, directory))
+
+    data = bytearray()
+
+    def _add_data(value: bytes) -> Tuple[int, int]:
+        # offsets are relative to the start of the data section until it's placed
+        offset = len(data)
+        data.extend(value)
+        return offset, len(value)
+
+    iterations = []
+    for state in state_list:
+        env = json.dumps(state.get("env-vars", {"set": {}, "pop": []})).encode()
+        iterations.append(
+            (directory_nums[state["response-directory"]], _add_data(env)))
+
+    directory_entries = []
+    records = []
+    for directory_num, (path, source_state, directory) in enumerate(directories):
+        path_ref = _add_data(encode_key(path))
+        if directory is None:
+            directory_entries.append(
+                (source_state, 1, path_ref, (0, 0), (0, 0)))
+            continue
+        meta_ref = _add_data(json.dumps(directory["meta"]).encode())
+        patterns_ref = _add_data(json.dumps(
+            directory.get("command_patterns", [])).encode())
+        directory_entries.append(
+            (source_state, 0, path_ref, meta_ref, patterns_ref))
+        commands = [(None, directory.get("commands", {}))]
+        commands.extend(directory.get("commands_with_input", {}).items())
+        for input_hash, command_dict in commands:
+            for arg_string, response_dict in command_dict.items():
+                key = _entry_key(directory_num, input_hash, arg_string)
+                records.append((_key_hash(key), pack_record(key, response_dict)))
+
+    data_offset = _HEADER.size + len(iterations) * _ITERATION.size + \
+        len(directory_entries) * _DIRECTORY.size
+
+    slots, slots_offset = build_slots(records, data_offset + len(data))
+
+    header = _HEADER.pack(_MAGIC, _VERSION, *config_state,
+                          config["iteration"], config["max-iterations"],
+                          len(iterations), len(directory_entries),
+                          len(slots), slots_offset)
+
+    bundle_path = bundle_path_for(config_path)
+    with atomic_open(bundle_path, "wb") as f:
+        f.write(header)
+        for directory_num, (env_offset, env_len) in iterations:
+            f.write(_ITERATION.pack(
+                directory_num, data_offset + env_offset, env_len))
+        for source_state, archive, *refs in directory_entries:
+            refs = [value for offset, length in refs
+                    for value in (data_offset + offset, length)]
+            f.write(_DIRECTORY.pack(*source_state, archive, *refs))
+        f.write(data)
+        write_table(f, records, slots)
+
+
+class _BundledDirectory:
+    """
+    One response directory in a state bundle, looked up the same way as a ResponseIndex
+    """
+
+    def __init__(self, bundle: "StateBundle", directory_num: int, meta: Dict,
+                 patterns_ref: Tuple[int, int]):
+        self._bundle = bundle
+        self._directory_num = directory_num
+        self._meta = meta
+        self._patterns_ref = patterns_ref
+        self._command_patterns = None
+
+    @property
+    def meta(self) -> Dict:
+        return self._meta
+
+    @property
+    def command_patterns(self) -> List[Dict]:
+        if self._command_patterns is None:
+            self._command_patterns = json.loads(
+                self._bundle._data(*self._patterns_ref))
+        return self._command_patterns
+
+    def lookup(self, input_hash: Optional[str], arg_string: str) -> Optional[Dict]:
+        key = _entry_key(self._directory_num, input_hash, arg_string)
+        return self._bundle._lookup(key)
+
+
+class StateBundle:
+    """
+    A memory-mapped, compiled mock command state, standing in for MockCMDStateConfig
+
+    Applies the current iteration's environment changes when it's opened,
+    the same as MockCMDStateConfig
+    """
+
+    def __init__(self, config_path, namespace: Optional[str] = None,
+                 environ: Optional[MutableMapping[str, str]] = None):
+        self._config_path = os.fspath(config_path)
+        self._bundle_path = self._config_path + BUNDLE_SUFFIX
+        self._namespace = namespace
+        # where the current iteration's environment changes are made, by default os.environ
+        self._environ = environ
+        self._counter_path = _counter_path(config_path, namespace)
+        self._mmap = self._open(self._bundle_path)
+        try:
+            self._parse_header()
+            self.iteration = self._read_saved_iteration()
+            current = self._is_current()
+        except BaseException:
+            self._mmap.close()
+            raise
+        if not current:
+            self._mmap.close()
+            self._rebuild()
+        self._env_config: Optional[MockCMDEnvironmentConfig] = None
+        self._initialize_env()
+
+    @staticmethod
+    def _open(bundle_path) -> mmap.mmap:
+        with open(bundle_path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _parse_header(self):
+        if len(self._mmap) < _HEADER.size:
+            raise StateBundleException("Truncated state bundle")
+        (magic, version,
+         *config_state,
+         self._shared_iteration, self._max_iterations,
+         self._iteration_count, self._directory_count,
+         self._slot_count, self._slots_offset) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise StateBundleException("Unrecognized state bundle format")
+        self._config_state = tuple(config_state)
+        expected_len = self._slots_offset + self._slot_count * SLOT.size
+        if len(self._mmap) != expected_len:
+            raise StateBundleException("Truncated state bundle")
+
+    def _rebuild(self):
+        config_lock = lock_path_for(self._config_path)
+        with locked(config_lock):
+            # another process may have rebuilt it while we waited for the lock
+            self._mmap = self._open(self._bundle_path)
+            self._parse_header()
+            self.iteration = self._read_saved_iteration()
+            if self._is_current():
+                return
+            self._mmap.close()
+            _build_state_bundle(Path(self._config_path))
+            self._mmap = self._open(self._bundle_path)
+            self._parse_header()
+            self.iteration = self._read_saved_iteration()
+
+    def _is_current(self) -> bool:
+        config_stat = os.stat(self._config_path)
+        if (config_stat.st_mtime_ns, config_stat.st_size) != self._config_state:
+            return False
+        source_state, _, path_ref, _, _ = self._directory_entry(
+            self._current_directory_num())
+        path = self._data(*path_ref).decode("utf-8", "surrogatepass")
+        try:
+            current = directory_file_state(path) == source_state
+        except FileNotFoundError:
+            current = False
+        return current
+
+    @property
+    def iteration(self) -> int:
+        return self._iteration
+
+    @iteration.setter
+    def iteration(self, iteration: int):
+        self._iteration = iteration
+
+    @property
+    def max_iterations(self) -> int:
+        return self._max_iterations
+
+    @property
+    def response_directory(self) -> str:
+        _, _, path_ref, _, _ = self._directory_entry(
+            self._current_directory_num())
+        path = self._data(*path_ref).decode("utf-8", "surrogatepass")
+        return path
+
+    def response_index(self) -> Optional[_BundledDirectory]:
+        """
+        The current iteration's response directory, for looking up responses,
+        or None if it's a response archive, which has its own index
+        """
+        directory_num = self._current_directory_num()
+        _, archive, _, meta_ref, patterns_ref = self._directory_entry(
+            directory_num)
+        if archive:
+            return None
+        meta = json.loads(self._data(*meta_ref))
+        return _BundledDirectory(self, directory_num, meta, patterns_ref)
+
+    def iterate(self):
+        # Lock so concurrent invocations each advance the state exactly once
+        # and re-read the saved iteration, since another process
+        # may have iterated since we loaded it
+        if self._namespace:
+            lock_path = lock_path_for(self._counter_path)
+        else:
+            # the same lock the bundle is rebuilt under
+            lock_path = lock_path_for(self._config_path)
+        with locked(lock_path):
+            self.iteration = self._read_saved_iteration()
+            if self.iteration >= self.max_iterations:
+                raise MockCMDStateMaxIterationException(
+                    f"Already reached max iterations: {self.max_iterations}")
+            self.iteration += 1
+            _write_iteration_counter(
+                self._counter_path, self.iteration, self._config_state)
+
+        self.restore_env()
+        self._initialize_env()
+
+    def restore_env(self):
+        """
+        Undo the current state iteration's environment changes
+        """
+        if self._env_config is not None:
+            self._env_config.restore_env()
+            self._env_config = None
+
+    def close(self):
+        self.restore_env()
+        self._mmap.close()
+
+    def _read_saved_iteration(self) -> int:
+        # the config's state is in the header, so there's no need to stat it again
+        iteration = _read_iteration_counter(
+            self._counter_path, self._config_state)
+        if iteration is None:
+            # we haven't iterated since the config was written
+            iteration = self._shared_iteration
+        return iteration
+
+    def _initialize_env(self):
+        if self._env_config is None:
+            _, env_offset, env_len = self._iteration_entry(self.iteration)
+            env_config = MockCMDEnvironmentConfig(
+                json.loads(self._data(env_offset, env_len)))
+            env_config.initialize_env(self._environ)
+            self._env_config = env_config
+
+    def _iteration_entry(self, iteration: int) -> Tuple[int, int, int]:
+        if not 0 <= iteration < self._iteration_count:
+            raise StateBundleException(
+                f"No state for iteration {iteration}, state list has {self._iteration_count}")
+        offset = _HEADER.size + iteration * _ITERATION.size
+        return _ITERATION.unpack_from(self._mmap, offset)
+
+    def _current_directory_num(self) -> int:
+        directory_num, _, _ = self._iteration_entry(self.iteration)
+        return directory_num
+
+    def _directory_entry(self, directory_num: int):
+        offset = _HEADER.size + self._iteration_count * _ITERATION.size + \
+            directory_num * _DIRECTORY.size
+        (*source_state, archive,
+         path_offset, path_len,
+         meta_offset, meta_len,
+         patterns_offset, patterns_len) = _DIRECTORY.unpack_from(self._mmap, offset)
+        entry = (tuple(source_state), archive, (path_offset, path_len),
+                 (meta_offset, meta_len), (patterns_offset, patterns_len))
+        return entry
+
+    def _data(self, offset: int, length: int) -> bytes:
+        return self._mmap[offset:offset + length]
+
+    def _lookup(self, key: bytes) -> Optional[Dict]:
+        return lookup(self._mmap, self._slots_offset, self._slot_count,
+                      key, _key_hash(key))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compile a mock command state directory into a state bundle")
+    parser.add_argument("state_dir",
+                        help="State directory (or state config file) to compile")
+    parsed = parser.parse_args()
+    bundle_path = build_state_bundle(parsed.state_dir)
+    print(bundle_path)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
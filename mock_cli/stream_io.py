@@ -0,0 +1,153 @@
+import errno
+import io
+import os
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+
+CHUNK_SIZE = 1024 * 1024
+
+# Recorded output may be provided as bytes, a readable file object such as
+# a subprocess pipe, or an iterable of byte chunks
+OutputSource = Union[bytes, BinaryIO, Iterable[bytes]]
+
+# errors meaning sendfile() can't be used with this pair of file descriptors,
+# e.g., on platforms where the output must be a socket
+_SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS,
+                         errno.ENOTSOCK, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def _wait_writable(out_fd: int):
+    # only needed if we were handed a non-blocking file descriptor
+    import select
+
+    select.select([], [out_fd], [])
+
+
+def write_all(out_fd: int, data) -> int:
+    """
+    Write all of data to a file descriptor, retrying partial writes
+    """
+    view = memoryview(data)
+    total = len(view)
+    while view:
+        try:
+            written = os.write(out_fd, view)
+        except BlockingIOError:
+            _wait_writable(out_fd)
+            continue
+        view = view[written:]
+    return total
+
+
+def is_stream(source: OutputSource) -> bool:
+    return not isinstance(source, (bytes, bytearray, memoryview, str))
+
+
+def _read_chunks(source: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def iter_chunks(source: OutputSource, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Iterate over the data from an output source in chunks of bounded size
+    (if the source is a file object) or as provided (if it's an iterable)
+    """
+    if not is_stream(source):
+        chunks = [source]
+    elif hasattr(source, "read"):
+        chunks = _read_chunks(source, chunk_size)
+    else:
+        chunks = source
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if chunk:
+            yield chunk
+
+
+def write_to_path(path, source: OutputSource, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Write an output source to a file, one chunk at a time
+
+    Returns
+    -------
+    int
+        The number of bytes written
+    """
+    written = 0
+    with open(path, "wb") as f:
+        for chunk in iter_chunks(source, chunk_size=chunk_size):
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def _is_plain_file(src: BinaryIO) -> bool:
+    # a file object whose file descriptor yields exactly the bytes that read() would
+    # this excludes things like GzipFile, whose fileno() is the compressed file
+    # and pipes, which sendfile() can't take an offset into
+    plain = isinstance(src, (io.FileIO, io.BufferedReader)) and src.seekable()
+    return plain
+
+
+def copy_to_fd(src: BinaryIO, out_fd: int, chunk_size: int = CHUNK_SIZE,
+               count: Optional[int] = None) -> int:
+    """
+    Copy the remainder of a binary file object to a file descriptor
+    without reading it all into memory
+
+    If src is a regular file, the copy is done in-kernel with sendfile()
+    where the platform supports it, falling back to a chunked copy otherwise
+
+    Parameters
+    ----------
+    src : BinaryIO
+        A readable binary file object
+    out_fd : int
+        File descriptor to write to
+    chunk_size : int, optional
+        Maximum number of bytes to copy per system call, by default CHUNK_SIZE
+    count : Optional[int], optional
+        Copy at most this many bytes, rather than everything up to the end of src
+
+    Returns
+    -------
+    int
+        The number of bytes copied
+    """
+    copied = 0
+    if _is_plain_file(src) and hasattr(os, "sendfile"):
+        offset = src.tell()
+        in_fd = src.fileno()
+        try:
+            while count is None or copied < count:
+                size = chunk_size
+                if count is not None:
+                    size = min(size, count - copied)
+                try:
+                    sent = os.sendfile(out_fd, in_fd, offset + copied, size)
+                except BlockingIOError:
+                    _wait_writable(out_fd)
+                    continue
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in _SENDFILE_UNSUPPORTED:
+                raise
+        # sendfile() doesn't move src's file position, so do that ourselves
+        # if it failed part way through, the chunked copy below picks up where it left off
+        src.seek(offset + copied)
+
+    while count is None or copied < count:
+        size = chunk_size
+        if count is not None:
+            size = min(size, count - copied)
+        chunk = src.read(size)
+        if not chunk:
+            break
+        copied += write_all(out_fd, chunk)
+    return copied
@@ -0,0 +1,253 @@
+import io
+import struct
+import time
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .stream_io import CHUNK_SIZE, OutputSource, copy_to_fd, iter_chunks
+
+# set to a number to have mock commands replay recorded output with its original timing,
+# scaled by that factor: "1" for real time, "0.1" for ten times faster,
+# "0" to reproduce the original chunking without any delay
+TIMING_SCALE_ENV_NAME = "MOCK_CLI_TIMING_SCALE"
+
+STDOUT_STREAM = 1
+STDERR_STREAM = 2
+
+# Timing file layout (all integers little-endian):
+#   header: magic, version, total duration (ns), event count
+#   events: stream (1 = stdout, 2 = stderr), length (bytes), time since the command started (ns)
+# Version 1 stored lengths as 32 bits, too small for coalesced runs of output over 4 GiB
+_MAGIC = b"MCLITIM\x00"
+_VERSION = 2
+_HEADER = struct.Struct("<8sIQQ")
+_EVENT = struct.Struct("<BQQ")
+_EVENT_FORMATS = {1: struct.Struct("<BIQ"), _VERSION: _EVENT}
+
+
+class OutputTimingException(Exception):
+    pass
+
+
+class OutputEvent(NamedTuple):
+    stream: int
+    length: int
+    time_ns: int
+
+
+class OutputTiming:
+    """
+    When each chunk of a command's output was produced, and on which stream
+
+    The order of the events also records how stdout and stderr were interleaved
+    """
+
+    def __init__(self, start_ns: Optional[int] = None):
+        """
+        Parameters
+        ----------
+        start_ns : Optional[int], optional
+            time.monotonic_ns() when the command was started.
+            Defaults to when this object is created
+        """
+        if start_ns is None:
+            start_ns = time.monotonic_ns()
+        self._start_ns = start_ns
+        self.events: List[OutputEvent] = []
+        self.duration_ns = 0
+
+    def timed_chunks(self, source: OutputSource, stream: int,
+                     chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Iterate over an output source, noting when each chunk arrives
+
+        File objects are read with read1() where possible, so chunks are yielded
+        as soon as they're available rather than once a full chunk has accumulated
+        """
+        read1 = getattr(source, "read1", None)
+        if read1 is not None:
+            chunks = iter(lambda: read1(chunk_size), b"")
+        else:
+            chunks = iter_chunks(source, chunk_size=chunk_size)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            self.note_chunk(stream, len(chunk))
+            yield chunk
+
+    def note_chunk(self, stream: int, length: int):
+        """
+        Note that a chunk of output just arrived, for output read some other way
+        than timed_chunks(), e.g., from an asyncio pipe
+        """
+        # list.append() is atomic, so stdout and stderr may be read concurrently
+        self.events.append(OutputEvent(
+            stream, length, time.monotonic_ns() - self._start_ns))
+
+    def finish(self, end_ns: Optional[int] = None):
+        """
+        Note when the command finished, and put events from both streams in order
+        """
+        if end_ns is None:
+            end_ns = time.monotonic_ns()
+        self.events.sort(key=lambda event: event.time_ns)
+        last_event_ns = self.events[-1].time_ns if self.events else 0
+        self.duration_ns = max(end_ns - self._start_ns, last_event_ns)
+
+    def coalesce(self):
+        """
+        Merge consecutive events on the same stream, keeping only how the streams
+        were interleaved (and when each run of output started)
+        """
+        coalesced = []
+        for event in self.events:
+            if coalesced and coalesced[-1].stream == event.stream:
+                last = coalesced[-1]
+                coalesced[-1] = last._replace(length=last.length + event.length)
+            else:
+                coalesced.append(event)
+        self.events = coalesced
+
+    def to_bytes(self) -> bytes:
+        parts = [_HEADER.pack(_MAGIC, _VERSION,
+                              self.duration_ns, len(self.events))]
+        parts.extend(_EVENT.pack(*event) for event in self.events)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "OutputTiming":
+        if len(data) < _HEADER.size:
+            raise OutputTimingException("Truncated output timing")
+        magic, version, duration_ns, event_count = _HEADER.unpack_from(data)
+        event_format = _EVENT_FORMATS.get(version)
+        if magic != _MAGIC or event_format is None:
+            raise OutputTimingException("Unrecognized output timing format")
+        if len(data) != _HEADER.size + event_count * event_format.size:
+            raise OutputTimingException("Truncated output timing")
+        timing = cls(start_ns=0)
+        timing.duration_ns = duration_ns
+        timing.events = [OutputEvent(*event)
+                         for event in event_format.iter_unpack(data[_HEADER.size:])]
+        return timing
+
+    @classmethod
+    def from_file(cls, path) -> "OutputTiming":
+        with open(path, "rb") as f:
+            data = f.read()
+        return cls.from_bytes(data)
+
+    def replay(self, streams: Dict[int, Tuple[BinaryIO, int]], scale: float = 1.0) -> Dict[int, int]:
+        """
+        Write output to file descriptors in the recorded order and chunk sizes,
+        sleeping between chunks to reproduce the recorded timing
+
+        Parameters
+        ----------
+        streams : Dict[int, Tuple[BinaryIO, int]]
+            For each stream, the recorded output to read from and the file descriptor to write to
+        scale : float, optional
+            Multiplier for recorded delays, e.g., 0.1 to replay ten times faster,
+            or 0 to not delay at all, by default 1.0
+
+        Returns
+        -------
+        Dict[int, int]
+            The number of bytes written for each stream
+        """
+        written = {stream: 0 for stream in streams}
+        start_ns = time.monotonic_ns()
+        for event in self.events:
+            if scale > 0:
+                _sleep_until(start_ns + int(event.time_ns * scale))
+            src, out_fd = streams[event.stream]
+            written[event.stream] += copy_to_fd(src, out_fd, count=event.length)
+        # anything the events don't account for
+        for stream, (src, out_fd) in streams.items():
+            written[stream] += copy_to_fd(src, out_fd)
+        if scale > 0:
+            _sleep_until(start_ns + int(self.duration_ns * scale))
+        return written
+
+
+class InterleavedReader(io.RawIOBase):
+    """
+    Read stdout and stderr as a single stream, interleaved the way they were recorded,
+    e.g., for a consumer that merged them with stderr=subprocess.STDOUT
+
+    Output is read from each stream as needed rather than buffered in memory
+    """
+
+    def __init__(self, timing: OutputTiming, streams: Dict[int, BinaryIO]):
+        super().__init__()
+        self._events = iter(timing.events)
+        self._streams = streams
+        # anything the events don't account for is read afterward, stdout first
+        self._leftovers = [streams[stream] for stream in sorted(streams)]
+        self._current: Optional[BinaryIO] = None
+        self._remaining = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        if not view:
+            return 0
+        while True:
+            if self._current is None and not self._next_stream():
+                return 0
+            size = len(view)
+            if self._remaining is not None:
+                size = min(size, self._remaining)
+            data = self._current.read(size)
+            if not data:
+                # the stream ran out before its event did
+                self._current = None
+                continue
+            view[:len(data)] = data
+            if self._remaining is not None:
+                self._remaining -= len(data)
+                if self._remaining == 0:
+                    self._current = None
+            return len(data)
+
+    def _next_stream(self) -> bool:
+        event = next(self._events, None)
+        if event is not None:
+            self._current = self._streams[event.stream]
+            self._remaining = event.length
+            return True
+        if self._leftovers:
+            self._current = self._leftovers.pop(0)
+            # until the end of the stream
+            self._remaining = None
+            return True
+        return False
+
+    def close(self):
+        if not self.closed:
+            for stream in self._streams.values():
+                stream.close()
+        super().close()
+
+
+def interleaved_reader(timing: OutputTiming, stdout: BinaryIO, stderr: BinaryIO) -> BinaryIO:
+    streams = {STDOUT_STREAM: stdout, STDERR_STREAM: stderr}
+    return io.BufferedReader(InterleavedReader(timing, streams))
+
+
+def _sleep_until(deadline_ns: int):
+    remaining = deadline_ns - time.monotonic_ns()
+    if remaining > 0:
+        time.sleep(remaining / 1e9)
+
+
+def timing_scale_from_env(environ) -> Optional[float]:
+    scale = environ.get(TIMING_SCALE_ENV_NAME)
+    if not scale:
+        return None
+    try:
+        scale = float(scale)
+    except ValueError as e:
+        raise OutputTimingException(
+            f"Invalid {TIMING_SCALE_ENV_NAME}: {scale}") from e
+    return scale
@@ -17,8 +17,13 @@ setup(name='mock-cli-framework',
       url="https://github.com/zcutlip/mock-cli-framework.git",
       license="MIT",
       packages=find_packages(),
-      entry_points={},
-      python_requires='>=3.7',
+      entry_points={
+          "console_scripts": [
+              "mock-cli-server=mock_cli.server:main",
+              "mock-cli-client=mock_cli.client:main",
+          ]
+      },
+      python_requires='>=3.8',
       install_requires=[],
       package_data={'mock_cli': ['data/**/*json']},
       )
@@ -0,0 +1,22 @@
+from mock_cli.archive import pack_directory
+from mock_cli.responses import CommandInvocation, ResponseDirectory
+
+
+def test_pack_finds_input_relative_to_directory_json(tmp_path, monkeypatch):
+    fixtures = tmp_path / "fixtures"
+    monkeypatch.chdir(tmp_path)
+    directory = ResponseDirectory(fixtures / "dir.json", create=True,
+                                  response_dir="fixtures/responses", input_dir="fixtures/input")
+    invocation = CommandInvocation(["cat"], b"in", b"", 0, "cat", False, input=b"in")
+    directory.add_command_invocation(invocation, save=True)
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+
+    stats = pack_directory(fixtures / "dir.json", tmp_path / "dir.mockarchive")
+
+    assert stats["responses"] == 1
+    assert stats["inputs"] == 1
+    archive = ResponseDirectory(tmp_path / "dir.mockarchive")
+    response = archive.response_lookup(["cat"], input_hash=archive.hash_input(b"in"))
+    assert response.output == b"in"
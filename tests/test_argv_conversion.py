@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from mock_cli.argv_conversion import (
+    ARG_KEY_VERSION,
+    ARG_KEY_VERSION_LEGACY,
+    ArgKeyException,
+    argv_to_key,
+    upgrade_arg_keys
+)
+from mock_cli.responses import CommandInvocation, ResponseDirectory
+
+LONG_ARG = "x" * 2000
+
+
+def _add(directory, args, output):
+    invocation = CommandInvocation(args, output, b"", 0, output.decode(), False)
+    directory.add_command_invocation(invocation, save=True)
+
+
+def test_keys_are_unambiguous():
+    keys = [argv_to_key(argv) for argv in
+            (["a|b"], ["a", "b"], ["a\\", "b"], ["a\\|b"], [""], [], ["\\e"])]
+
+    assert len(set(keys)) == len(keys)
+
+
+def test_ordinary_args_key_the_same_under_both_versions():
+    argv = ["item", "get", "--format=json"]
+
+    assert argv_to_key(argv) == argv_to_key(argv, version=ARG_KEY_VERSION_LEGACY)
+
+
+def test_long_args_are_digested():
+    key = argv_to_key(["get", LONG_ARG])
+
+    assert len(key) < 100
+    assert key != argv_to_key(["get", LONG_ARG + "y"])
+    assert argv_to_key(["get", LONG_ARG], digest_threshold=4096) == "get|" + LONG_ARG
+
+
+def test_unsupported_version():
+    with pytest.raises(ArgKeyException):
+        argv_to_key(["a"], version=3)
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_directory_lookup(tmp_path, use_index):
+    path = tmp_path / "dir.json"
+    directory = ResponseDirectory(path, create=True, response_dir=tmp_path / "responses")
+    _add(directory, ["a|b"], b"joined")
+    _add(directory, ["a", "b"], b"split")
+    _add(directory, [""], b"empty")
+    _add(directory, ["\udcff", LONG_ARG], b"long")
+
+    directory = ResponseDirectory(path, use_index=use_index)
+    assert directory.response_lookup(["a|b"]).output == b"joined"
+    assert directory.response_lookup(["a", "b"]).output == b"split"
+    assert directory.response_lookup([""]).output == b"empty"
+    assert directory.response_lookup(["\udcff", LONG_ARG]).output == b"long"
+
+
+def test_upgrade_legacy_directory(tmp_path):
+    path = tmp_path / "dir.json"
+    directory = ResponseDirectory(path, create=True, response_dir=tmp_path / "responses")
+    _add(directory, ["a", "b"], b"split")
+    _add(directory, ["get", LONG_ARG], b"long")
+    raw = json.loads(path.read_text())
+    del raw["meta"]["arg_key_version"]
+    # keyed the way a directory recorded before version 2 would be
+    raw["commands"] = {argv_to_key(argv, version=ARG_KEY_VERSION_LEGACY): raw["commands"][argv_to_key(argv)]
+                       for argv in (["a", "b"], ["get", LONG_ARG])}
+    path.write_text(json.dumps(raw))
+    assert ResponseDirectory(path).arg_key_version == ARG_KEY_VERSION_LEGACY
+
+    stats = upgrade_arg_keys(path)
+
+    assert stats == {"commands": 2, "digested": 1}
+    directory = ResponseDirectory(path)
+    assert directory.arg_key_version == ARG_KEY_VERSION
+    assert directory.response_lookup(["a", "b"]).output == b"split"
+    assert directory.response_lookup(["get", LONG_ARG]).output == b"long"
+    # already upgraded
+    assert upgrade_arg_keys(path) == {"commands": 0, "digested": 0}
+    with pytest.raises(ArgKeyException):
+        upgrade_arg_keys(path, digest_threshold=10)
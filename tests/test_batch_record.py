@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+from mock_cli.batch_record import (
+    BatchRecorder,
+    BatchRecordException,
+    BatchRecordSpec
+)
+from mock_cli.responses import ResponseDirectory
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return ResponseDirectory(str(tmp_path / "dir.json"), create=True,
+                             response_dir=str(tmp_path / "responses"))
+
+
+def _spec(script, name, **kwargs):
+    return BatchRecordSpec([sys.executable, "-c", script], name, cmd_args=[name], **kwargs)
+
+
+def test_timed_recording(directory, tmp_path):
+    script = "import sys; sys.stdout.write(sys.stdin.read()); sys.stderr.write('err'); sys.exit(2)"
+    spec = _spec(script, "echo", input=b"x" * 200000, record_interleaving=True)
+
+    BatchRecorder(directory).record([spec])
+
+    response = ResponseDirectory(str(tmp_path / "dir.json")).response_lookup(
+        ["echo"], input_hash=directory.hash_input(b"x" * 200000))
+    assert response.return_code == 2
+    assert response.output == b"x" * 200000
+    assert response.error_output == b"err"
+    assert "timing" in response
+
+
+def test_timed_out_command_writes_nothing(directory, tmp_path):
+    script = "import sys, time; sys.stdout.write('partial'); sys.stdout.flush(); time.sleep(30)"
+    spec = _spec(script, "slow", record_timing=True)
+
+    with pytest.raises(BatchRecordException):
+        BatchRecorder(directory, timeout=0.5).record([spec])
+
+    responses = tmp_path / "responses"
+    assert not responses.exists() or os.listdir(responses) == []
+    assert directory.commands == {}
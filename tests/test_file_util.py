@@ -0,0 +1,50 @@
+import os
+import stat
+
+import pytest
+
+from mock_cli.file_util import atomic_open, atomic_write_json
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@pytest.fixture
+def umask():
+    old = os.umask(0o027)
+    yield 0o027
+    os.umask(old)
+
+
+def test_new_file_gets_umask_permissions(tmp_path, umask):
+    path = tmp_path / "new.json"
+
+    atomic_write_json(path, {"a": 1})
+
+    assert _mode(path) == 0o666 & ~umask
+
+
+def test_replaced_file_keeps_its_permissions(tmp_path, umask):
+    path = tmp_path / "existing.bin"
+    path.write_bytes(b"old")
+    os.chmod(path, 0o604)
+
+    with atomic_open(path, "wb") as f:
+        f.write(b"new")
+
+    assert path.read_bytes() == b"new"
+    assert _mode(path) == 0o604
+
+
+def test_failed_write_leaves_file_untouched(tmp_path):
+    path = tmp_path / "existing.bin"
+    path.write_bytes(b"old")
+
+    with pytest.raises(RuntimeError):
+        with atomic_open(path, "wb") as f:
+            f.write(b"new")
+            raise RuntimeError
+
+    assert path.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["existing.bin"]
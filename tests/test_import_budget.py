@@ -0,0 +1,5 @@
+from mock_cli.import_budget import check_import_budget
+
+
+def test_playback_import_budget():
+    assert check_import_budget() == []
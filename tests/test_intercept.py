@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+import pytest
+
+from mock_cli.intercept import SubprocessInterceptor
+from mock_cli.mock_cmd_state import MockCMDNewStateConfig
+from mock_cli.responses import CommandInvocation, ResponseDirectory
+
+
+@pytest.fixture
+def response_directory(tmp_path):
+    path = str(tmp_path / "dir.json")
+    directory = ResponseDirectory(path, create=True, response_dir=str(tmp_path / "responses"))
+    invocation = CommandInvocation(["--version"], b"tool 1.0\n", b"", 0, "version", True)
+    directory.add_command_invocation(invocation, save=True)
+    return path
+
+
+@pytest.fixture
+def state_dir(tmp_path, response_directory):
+    state_dir = tmp_path / "state"
+    state_dir.mkdir()
+    config = MockCMDNewStateConfig.from_template(state_dir / "config.json")
+    config.add_state(response_directory, 0, set_vars={"MOCK_TEST_VAR": "first"})
+    config.add_state(response_directory, 1, set_vars={"MOCK_TEST_VAR": "second"})
+    return state_dir
+
+
+def test_missing_response_exits_1(response_directory):
+    with SubprocessInterceptor() as interceptor:
+        interceptor.add_mock("tool", response_directory=response_directory)
+        result = subprocess.run(["tool", "--unrecorded"], capture_output=True)
+
+    assert result.returncode == 1
+    assert result.stdout == b""
+    assert b"No response for command args: --unrecorded" in result.stderr
+
+
+def test_missing_response_check_output(response_directory):
+    with SubprocessInterceptor() as interceptor:
+        interceptor.add_mock("tool", response_directory=response_directory)
+        with pytest.raises(subprocess.CalledProcessError) as excinfo:
+            subprocess.check_output(["tool", "--unrecorded"], stderr=subprocess.STDOUT)
+
+    assert b"No response" in excinfo.value.output
+
+
+def test_state_env_changes_stay_out_of_os_environ(state_dir, monkeypatch):
+    monkeypatch.delenv("MOCK_TEST_VAR", raising=False)
+    with SubprocessInterceptor() as interceptor:
+        interceptor.add_mock("tool", state_dir=state_dir)
+        result = subprocess.run(["tool", "--version"], capture_output=True)
+
+    assert result.stdout == b"tool 1.0\n"
+    assert "MOCK_TEST_VAR" not in os.environ
+
+
+def test_settings_read_from_call_env(state_dir, monkeypatch):
+    monkeypatch.setenv("MOCK_CMD_STATE_NAMESPACE", "from-os-environ")
+    env = dict(os.environ, MOCK_CMD_STATE_DIR=str(state_dir),
+               MOCK_CMD_STATE_NAMESPACE="from-call-env")
+    with SubprocessInterceptor() as interceptor:
+        interceptor.add_mock("tool")
+        subprocess.run(["tool", "--version"], capture_output=True, env=env)
+
+    assert (state_dir / "iteration-from-call-env.json").exists()
+    assert not (state_dir / "iteration-from-os-environ.json").exists()
@@ -0,0 +1,188 @@
+import os
+
+import pytest
+
+from mock_cli.maintenance import MaintenanceException, maintain
+from mock_cli.responses import CommandInvocation, ResponseDirectory
+
+
+def _add(directory, args, output, name, input=None):
+    invocation = CommandInvocation(args, output, b"", 0, name, False, input=input)
+    directory.add_command_invocation(invocation, save=True)
+
+
+def _new_directory(path, input_dir=None, **kwargs):
+    return ResponseDirectory(path, create=True, input_dir=input_dir, **kwargs)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # relative paths given when creating response directories are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_dry_run_reports_without_deleting(workdir):
+    directory = _new_directory("dir.json", response_dir="responses")
+    _add(directory, ["a"], b"a", "a")
+    orphan = workdir / "responses" / "orphan"
+    orphan.mkdir()
+    (orphan / "output").write_bytes(b"stale")
+
+    report = maintain("dir.json", dry_run=True)
+
+    assert report.unreferenced == [os.path.realpath(orphan)]
+    assert report.reclaimed_inodes == 2
+    assert report.reclaimed_bytes > 0
+    assert orphan.exists()
+
+
+def test_deletes_unreferenced_output(workdir):
+    directory = _new_directory("dir.json", response_dir="responses")
+    _add(directory, ["a"], b"a", "a")
+    orphan = workdir / "responses" / "orphan"
+    orphan.mkdir()
+    (orphan / "output").write_bytes(b"stale")
+    stray = workdir / "responses" / "a" / "stray"
+    stray.write_bytes(b"stray")
+
+    report = maintain("dir.json")
+
+    assert sorted(report.unreferenced) == sorted(
+        [os.path.realpath(orphan), os.path.realpath(stray)])
+    assert not orphan.exists()
+    assert not stray.exists()
+    assert ResponseDirectory("dir.json").response_lookup(["a"]).output == b"a"
+    # nothing left to reclaim
+    assert maintain("dir.json").unreferenced == []
+
+
+def test_deletes_unreferenced_blobs(workdir):
+    directory = _new_directory("dir.json", response_dir="responses", blob_dir="blobs")
+    _add(directory, ["a"], b"a", "a")
+    _add(directory, ["b"], b"b", "b")
+    del directory.commands["b"]
+    directory.save()
+
+    report = maintain("dir.json")
+
+    assert len(report.unreferenced) == 1
+    assert not os.path.exists(report.unreferenced[0])
+    assert ResponseDirectory("dir.json").response_lookup(["a"]).output == b"a"
+
+
+def test_default_input_dir_is_left_alone(workdir):
+    # "input" is the template's default input_dir, but nothing is recorded there
+    # unless ResponseDirectory is given input_dir, so it may be unrelated data
+    directory = _new_directory("dir.json", response_dir="responses")
+    _add(directory, ["cat"], b"x", "cat", input=b"x")
+    important = workdir / "input" / "important_data"
+    important.mkdir(parents=True)
+    (important / "keep.txt").write_bytes(b"keep")
+    (workdir / "input" / "more").mkdir()
+
+    dry_run_report = maintain("dir.json", dry_run=True)
+    report = maintain("dir.json")
+
+    assert dry_run_report.unreferenced == []
+    assert report.unreferenced == []
+    assert (important / "keep.txt").read_bytes() == b"keep"
+    assert (workdir / "input" / "more").is_dir()
+
+
+def test_explicit_input_dir_is_cleaned_up(workdir):
+    directory = _new_directory("dir.json", input_dir="recorded-input",
+                               response_dir="responses")
+    _add(directory, ["cat"], b"x", "cat", input=b"x")
+    recorded = [entry.path for entry in os.scandir("recorded-input")]
+    assert len(recorded) == 1
+    orphan = workdir / "recorded-input" / "0123abcd"
+    orphan.mkdir()
+    (orphan / "input.bin").write_bytes(b"orphan")
+
+    report = maintain("dir.json", input_dir="recorded-input")
+
+    assert report.unreferenced == [os.path.realpath(orphan)]
+    assert not orphan.exists()
+    assert os.path.exists(recorded[0])
+
+
+def test_shared_roots_maintained_together(workdir):
+    first = _new_directory("first.json", response_dir="responses", blob_dir="blobs")
+    second = _new_directory("second.json", response_dir="responses", blob_dir="blobs")
+    _add(first, ["a"], b"shared", "a")
+    _add(second, ["b"], b"shared", "b")
+    _add(second, ["c"], b"only second", "c")
+
+    report = maintain(["first.json", "second.json"])
+
+    assert report.unreferenced == []
+    assert report["responses"] == 3
+    assert ResponseDirectory("first.json").response_lookup(["a"]).output == b"shared"
+    assert ResponseDirectory("second.json").response_lookup(["c"]).output == b"only second"
+
+
+def test_blob_dir_nested_in_response_dir(workdir):
+    directory = _new_directory("dir.json", response_dir="responses",
+                               blob_dir=os.path.join("responses", "blobs"))
+    _add(directory, ["a"], b"a", "a")
+
+    report = maintain("dir.json")
+
+    assert report.unreferenced == []
+    assert ResponseDirectory("dir.json").response_lookup(["a"]).output == b"a"
+
+
+def test_drop_broken(workdir):
+    directory = _new_directory("dir.json", response_dir="responses")
+    _add(directory, ["a"], b"a", "a")
+    _add(directory, ["b"], b"b", "b")
+    missing = workdir / "responses" / "b" / "output"
+    missing.unlink()
+
+    report = maintain("dir.json", dry_run=True)
+    assert report.missing == [os.path.realpath(missing)]
+    assert "b" in ResponseDirectory("dir.json").commands
+
+    report = maintain("dir.json", drop_broken=True)
+    assert report["dropped"] == 1
+    assert "b" not in ResponseDirectory("dir.json").commands
+    assert not (workdir / "responses" / "b").exists()
+
+
+def test_response_dir_relative_to_directory_json(workdir, monkeypatch):
+    fixtures = workdir / "fixtures"
+    directory = _new_directory(fixtures / "dir.json", response_dir=fixtures / "responses")
+    _add(directory, ["a"], b"a", "a")
+    assert directory.meta["response_dir"] == str(fixtures / "responses")
+    directory = _new_directory(fixtures / "rel.json", response_dir="fixtures/responses")
+    _add(directory, ["b"], b"b", "b")
+    assert directory.meta["response_dir"] == "responses"
+    elsewhere = workdir / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+
+    report = maintain([fixtures / "dir.json", fixtures / "rel.json"])
+
+    assert report.missing == []
+    assert report.unreferenced == []
+    assert ResponseDirectory(fixtures / "rel.json").response_lookup(["b"]).output == b"b"
+
+
+def test_refuses_to_delete_when_most_files_are_missing(workdir):
+    directory = _new_directory("dir.json", response_dir="responses")
+    _add(directory, ["a"], b"a", "a")
+    _add(directory, ["b"], b"b", "b")
+    os.rename("responses", "moved")
+    os.mkdir("responses")
+    orphan = workdir / "responses" / "orphan"
+    orphan.mkdir()
+
+    with pytest.raises(MaintenanceException):
+        maintain("dir.json", drop_broken=True)
+    assert orphan.exists()
+    assert "b" in ResponseDirectory("dir.json").commands
+
+    report = maintain("dir.json", drop_broken=True, force=True)
+    assert report["dropped"] == 2
+    assert not orphan.exists()
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from mock_cli.journal import directory_file_state
+from mock_cli.response_index import ResponseIndex, build_index, index_path_for
+from mock_cli.responses import (
+    CommandInvocation,
+    ResponseDirectory,
+    ResponseLookupException
+)
+
+
+def _add(directory, args, output, name, input=None):
+    invocation = CommandInvocation(args, output, b"", 0, name, False, input=input)
+    directory.add_command_invocation(invocation, save=True)
+
+
+@pytest.fixture
+def json_path(tmp_path):
+    path = tmp_path / "dir.json"
+    directory = ResponseDirectory(path, create=True, response_dir=tmp_path / "responses")
+    _add(directory, ["a"], b"a", "a")
+    _add(directory, ["cat"], b"in", "cat", input=b"in")
+    # undecodable bytes in sys.argv are surrogate-escaped
+    _add(directory, ["\udcff"], b"surrogate", "surrogate")
+    return path
+
+
+def test_index_lookup(json_path):
+    directory = ResponseDirectory(json_path, use_index=True)
+
+    assert index_path_for(json_path).exists()
+    assert directory.response_lookup(["a"]).output == b"a"
+    assert directory.response_lookup(["\udcff"]).output == b"surrogate"
+    response = directory.response_lookup(["cat"], input_hash=directory.hash_input(b"in"))
+    assert response.output == b"in"
+    with pytest.raises(ResponseLookupException):
+        directory.response_lookup(["b"])
+
+
+def test_stale_index_is_rebuilt(json_path):
+    ResponseDirectory(json_path, use_index=True).response_lookup(["a"])
+    index = ResponseIndex(index_path_for(json_path))
+    _add(ResponseDirectory(json_path), ["b"], b"b", "b")
+
+    assert not index.is_current(directory_file_state(json_path))
+    index.close()
+    assert ResponseDirectory(json_path, use_index=True).response_lookup(["b"]).output == b"b"
+
+
+def test_journal_makes_index_stale(json_path):
+    build_index(json_path)
+    _add(ResponseDirectory(json_path, journal=True), ["b"], b"b", "b")
+
+    assert ResponseDirectory(json_path, use_index=True).response_lookup(["b"]).output == b"b"
+
+
+def test_corrupt_index_is_rebuilt(json_path):
+    index_path = build_index(json_path)
+    index_path.write_bytes(b"garbage")
+
+    assert ResponseDirectory(json_path, use_index=True).response_lookup(["a"]).output == b"a"
+    assert os.path.getsize(index_path) > len(b"garbage")
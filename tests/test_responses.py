@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+import pytest
+
+from mock_cli.responses import (
+    CommandInvocation,
+    ResponseDirectory,
+    ResponseRecordException
+)
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return ResponseDirectory(str(tmp_path / "dir.json"), create=True,
+                             response_dir=str(tmp_path / "responses"))
+
+
+def test_record_running_process(directory, tmp_path):
+    script = "import sys; sys.stdout.write('x' * 200000); sys.stderr.write('err'); sys.exit(3)"
+    proc = subprocess.Popen([sys.executable, "-c", script],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    invocation = CommandInvocation(["run"], proc.stdout, proc.stderr, proc, "run", False)
+
+    directory.add_command_invocation(invocation, save=True)
+    proc.stdout.close()
+    proc.stderr.close()
+
+    response = ResponseDirectory(str(tmp_path / "dir.json")).response_lookup(["run"])
+    assert response.return_code == 3
+    assert response.output == b"x" * 200000
+    assert response.error_output == b"err"
+
+
+def test_record_exit_status_callable(directory):
+    invocation = CommandInvocation(["run"], b"out", b"", lambda: 5, "run", False)
+
+    directory.add_command_invocation(invocation)
+
+    assert directory.response_lookup(["run"]).return_code == 5
+
+
+def test_missing_exit_status():
+    with pytest.raises(ResponseRecordException):
+        CommandInvocation(["run"], b"out", b"", None, "run", False)
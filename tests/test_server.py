@@ -0,0 +1,96 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from mock_cli.responses import CommandInvocation, ResponseDirectory
+from mock_cli.server import ForkingMockCommandServer, MockCommandServer
+from mock_cli.server_protocol import (
+    MockCLIProtocolException,
+    recv_request,
+    send_request
+)
+
+
+@pytest.fixture
+def json_path(tmp_path):
+    path = tmp_path / "dir.json"
+    directory = ResponseDirectory(path, create=True, response_dir=tmp_path / "responses")
+    for args, output, error_output, exit_status, input in [
+            (["status"], b"out", b"err", 3, None),
+            (["cat"], b"from stdin", b"", 0, b"some input")]:
+        invocation = CommandInvocation(args, output, error_output, exit_status,
+                                       args[0], False, input=input)
+        directory.add_command_invocation(invocation, save=True)
+    return path
+
+
+@pytest.fixture(params=[MockCommandServer, ForkingMockCommandServer])
+def socket_path(request, tmp_path, json_path):
+    socket_path = str(tmp_path / "server.sock")
+    server = request.param(socket_path, response_directory=str(json_path))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def _run_client(socket_path, args, input=None):
+    env = dict(os.environ, MOCK_CLI_SERVER_SOCKET=socket_path)
+    if input is not None:
+        env["MOCK_CLI_READ_STDIN"] = "1"
+    return subprocess.run([sys.executable, "-m", "mock_cli.client"] + args,
+                          input=input, capture_output=True, env=env)
+
+
+def test_exit_status_and_output(socket_path):
+    # the server writes straight to the client's stdout & stderr
+    proc = _run_client(socket_path, ["status"])
+
+    assert proc.returncode == 3
+    assert proc.stdout == b"out"
+    assert proc.stderr == b"err"
+
+
+def test_stdin_is_forwarded(socket_path):
+    proc = _run_client(socket_path, ["cat"], input=b"some input")
+
+    assert proc.returncode == 0
+    assert proc.stdout == b"from stdin"
+
+
+def test_missing_response(socket_path):
+    proc = _run_client(socket_path, ["missing"])
+
+    assert proc.returncode == 1
+    assert proc.stdout == b""
+    assert b"ResponseLookupException" in proc.stderr
+
+
+def test_request_passes_file_descriptors():
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    read_fd, write_fd = os.pipe()
+    with client, server:
+        send_request(client, {"args": ["a"]}, [write_fd, write_fd])
+        os.close(write_fd)
+        request, fds = recv_request(server)
+
+    assert request == {"args": ["a"]}
+    for fd in fds:
+        os.write(fd, b"x")
+        os.close(fd)
+    assert os.read(read_fd, 2) == b"xx"
+    os.close(read_fd)
+
+
+def test_request_without_file_descriptors():
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client, server:
+        send_request(client, {"args": ["a"]}, [])
+        with pytest.raises(MockCLIProtocolException):
+            recv_request(server)
@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+
+from mock_cli.mock_cmd import MockCommand
+from mock_cli.mock_cmd_state import MockCMDNewStateConfig, MockCMDState
+from mock_cli.responses import CommandInvocation, ResponseDirectory
+from mock_cli.state_bundle import StateBundle, build_state_bundle
+
+
+def _new_directory(path, output, changes_state):
+    directory = ResponseDirectory(path, create=True, response_dir=path.parent / "responses")
+    invocation = CommandInvocation(["status"], output, b"", 0, f"status-{output.decode()}", changes_state)
+    directory.add_command_invocation(invocation, save=True)
+
+
+@pytest.fixture
+def state_dir(tmp_path):
+    state_dir = tmp_path / "state"
+    first = state_dir / "first" / "dir.json"
+    second = state_dir / "second" / "dir.json"
+    _new_directory(first, b"first", True)
+    _new_directory(second, b"second", False)
+    config = MockCMDNewStateConfig.from_template(state_dir / "config.json")
+    config.add_state(first, 0, set_vars={"STAGE": "first"})
+    config.add_state(second, 1, set_vars={"STAGE": "second"})
+    return state_dir
+
+
+def _respond(state_dir, environ):
+    with MockCommand(state_dir=state_dir, environ=environ) as cmd:
+        response = cmd.get_response(["status"])
+        if response.changes_state:
+            cmd._iterate_state()
+    return response.output
+
+
+def test_bundle_plays_back_each_iteration(state_dir):
+    build_state_bundle(state_dir)
+    environ = {}
+
+    with MockCMDState(state_dir, environ=environ) as state:
+        assert isinstance(state._config, StateBundle)
+        assert environ == {"STAGE": "first"}
+    assert _respond(state_dir, {}) == b"first"
+    assert _respond(state_dir, {}) == b"second"
+    assert _respond(state_dir, {}) == b"second"
+
+
+def test_namespace_counter_file(state_dir):
+    build_state_bundle(state_dir)
+    environ = {"MOCK_CMD_STATE_NAMESPACE": "gw0"}
+
+    assert _respond(state_dir, dict(environ)) == b"first"
+    assert _respond(state_dir, dict(environ)) == b"second"
+    # other namespaces, and the shared config, are unaffected
+    assert _respond(state_dir, {"MOCK_CMD_STATE_NAMESPACE": "gw1"}) == b"first"
+    assert json.load(open(state_dir / "config.json"))["iteration"] == 0
+
+    config_stat = os.stat(state_dir / "config.json")
+    with open(state_dir / "iteration-gw0.json") as f:
+        assert json.load(f) == {"iteration": 1,
+                                "config_state": [config_stat.st_mtime_ns, config_stat.st_size]}
+
+
+def test_counter_from_earlier_config_is_ignored(state_dir):
+    environ = {"MOCK_CMD_STATE_NAMESPACE": "gw0"}
+    assert _respond(state_dir, dict(environ)) == b"first"
+
+    # e.g., the scenario is set up again for a reused worker name
+    config = json.load(open(state_dir / "config.json"))
+    config["max-iterations"] += 1
+    with open(state_dir / "config.json", "w") as f:
+        json.dump(config, f)
+
+    assert _respond(state_dir, dict(environ)) == b"first"
+
+
+def test_stale_bundle_is_rebuilt(state_dir):
+    build_state_bundle(state_dir)
+    directory = ResponseDirectory(state_dir / "first" / "dir.json")
+    invocation = CommandInvocation(["status"], b"changed", b"", 0, "status-changed", True)
+    directory.add_command_invocation(invocation, overwrite=True, save=True)
+
+    assert _respond(state_dir, {}) == b"changed"
+
+
+@pytest.mark.parametrize("bundle", [False, True])
+@pytest.mark.parametrize("namespace", [None, "gw0"])
+def test_locks_are_kept_out_of_the_state_dir(state_dir, bundle, namespace):
+    if bundle:
+        build_state_bundle(state_dir)
+    environ = {}
+    if namespace:
+        environ["MOCK_CMD_STATE_NAMESPACE"] = namespace
+
+    assert _respond(state_dir, environ) == b"first"
+
+    assert list(state_dir.glob("*.lock")) == []
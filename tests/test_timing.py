@@ -0,0 +1,34 @@
+import struct
+
+from mock_cli.timing import (
+    STDERR_STREAM,
+    STDOUT_STREAM,
+    OutputEvent,
+    OutputTiming
+)
+
+
+def test_coalesced_run_over_4_gib_round_trips():
+    timing = OutputTiming(start_ns=0)
+    timing.events = [OutputEvent(STDOUT_STREAM, 2**31, n) for n in range(3)]
+    timing.events.append(OutputEvent(STDERR_STREAM, 1, 3))
+    timing.finish(end_ns=10)
+    timing.coalesce()
+    assert timing.events[0].length == 3 * 2**31
+
+    restored = OutputTiming.from_bytes(timing.to_bytes())
+
+    assert restored.events == timing.events
+    assert restored.duration_ns == 10
+
+
+def test_reads_version_1():
+    data = struct.pack("<8sIQQ", b"MCLITIM\x00", 1, 10, 2)
+    data += struct.pack("<BIQ", STDOUT_STREAM, 5, 1)
+    data += struct.pack("<BIQ", STDERR_STREAM, 7, 2)
+
+    timing = OutputTiming.from_bytes(data)
+
+    assert timing.duration_ns == 10
+    assert timing.events == [OutputEvent(STDOUT_STREAM, 5, 1),
+                             OutputEvent(STDERR_STREAM, 7, 2)]